@@ -0,0 +1,281 @@
+# coding: utf-8
+"""
+Benchmarks of the ConsulService request path and of applying remote config,
+run against flask_consulate.testing.FakeConsul on localhost.
+
+    python benchmarks/run.py --output results.json
+
+Every result records the number of operations, the total time and the
+latency distribution in microseconds, so runs can be compared by name.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+import requests
+
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_consulate import Consul, ConsulService  # noqa: E402
+from flask_consulate.instrumentation import Instrumentation  # noqa: E402
+from flask_consulate.testing import FakeConsul  # noqa: E402
+
+SERVICE = 'api'
+
+
+class Counter(Instrumentation):
+    """
+    Counts retries and the time slept for them, and keeps the size of the
+    last config fetched
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.retries = 0
+        self.retry_sleep = 0.0
+        self.fetched_bytes = None
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, labels):
+        if name == 'retry_sleep_seconds':
+            with self._lock:
+                self.retry_sleep += value
+        elif name == 'config_fetch_bytes':
+            self.fetched_bytes = value
+
+    def increment(self, name, value, labels):
+        if name == 'retries':
+            with self._lock:
+                self.retries += value
+
+
+def summarize(name, samples, total=None, **params):
+    """
+    :param samples: list of latencies in seconds
+    :param total: wall time of all operations, defaults to their sum
+    :return: dict describing the benchmark result
+    """
+    ordered = sorted(samples)
+    total = total if total is not None else sum(ordered)
+
+    def percentile(p):
+        return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)] * 1e6
+
+    return {
+        'name': name,
+        'params': params,
+        'operations': len(ordered),
+        'total_s': total,
+        'ops_per_s': len(ordered) / total if total else None,
+        'mean_us': sum(ordered) / len(ordered) * 1e6,
+        'p50_us': percentile(50),
+        'p99_us': percentile(99),
+        'max_us': ordered[-1] * 1e6,
+    }
+
+
+def timed(call, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = monotonic()
+        call()
+        samples.append(monotonic() - start)
+    return samples
+
+
+def service(fake, **kwargs):
+    return fake.service(
+        'consul://{}.service.consul'.format(SERVICE), cls=ConsulService,
+        **kwargs
+    )
+
+
+def bench_baseline(fake, iterations):
+    """
+    requests.Session.get against the same endpoint, without ConsulService
+    """
+    session = requests.Session()
+    url = fake.endpoints(SERVICE)[0].url + '/status'
+    return [summarize(
+        'requests_get_baseline',
+        timed(lambda: session.get(url, timeout=(1, 30)), iterations),
+    )]
+
+
+def bench_service_get(fake, iterations):
+    """
+    ConsulService.get with the endpoints served from the cache, and with
+    every call re-resolving them
+    """
+    results = []
+    cs = service(fake, min_ttl=3600, max_ttl=3600)
+    cs.get('/status')
+    results.append(summarize(
+        'service_get_cached', timed(lambda: cs.get('/status'), iterations),
+    ))
+    cs = service(fake, min_ttl=0, max_ttl=0)
+    results.append(summarize(
+        'service_get_resolve', timed(lambda: cs.get('/status'), iterations),
+    ))
+    return results
+
+
+def bench_throughput(fake, iterations, threads=(1, 4, 16)):
+    """
+    Requests per second of one ConsulService shared by N threads
+    """
+    results = []
+    for n in threads:
+        cs = service(fake, min_ttl=3600, max_ttl=3600, pool_maxsize=n)
+        cs.get('/status')
+        samples = [[] for _ in range(n)]
+
+        def worker(out):
+            out.extend(timed(lambda: cs.get('/status'), iterations // n))
+
+        workers = [
+            threading.Thread(target=worker, args=(out,)) for out in samples
+        ]
+        start = monotonic()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        results.append(summarize(
+            'service_get_threads', sum(samples, []),
+            total=monotonic() - start, threads=n,
+        ))
+    return results
+
+
+def bench_config_apply(fake, sizes):
+    """
+    apply_remote_config of namespaces with increasing numbers of keys, on
+    the first pass and on an unchanged second pass, fetched in one response
+    and walked in pages
+    """
+    results = []
+    for size in sizes:
+        namespace = 'bench/{}/'.format(size)
+        for i in range(size):
+            fake.set_kv(namespace + 'key_{}'.format(i),
+                        {'value': i, 'tags': ['a', 'b']})
+        counter = Counter()
+        consul = Consul(Flask('bench'), instrumentation=counter,
+                        **fake.consul_kwargs)
+        for phase in ('initial', 'unchanged'):
+            samples = timed(lambda: consul.apply_remote_config(namespace), 1)
+            results.append(summarize(
+                'config_apply', samples, keys=size, phase=phase,
+                bytes=counter.fetched_bytes,
+            ))
+        consul = Consul(Flask('bench'), **fake.consul_kwargs)
+        for phase in ('initial', 'unchanged'):
+            samples = timed(
+                lambda: consul.apply_remote_config(namespace, page_size=64), 1,
+            )
+            results.append(summarize(
+                'config_apply_paged', samples, keys=size, phase=phase,
+            ))
+    return results
+
+
+def bench_retries(fake, iterations, rates=(0.05, 0.2)):
+    """
+    ConsulService.get while a share of the requests fail, with the retries
+    and time slept for them
+    """
+    results = []
+    for mode in ('unavailable', 'reset'):
+        for rate in rates:
+            counter = Counter()
+            cs = service(
+                fake, min_ttl=3600, max_ttl=3600, instrumentation=counter,
+                retry_policy={'status_codes': [503], 'max_tries': 5},
+                circuit_breaker={'failure_rate': 1.0},
+            )
+            cs.get('/status')
+            endpoints = fake.endpoints(SERVICE)
+            for endpoint in endpoints:
+                endpoint.failure_mode, endpoint.failure_rate = mode, rate
+            failed = [0]
+
+            def call():
+                try:
+                    if cs.get('/status').status_code != 200:
+                        failed[0] += 1
+                except Exception:
+                    failed[0] += 1
+
+            try:
+                samples = timed(call, iterations)
+            finally:
+                for endpoint in endpoints:
+                    endpoint.failure_rate = 0
+            result = summarize(
+                'service_get_failures', samples, mode=mode, failure_rate=rate,
+            )
+            result.update(
+                retries=counter.retries, retry_sleep_s=counter.retry_sleep,
+                failed=failed[0],
+            )
+            results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='file to write the results to, '
+                                         'instead of stdout')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer iterations and no 100k key config')
+    args = parser.parse_args(argv)
+
+    iterations = 200 if args.quick else args.iterations
+    sizes = (10, 1000) if args.quick else (10, 1000, 100000)
+    fake = FakeConsul().start()
+    fake.serve(SERVICE, instances=2)
+    try:
+        results = []
+        results += bench_baseline(fake, iterations)
+        results += bench_service_get(fake, iterations)
+        results += bench_throughput(fake, iterations)
+        results += bench_config_apply(fake, sizes)
+        results += bench_retries(fake, iterations // 4)
+    finally:
+        fake.stop()
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
 # coding: utf-8
 
+import sys
+
 from flask_consulate.service import ConsulService
 from flask_consulate.consul import Consul
+
+if sys.version_info >= (3, 5):
+    from flask_consulate.aio import AsyncConsulService
@@ -0,0 +1,230 @@
+# coding: utf-8
+
+import os
+
+from contextlib import contextmanager
+
+import consulate
+import requests
+
+from six import string_types
+
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+from flask_consulate.exceptions import CircuitOpenError
+
+
+def parse_agents(hosts, port=8500):
+    """
+    :param hosts: list of hosts, or comma-separated string of them; either
+        may be given as host:port
+    :param port: port of the hosts given without one
+    :return: list of (host, port) tuples
+    """
+    if isinstance(hosts, string_types):
+        hosts = hosts.split(',')
+    agents = []
+    for host in hosts:
+        host = host.strip()
+        if not host:
+            continue
+        if ':' in host:
+            host, _, agent_port = host.rpartition(':')
+            agents.append((host, int(agent_port)))
+        else:
+            agents.append((host, int(port)))
+    return agents
+
+
+def default_agent():
+    """
+    :return: host:port of the first agent of $CONSUL_HOST and $CONSUL_PORT,
+        defaulting to localhost:8500
+    """
+    host, port = parse_agents(
+        os.environ.get('CONSUL_HOST') or 'localhost',
+        os.environ.get('CONSUL_PORT', 8500),
+    )[0]
+    return '{}:{}'.format(host, port)
+
+
+class Agent(object):
+    """
+    A consul agent, with its own connections - reused across calls and
+    retries - and the latency and failures of the calls made to it
+    """
+
+    def __init__(self, host, port, breaker, alpha=0.3):
+        """
+        :param breaker: CircuitBreaker of the agent
+        :param alpha: weight of the latest call in the moving average of
+            latencies
+        """
+        self.host = host
+        self.port = port
+        self.address = '{}:{}'.format(host, port)
+        self.base_uri = 'http://{}/v1/'.format(self.address)
+        self.breaker = breaker
+        self.alpha = alpha
+        # exponentially weighted moving average of call latencies, seconds
+        self.latency = None
+        self.failed_at = None
+        self._http = None
+        self._session = None
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """
+        Sockets must not be shared with the parent process, so drop the
+        connections inherited from it after a fork
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._http = None
+            self._session = None
+
+    @property
+    def http(self):
+        """
+        requests.Session for the parts of the consul HTTP API that consulate
+        doesn't expose
+        """
+        self._check_fork()
+        if self._http is None:
+            self._http = requests.Session()
+        return self._http
+
+    @property
+    def session(self):
+        """
+        consulate.Session of the agent
+        """
+        self._check_fork()
+        if self._session is None:
+            self._session = consulate.Session(host=self.host, port=self.port)
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._pid = os.getpid()
+        self._session = session
+
+    def record_success(self, elapsed=None):
+        """
+        :param elapsed: seconds the call took, or None if it shouldn't count
+            towards the latency, like a blocking query
+        """
+        self.failed_at = None
+        if elapsed is not None:
+            self.latency = elapsed if self.latency is None else \
+                self.alpha * elapsed + (1 - self.alpha) * self.latency
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.failed_at = monotonic()
+        self.breaker.record_failure()
+
+    def snapshot(self):
+        """
+        :return: dict describing the agent, for monitoring
+        """
+        return {
+            'latency': self.latency,
+            'failed_at': self.failed_at,
+            'breaker': self.breaker.state,
+        }
+
+
+class AgentPool(object):
+    """
+    The consul agents a Consul extension talks to. Every call goes to the
+    fastest agent by moving average latency whose circuit breaker is closed
+    and whose last call didn't fail within failover_cooldown seconds. Agents
+    that haven't been called yet come after those with a latency, in the
+    order given, so the first agent is used until it fails. A failed call
+    is retried on the next agent by the retry policy. If every agent failed
+    recently, the one that failed longest ago is tried.
+    """
+
+    def __init__(self, agents, breakers, failover_cooldown=10):
+        """
+        :param agents: list of (host, port) tuples, the local agent first
+        :param breakers: BreakerRegistry to take the agents' breakers from
+        :param failover_cooldown: seconds a failed agent is avoided for
+        """
+        assert agents, "At least one consul agent is required"
+        self.agents = [
+            Agent(host, port, breakers.get('{}:{}'.format(host, port)))
+            for host, port in agents
+        ]
+        self.failover_cooldown = failover_cooldown
+
+    @property
+    def primary(self):
+        """
+        The first agent, usually the one on the local node
+        """
+        return self.agents[0]
+
+    def choose(self):
+        """
+        :return: the Agent to make the next call to
+        :raises CircuitOpenError: if the breakers of all agents are open
+        """
+        now = monotonic()
+        best = fallback = None
+        for agent in self.agents:
+            if not agent.breaker.available():
+                continue
+            if agent.failed_at is not None and \
+                    now - agent.failed_at < self.failover_cooldown:
+                if fallback is None or agent.failed_at < fallback.failed_at:
+                    fallback = agent
+                continue
+            if best is None or self._faster(agent, best):
+                best = agent
+        if best is None:
+            best = fallback
+        if best is None:
+            raise CircuitOpenError(
+                'Circuit breakers of all consul agents are open'
+            )
+        return best
+
+    @staticmethod
+    def _faster(agent, other):
+        if agent.latency is None:
+            return False
+        return other.latency is None or agent.latency < other.latency
+
+    @contextmanager
+    def call(self, agent=None, timed=True):
+        """
+        Guard a call to an agent with its circuit breaker, and record its
+        outcome and latency
+
+        :param agent: Agent to call, instead of the one chosen
+        :param timed: count the duration of the call towards the latency
+        :return: context manager yielding the Agent to call
+        """
+        agent = agent if agent is not None else self.choose()
+        if not agent.breaker.allow():
+            raise CircuitOpenError(
+                'Circuit breaker of consul agent {} is open'.format(agent.address)
+            )
+        start = monotonic()
+        try:
+            yield agent
+        except Exception:
+            agent.record_failure()
+            raise
+        agent.record_success(monotonic() - start if timed else None)
+
+    def snapshot(self):
+        """
+        :return: dict of agent address to its snapshot, for monitoring
+        """
+        return dict((a.address, a.snapshot()) for a in self.agents)
@@ -0,0 +1,435 @@
+# coding: utf-8
+"""
+asyncio counterparts of ConsulService and Consul.apply_remote_config, for
+async Flask/Quart applications. Requires Python 3.5+ and aiohttp.
+"""
+
+import json
+import asyncio
+import functools
+
+import dns.message
+import dns.exception
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency
+    aiohttp = None
+
+from urllib.parse import urljoin
+
+from flask_consulate.decorators import RetryPolicy, get_retry_policy, \
+    get_hooks
+from flask_consulate.exceptions import ConsulConnectionError, \
+    RateLimitExceeded
+from flask_consulate.service import ConsulService, RESOLVE_ERRORS, \
+    monotonic, logger
+
+if aiohttp is not None:
+    ASYNC_RETRY_EXCEPTIONS = (
+        ConsulConnectionError, aiohttp.ClientConnectionError,
+        asyncio.TimeoutError,
+    )
+else:
+    ASYNC_RETRY_EXCEPTIONS = (ConsulConnectionError, asyncio.TimeoutError)
+
+
+# ConsulService arguments of its requests.Session, which requests of
+# AsyncConsulService don't go through
+SYNC_ONLY_ARGUMENTS = (
+    'pool_maxsize', 'pool_block', 'pool_idle_timeout', 'hedge',
+    'hedge_workers',
+)
+
+
+def require_aiohttp():
+    if aiohttp is None:
+        raise RuntimeError('aiohttp is required for asyncio support')
+
+
+def client_session(limit=100, limit_per_host=0):
+    """
+    :param limit: maximum number of open connections
+    :param limit_per_host: maximum number of open connections per endpoint,
+        or 0 for no limit
+    :return: aiohttp.ClientSession with a pooling connector
+    """
+    require_aiohttp()
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+        limit=limit, limit_per_host=limit_per_host,
+    ))
+
+
+def async_retry_connections(max_tries=3, sleep=0.05, **kwargs):
+    """
+    Coroutine counterpart of with_retry_connections, taking the same
+    RetryPolicy arguments and overrides. Sleeps with asyncio.sleep, so the
+    event loop keeps running between tries.
+    """
+    kwargs.setdefault('exceptions', ASYNC_RETRY_EXCEPTIONS)
+    default = RetryPolicy(max_tries=max_tries, sleep=sleep, **kwargs)
+
+    def decorator(f):
+        @functools.wraps(f)
+        async def f_retry(*args, **kwargs):
+            policy = getattr(args[0], 'retry_policy', None) if args else None
+            policy = get_retry_policy(
+                kwargs.pop('retry_policy', None),
+                policy if isinstance(policy, RetryPolicy) else default,
+            )
+            start = monotonic()
+            tries = 0
+            while True:
+                try:
+                    result = await f(*args, **kwargs)
+                except policy.exceptions as e:
+                    result, error = None, e
+                else:
+                    status_code = getattr(result, 'status', None)
+                    if status_code not in policy.status_codes:
+                        return result
+                    error = None
+                tries += 1
+                delay = policy.backoff(tries)
+                out_of_time = policy.deadline is not None and \
+                    monotonic() - start + delay >= policy.deadline
+                if tries >= policy.max_tries or out_of_time:
+                    if error is None:
+                        return result
+                    if isinstance(error, ConsulConnectionError):
+                        raise error
+                    raise ConsulConnectionError(error)
+                hooks = get_hooks(args)
+                if hooks.enabled:
+                    labels = {'call': f.__name__}
+                    hooks.increment('retries', 1, labels)
+                    hooks.observe('retry_sleep_seconds', delay, labels)
+                if delay:
+                    await asyncio.sleep(delay)
+        return f_retry
+    return decorator
+
+
+class _DNSProtocol(asyncio.DatagramProtocol):
+    """
+    Sends a single DNS query over UDP and resolves a future with the answer
+    """
+
+    def __init__(self, query, future):
+        self.query = query
+        self.future = future
+
+    def connection_made(self, transport):
+        transport.sendto(self.query.to_wire())
+
+    def datagram_received(self, data, addr):
+        if self.future.done():
+            return
+        try:
+            response = dns.message.from_wire(data)
+        except dns.exception.DNSException as e:
+            self.future.set_exception(e)
+            return
+        if self.query.is_response(response):
+            self.future.set_result(response)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def query_srv(name, nameservers, port=53, timeout=2.0):
+    """
+    Query the nameservers in turn for the SRV record of name without
+    blocking the event loop
+
+    :return: dns.message.Message
+    """
+    loop = asyncio.get_event_loop()
+    query = dns.message.make_query(name, 'SRV')
+    for nameserver in nameservers:
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DNSProtocol(query, future),
+            remote_addr=(nameserver, port),
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, OSError):
+            continue
+        finally:
+            transport.close()
+    raise dns.exception.Timeout()
+
+
+class AsyncConsulService(ConsulService):
+    """
+    ConsulService whose SRV resolution and requests are coroutines. It
+    shares the resolution cache, balancers, circuit breakers and retry
+    policy of ConsulService; requests go through a pooled aiohttp session.
+    Hedging and the per-endpoint connection pools of ConsulService don't
+    apply to it, and their arguments are rejected.
+
+    Example:
+
+    cs = AsyncConsulService("consul://tag.FOO.service")
+    response = await cs.get('/v1/status')
+    data = await response.json()
+    await cs.close()
+    """
+
+    def __init__(self, service_uri, connection_limit=100,
+                 connection_limit_per_host=0, **kwargs):
+        """
+        :param service_uri: string formatted service identifier
+            (consul://production.solr_service.consul)
+        :param connection_limit: maximum number of open connections
+        :param connection_limit_per_host: maximum number of open connections
+            per endpoint, or 0 for no limit
+        :param kwargs: ConsulService arguments, except for those of its
+            connection pools and hedging, which raise TypeError
+        """
+        unsupported = sorted(k for k in kwargs if k in SYNC_ONLY_ARGUMENTS)
+        if unsupported:
+            raise TypeError(
+                "AsyncConsulService doesn't support {}".format(', '.join(unsupported))
+            )
+        retry_policy = kwargs.pop('retry_policy', None)
+        super(AsyncConsulService, self).__init__(service_uri, **kwargs)
+        self.retry_policy = get_retry_policy(
+            retry_policy, RetryPolicy(exceptions=ASYNC_RETRY_EXCEPTIONS),
+        )
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self._client = None
+
+    def _init_session(self, pool_maxsize, pool_block, pool_idle_timeout):
+        # requests go through self.client instead
+        self.session = self.pools = None
+
+    @property
+    def client(self):
+        """
+        aiohttp.ClientSession, created on first use
+        """
+        if self._client is None or self._client.closed:
+            self._client = client_session(
+                self.connection_limit, self.connection_limit_per_host,
+            )
+        return self._client
+
+    async def close(self):
+        self.stop_refresh()
+        if self._client is not None:
+            await self._client.close()
+
+    async def _resolve_async(self):
+        if self.health is not None:
+            return await asyncio.get_event_loop().run_in_executor(
+                None, self._resolve,
+            )
+        start = monotonic() if self.instrumentation.enabled else None
+        response = await query_srv(
+            self.service, self.resolver.nameservers, port=self.resolver.port,
+            timeout=self.resolver.timeout,
+        )
+        if start is not None:
+            self._observe_resolve(start)
+        return self._parse_srv(response)
+
+    async def _refresh_async(self):
+        endpoints, ttl = await self._resolve_async()
+        self._store(endpoints, ttl)
+        return self.cache.remaining()
+
+    async def get_endpoints(self):
+        """
+        tuple of endpoint records; see ConsulService.endpoints
+        """
+        endpoints = self.cache.get()
+        if endpoints is None and self._refreshing():
+            endpoints = self.cache.get_stale()
+        if endpoints is None:
+            try:
+                endpoints, ttl = await self._resolve_async()
+            except RESOLVE_ERRORS:
+                endpoints = self.cache.get_stale()
+                if endpoints is None:
+                    raise
+                logger.warning(
+                    "Couldn't resolve %s, serving stale endpoints",
+                    self.service, exc_info=True,
+                )
+            else:
+                endpoints = self._store(endpoints, ttl)
+        if self.refresh and self._refresher is None:
+            self.start_refresh()
+        return endpoints
+
+    def _refreshing(self):
+        refresher = self._refresher
+        if isinstance(refresher, asyncio.Future):
+            return not refresher.done()
+        return super(AsyncConsulService, self)._refreshing()
+
+    def start_refresh(self, ahead=0.25, retry_interval=1):
+        """
+        Start an asyncio task that re-resolves the endpoints before they
+        expire. Must be called with a running event loop. Endpoints resolved
+        through the health API are kept fresh by a HealthWatcher thread.
+        """
+        if self.health is not None:
+            return super(AsyncConsulService, self).start_refresh()
+        self.refresh = True
+        with self._refresher_lock:
+            if self._refresher is None or self._refresher.done():
+                self._refresher = asyncio.ensure_future(
+                    self._refresh_loop(ahead, retry_interval)
+                )
+
+    def stop_refresh(self):
+        if self.health is not None:
+            return super(AsyncConsulService, self).stop_refresh()
+        self.refresh = False
+        with self._refresher_lock:
+            if self._refresher is not None:
+                self._refresher.cancel()
+                self._refresher = None
+
+    async def _refresh_loop(self, ahead, retry_interval):
+        await asyncio.sleep(self.cache.remaining() * (1 - ahead))
+        while True:
+            try:
+                ttl = await self._refresh_async()
+            except RESOLVE_ERRORS:
+                logger.warning(
+                    "Couldn't refresh endpoints of %s, serving stale ones",
+                    self.service, exc_info=True,
+                )
+                wait = retry_interval
+            else:
+                wait = ttl * (1 - ahead)
+            await asyncio.sleep(wait)
+
+    async def _begin_request_async(self, endpoints):
+        """
+        _begin_request that waits for the rate limits with asyncio.sleep,
+        so the event loop keeps running while requests are queued
+        """
+        if self.rate_limit is None:
+            return self._begin_request(endpoints)
+        deadline = monotonic() + self.rate_limit.timeout
+        while True:
+            try:
+                return self._begin_request(endpoints, timeout=0)
+            except RateLimitExceeded as e:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise
+                await asyncio.sleep(min(e.retry_after, remaining))
+
+    @async_retry_connections()
+    async def request(self, method, endpoint, **kwargs):
+        """
+        Proxy to aiohttp.ClientSession.request. The response body is read
+        before returning, so the connection goes back to the pool.
+
+        :param method: str formatted http method
+        :param endpoint: service endpoint
+        :param kwargs: kwargs passed directly to aiohttp
+        :return: aiohttp.ClientResponse
+        """
+        if aiohttp is not None:
+            kwargs.setdefault(
+                'timeout', aiohttp.ClientTimeout(total=30, sock_connect=1)
+            )
+        endpoints = await self.get_endpoints()
+        target, breaker, start = await self._begin_request_async(endpoints)
+        try:
+            async with self.client.request(
+                method, urljoin(target.url, endpoint), **kwargs
+            ) as response:
+                await response.read()
+        except asyncio.CancelledError:
+            self.balancer.on_finish(target, monotonic() - start, failed=True)
+            breaker.release()
+            if self.rate_limit is not None:
+                self.rate_limit.release(target.url)
+            raise
+        except Exception as e:
+            self._fail_request(
+                target, breaker, start,
+                aiohttp is not None and
+                isinstance(e, aiohttp.ClientConnectionError),
+            )
+            raise
+        self._finish_request(target, breaker, start, response.status)
+        return response
+
+    async def get(self, endpoint, **kwargs):
+        return await self.request('GET', endpoint, **kwargs)
+
+    async def post(self, endpoint, **kwargs):
+        return await self.request('POST', endpoint, **kwargs)
+
+    async def delete(self, endpoint, **kwargs):
+        return await self.request('DELETE', endpoint, **kwargs)
+
+    async def put(self, endpoint, **kwargs):
+        return await self.request('PUT', endpoint, **kwargs)
+
+    async def options(self, endpoint, **kwargs):
+        return await self.request('OPTIONS', endpoint, **kwargs)
+
+    async def head(self, endpoint, **kwargs):
+        return await self.request('HEAD', endpoint, **kwargs)
+
+
+async def fetch_kv(consul, namespace):
+    """
+    Coroutine counterpart of Consul._fetch_kv
+
+    :return: tuple of (list of kv records, X-Consul-Index)
+    """
+    client = getattr(consul, '_aio_client', None)
+    if client is None or client.closed:
+        client = consul._aio_client = client_session()
+    hooks = consul.instrumentation
+    start = monotonic() if hooks.enabled else None
+    with consul._agent_call() as agent:
+        async with client.get(
+            agent.base_uri + 'kv/' + namespace.lstrip('/'),
+            params={'recurse': ''},
+            timeout=aiohttp.ClientTimeout(total=30, sock_connect=1),
+        ) as r:
+            index = int(r.headers.get('X-Consul-Index', 0))
+            if r.status == 404:
+                return [], index
+            if r.status != 200:
+                raise ConsulConnectionError(
+                    'Unexpected response {} from consul kv'.format(r.status)
+                )
+            body = await r.read()
+            if start is not None:
+                labels = {'namespace': namespace}
+                hooks.observe('config_fetch_seconds', monotonic() - start, labels)
+                hooks.observe('config_fetch_bytes', len(body), labels)
+            return json.loads(body.decode('utf-8')), index
+
+
+async def apply_remote_config(consul, namespace, prune=False):
+    """
+    Coroutine counterpart of Consul.apply_remote_config, retried with the
+    retry policy of consul
+    """
+    require_aiohttp()
+    fetch = async_retry_connections()(fetch_kv)
+    records, _ = await fetch(
+        consul, namespace, retry_policy=consul.retry_policy.replace(
+            exceptions=ASYNC_RETRY_EXCEPTIONS,
+        ),
+    )
+    return consul._apply_records(
+        namespace, records, consul.kv_indexes.setdefault(namespace, {}),
+        prune=prune,
+    )
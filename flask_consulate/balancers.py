@@ -0,0 +1,183 @@
+# coding: utf-8
+
+import bisect
+import random
+import threading
+import itertools
+
+
+class Balancer(object):
+    """
+    Base class for the strategies ConsulService uses to choose one of the
+    resolved endpoints for a request.
+
+    Endpoints are flask_consulate.endpoints.Endpoint records. Subclasses
+    implement select(); on_start() and on_finish() are called around every
+    request so that strategies can keep statistics on the endpoints.
+
+    ConsulService passes the same tuple of endpoints until its answer
+    changes, so strategies may precompute what they need per tuple.
+    """
+
+    def select(self, endpoints):
+        """
+        :param endpoints: non-empty list of endpoints
+        :return: the endpoint to send the next request to
+        """
+        raise NotImplementedError
+
+    def on_start(self, endpoint):
+        """
+        Called when a request to endpoint is started
+        """
+        pass
+
+    def on_finish(self, endpoint, elapsed, failed=False):
+        """
+        Called when a request to endpoint has finished
+
+        :param elapsed: duration of the request in seconds
+        :param failed: whether the request failed with a connection error
+        """
+        pass
+
+
+class RoundRobin(Balancer):
+    """
+    Hands out the endpoints in turn
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def select(self, endpoints):
+        with self._lock:
+            n = next(self._counter)
+        return endpoints[n % len(endpoints)]
+
+
+class WeightedRandom(Balancer):
+    """
+    Follows the SRV record semantics (RFC 2782): only endpoints of the
+    lowest priority value are used, and they are chosen at random in
+    proportion to their weight.
+    """
+
+    def __init__(self):
+        # (endpoints, candidates, cumulative weights) of the last tuple
+        self._table = None
+
+    def _prepare(self, endpoints):
+        table = self._table
+        if table is None or table[0] is not endpoints:
+            priority = min(e.priority for e in endpoints)
+            candidates = tuple(e for e in endpoints if e.priority == priority)
+            cumulative, total = [], 0
+            for endpoint in candidates:
+                total += endpoint.weight
+                cumulative.append(total)
+            table = self._table = (endpoints, candidates, tuple(cumulative))
+        return table
+
+    def select(self, endpoints):
+        _, candidates, cumulative = self._prepare(endpoints)
+        total = cumulative[-1]
+        if total <= 0:
+            return random.choice(candidates)
+        point = random.uniform(0, total)
+        i = bisect.bisect_left(cumulative, point)
+        return candidates[min(i, len(candidates) - 1)]
+
+
+class LeastOutstanding(Balancer):
+    """
+    Chooses the endpoint with the fewest requests in flight, breaking ties
+    at random
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def select(self, endpoints):
+        best, ties = None, 0
+        for endpoint in endpoints:
+            if best is None or endpoint.outstanding < best.outstanding:
+                best, ties = endpoint, 1
+            elif endpoint.outstanding == best.outstanding:
+                # keep each of the tied endpoints with equal probability
+                ties += 1
+                if random.randrange(ties) == 0:
+                    best = endpoint
+        return best
+
+    def on_start(self, endpoint):
+        with self._lock:
+            endpoint.outstanding += 1
+
+    def on_finish(self, endpoint, elapsed, failed=False):
+        with self._lock:
+            endpoint.outstanding = max(endpoint.outstanding - 1, 0)
+
+
+class PowerOfTwoChoices(LeastOutstanding):
+    """
+    Picks two endpoints at random and uses the one with the lower expected
+    cost, which is its moving average latency scaled by the number of
+    requests in flight. Endpoints without observations are preferred so
+    that every endpoint gets measured.
+    """
+
+    def __init__(self, decay=0.3):
+        """
+        :param decay: weight of the newest observation in the exponentially
+            weighted moving average of the latency
+        """
+        super(PowerOfTwoChoices, self).__init__()
+        self.decay = decay
+
+    @staticmethod
+    def _cost(endpoint):
+        return (endpoint.latency or 0) * (endpoint.outstanding + 1)
+
+    def select(self, endpoints):
+        n = len(endpoints)
+        if n == 1:
+            return endpoints[0]
+        i = random.randrange(n)
+        j = random.randrange(n - 1)
+        a, b = endpoints[i], endpoints[j + 1 if j >= i else j]
+        return a if self._cost(a) <= self._cost(b) else b
+
+    def on_finish(self, endpoint, elapsed, failed=False):
+        super(PowerOfTwoChoices, self).on_finish(endpoint, elapsed, failed)
+        if failed:
+            return
+        with self._lock:
+            previous = endpoint.latency
+            if previous is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency = \
+                    self.decay * elapsed + (1 - self.decay) * previous
+
+
+BALANCERS = {
+    'round_robin': RoundRobin,
+    'weighted_random': WeightedRandom,
+    'least_outstanding': LeastOutstanding,
+    'power_of_two': PowerOfTwoChoices,
+}
+
+
+def get_balancer(balancer):
+    """
+    :param balancer: Balancer instance, or the name of one of BALANCERS
+    :return: Balancer instance
+    """
+    if isinstance(balancer, Balancer):
+        return balancer
+    try:
+        return BALANCERS[balancer]()
+    except KeyError:
+        raise ValueError('Unknown balancer {!r}'.format(balancer))
@@ -0,0 +1,183 @@
+# coding: utf-8
+
+import threading
+
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the failure rate of calls to a single consul agent or service
+    endpoint.
+
+    While closed, calls go through and their outcome is counted over a
+    window of `window` seconds. Once at least `min_calls` were made and the
+    share of failures reaches `failure_rate`, the breaker opens and calls
+    are rejected without trying. After `reset_timeout` seconds the breaker
+    is half-open and lets `probes` calls through; a successful probe
+    closes it again, a failed one re-opens it.
+    """
+
+    def __init__(self, failure_rate=0.5, min_calls=5, window=30,
+                 reset_timeout=10, probes=1, listener=None):
+        """
+        :param failure_rate: share of failed calls that opens the breaker
+        :param min_calls: minimum number of calls in the window before the
+            breaker may open
+        :param window: length in seconds of the window calls are counted in
+        :param reset_timeout: seconds an open breaker waits before probing
+        :param probes: number of concurrent calls allowed while half-open
+        :param listener: called with 1 when the breaker opens after being
+            closed, and with -1 when it closes again
+        """
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.listener = listener
+        self.opened = 0
+        self._state = CLOSED
+        self._opened_at = None
+        self._window_start = monotonic()
+        self._successes = 0
+        self._failures = 0
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._state == OPEN and \
+                monotonic() - self._opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return self._state
+
+    def available(self):
+        """
+        :return: whether a call would currently be let through, without
+            claiming a half-open probe
+        """
+        state = self.state
+        return state == CLOSED or \
+            (state == HALF_OPEN and self._probing < self.probes)
+
+    def allow(self):
+        """
+        :return: whether a call may be made now. While half-open, this
+            claims one of the probes, to be released by record_success()
+            or record_failure().
+        """
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and self._probing < self.probes:
+                self._state = HALF_OPEN
+                self._probing += 1
+                return True
+            return False
+
+    def release(self):
+        """
+        Give back a probe claimed by allow() for a call that was abandoned
+        without an outcome
+        """
+        with self._lock:
+            if self._state == HALF_OPEN and self._probing > 0:
+                self._probing -= 1
+
+    def _roll_window(self):
+        now = monotonic()
+        if now - self._window_start >= self.window:
+            self._window_start = now
+            self._successes = self._failures = 0
+
+    def record_success(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._state = CLOSED
+                self._probing = 0
+                if self.listener is not None:
+                    self.listener(-1)
+                self._window_start = monotonic()
+                self._successes = self._failures = 0
+            self._roll_window()
+            self._successes += 1
+
+    def record_failure(self):
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._trip()
+                return
+            self._roll_window()
+            self._failures += 1
+            calls = self._successes + self._failures
+            if self._state == CLOSED and calls >= self.min_calls and \
+                    self._failures >= self.failure_rate * calls:
+                self._trip()
+
+    def _trip(self):
+        if self._state == CLOSED and self.listener is not None:
+            self.listener(1)
+        self._state = OPEN
+        self._opened_at = monotonic()
+        self._probing = 0
+        self.opened += 1
+
+    def snapshot(self):
+        """
+        :return: dict describing the breaker, for monitoring
+        """
+        return {
+            'state': self.state,
+            'successes': self._successes,
+            'failures': self._failures,
+            'opened': self.opened,
+        }
+
+
+class BreakerRegistry(object):
+    """
+    Holds one CircuitBreaker per key, e.g. per endpoint URL
+    """
+
+    def __init__(self, **kwargs):
+        """
+        :param kwargs: arguments for every CircuitBreaker created
+        """
+        self.kwargs = kwargs
+        self.breakers = {}
+        # number of breakers that aren't closed, so callers can skip
+        # checking every breaker while all of them are
+        self.unclosed = 0
+        self._lock = threading.Lock()
+        self._count_lock = threading.Lock()
+
+    def _count(self, delta):
+        with self._count_lock:
+            self.unclosed += delta
+
+    def get(self, key):
+        """
+        :return: the CircuitBreaker of key, created on first use
+        """
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.setdefault(
+                    key, CircuitBreaker(listener=self._count, **self.kwargs)
+                )
+        return breaker
+
+    def snapshot(self):
+        """
+        :return: dict of key to the snapshot of its breaker, for monitoring
+        """
+        return dict((k, b.snapshot()) for k, b in list(self.breakers.items()))
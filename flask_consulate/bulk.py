@@ -0,0 +1,193 @@
+# coding: utf-8
+"""
+Walking, exporting and importing large kv namespaces in bounded memory.
+
+Consul's kv API can't page through a recursive listing, so the namespace is
+walked one directory level at a time with ?keys&separator=, and the values
+are fetched in transactions of up to page_size gets. Only one listing and
+one page of values are held at a time, however many keys the namespace has;
+a directory with many keys directly under it is still listed at once, but
+without its values.
+"""
+
+import json
+import base64
+
+from flask_consulate.exceptions import ConsulConnectionError
+
+# consul rejects transactions with more operations
+TXN_MAX_OPS = 64
+
+
+def _list_keys(consul, prefix, separator):
+    """
+    :return: sorted list of the keys directly under prefix, and of the
+        prefixes of the directories below it, ending in separator
+    """
+    with consul._agent_call() as agent:
+        r = agent.http.get(
+            agent.base_uri + 'kv/' + prefix,
+            params={'keys': '', 'separator': separator},
+            timeout=(1, 30),
+        )
+        if r.status_code == 404:
+            return []
+        if r.status_code != 200:
+            raise ConsulConnectionError(
+                'Unexpected response {} from consul kv'.format(r.status_code)
+            )
+        return r.json()
+
+
+def _get_page(consul, keys):
+    """
+    Fetch the records of keys in one transaction, skipping the keys deleted
+    since they were listed
+
+    :return: list of raw kv records
+    """
+    while keys:
+        ops = [{'KV': {'Verb': 'get', 'Key': key}} for key in keys]
+        with consul._agent_call() as agent:
+            r = agent.http.put(agent.base_uri + 'txn', json=ops, timeout=(1, 30))
+            if r.status_code in (404, 405):
+                # consul < 0.7 has no transactions
+                return _get_each(agent, keys)
+            if r.status_code == 200:
+                return [result['KV'] for result in r.json().get('Results') or []]
+            if r.status_code != 409:
+                raise ConsulConnectionError(
+                    'Unexpected response {} from consul txn: {}'.format(r.status_code, r.text)
+                )
+        gone = set(e['OpIndex'] for e in r.json().get('Errors') or [])
+        if not gone:
+            raise ConsulConnectionError(
+                'Consul txn failed: {}'.format(r.text)
+            )
+        keys = [key for i, key in enumerate(keys) if i not in gone]
+    return []
+
+
+def _get_each(agent, keys):
+    records = []
+    for key in keys:
+        r = agent.http.get(agent.base_uri + 'kv/' + key, timeout=(1, 30))
+        if r.status_code == 404:
+            continue
+        if r.status_code != 200:
+            raise ConsulConnectionError(
+                'Unexpected response {} from consul kv'.format(r.status_code)
+            )
+        records.extend(r.json())
+    return records
+
+
+def iter_kv(consul, namespace, page_size=TXN_MAX_OPS, separator='/'):
+    """
+    Walk a kv namespace in pages, in key order
+
+    The walk isn't a consistent snapshot: keys written while it runs may or
+    may not be seen. Errors are raised as they happen; callers retry the
+    whole walk.
+
+    :param consul: flask_consulate.Consul instance
+    :param namespace: kv namespace/directory
+    :param page_size: number of values fetched per transaction, at most
+        TXN_MAX_OPS
+    :param separator: separator of the directory levels listed one at a time
+    :return: generator of raw kv records
+    """
+    page_size = max(1, min(page_size, TXN_MAX_OPS))
+    prefix = namespace.lstrip('/')
+    page = []
+    for key in _list_keys(consul, prefix, separator):
+        if key != prefix and key.endswith(separator):
+            for record in _get_page(consul, page):
+                yield record
+            page = []
+            for record in iter_kv(consul, key, page_size, separator):
+                yield record
+            continue
+        page.append(key)
+        if len(page) >= page_size:
+            for record in _get_page(consul, page):
+                yield record
+            page = []
+    for record in _get_page(consul, page):
+        yield record
+
+
+def export_kv(consul, namespace, fileobj, page_size=TXN_MAX_OPS):
+    """
+    Write the keys under namespace to fileobj, one JSON object per line in
+    the format of the entries of `consul kv export`; the values are base64
+    encoded. `jq -c '.[]'` turns the output of `consul kv export` into this
+    format, and `jq -s .` back.
+
+    :param consul: flask_consulate.Consul instance
+    :param namespace: kv namespace/directory
+    :param fileobj: text file to write to
+    :return: number of keys written
+    """
+    count = 0
+    for record in iter_kv(consul, namespace, page_size):
+        fileobj.write(json.dumps({
+            'key': record['Key'],
+            'flags': record.get('Flags') or 0,
+            'value': record.get('Value') or '',
+        }, sort_keys=True))
+        fileobj.write('\n')
+        count += 1
+    return count
+
+
+def _set_page(consul, entries):
+    ops = [{'KV': {
+        'Verb': 'set', 'Key': entry['key'], 'Flags': entry.get('flags') or 0,
+        'Value': entry.get('value') or '',
+    }} for entry in entries]
+    with consul._agent_call() as agent:
+        r = agent.http.put(agent.base_uri + 'txn', json=ops, timeout=(1, 30))
+        if r.status_code in (404, 405):
+            # consul < 0.7 has no transactions
+            for entry in entries:
+                r = agent.http.put(
+                    agent.base_uri + 'kv/' + entry['key'],
+                    params={'flags': entry.get('flags') or 0},
+                    data=base64.b64decode(entry.get('value') or ''),
+                    timeout=(1, 30),
+                )
+                if r.status_code != 200:
+                    break
+        if r.status_code != 200:
+            raise ConsulConnectionError(
+                'Unexpected response {} from consul kv: {}'.format(r.status_code, r.text)
+            )
+
+
+def import_kv(consul, fileobj, page_size=TXN_MAX_OPS):
+    """
+    Write the keys read from fileobj, in the format export_kv writes, to
+    consul in transactions of page_size keys. An import that failed half
+    way can be run again.
+
+    :param consul: flask_consulate.Consul instance
+    :param fileobj: text file to read from
+    :return: number of keys written
+    """
+    page_size = max(1, min(page_size, TXN_MAX_OPS))
+    count = 0
+    page = []
+    for line in fileobj:
+        line = line.strip()
+        if not line:
+            continue
+        page.append(json.loads(line))
+        if len(page) >= page_size:
+            _set_page(consul, page)
+            count += len(page)
+            page = []
+    if page:
+        _set_page(consul, page)
+        count += len(page)
+    return count
@@ -0,0 +1,178 @@
+# coding: utf-8
+
+import json
+import logging
+
+from flask import Config
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+try:
+    import yaml
+except ImportError:  # optional dependency
+    yaml = None
+
+logger = logging.getLogger(__name__)
+
+TRUE_VALUES = frozenset(['1', 'true', 'yes', 'on'])
+FALSE_VALUES = frozenset(['0', 'false', 'no', 'off', ''])
+
+
+def decode_raw(value):
+    return value
+
+
+def decode_text(value):
+    return value.decode('utf-8')
+
+
+def decode_json(value):
+    return json.loads(value.decode('utf-8'))
+
+
+def decode_int(value):
+    return int(value.decode('utf-8').strip())
+
+
+def decode_bool(value):
+    text = value.decode('utf-8').strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError('Not a boolean: {!r}'.format(text))
+
+
+def decode_msgpack(value):
+    if msgpack is None:
+        raise RuntimeError('msgpack is required for the msgpack codec')
+    return msgpack.unpackb(value, raw=False)
+
+
+def decode_yaml(value):
+    if yaml is None:
+        raise RuntimeError('PyYAML is required for the yaml codec')
+    return yaml.safe_load(value)
+
+
+def decode_guess(value):
+    """
+    Decode json, falling back to the utf-8 text, or the raw bytes if the
+    value isn't text. Used for keys without a codec.
+    """
+    try:
+        value = value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        logger.warning("Couldn't de-serialize %r to json, using raw value", value)
+        return value
+
+
+CODECS = {
+    'raw': decode_raw,
+    'text': decode_text,
+    'json': decode_json,
+    'int': decode_int,
+    'bool': decode_bool,
+    'msgpack': decode_msgpack,
+    'yaml': decode_yaml,
+}
+
+
+def get_codec(codec):
+    """
+    :param codec: name of one of CODECS, a callable taking the raw bytes of
+        a kv value, or None for decode_guess
+    :return: callable
+    """
+    if codec is None:
+        return decode_guess
+    if callable(codec):
+        return codec
+    try:
+        return CODECS[codec]
+    except KeyError:
+        raise ValueError('Unknown codec {!r}, expected one of {}'.format(
+            codec, ', '.join(sorted(CODECS))
+        ))
+
+
+class LazyValue(object):
+    """
+    Raw bytes of a kv value that are only decoded once the config key is
+    read from a LazyConfig
+    """
+
+    __slots__ = ('raw', 'codec')
+
+    def __init__(self, raw, codec):
+        """
+        :param raw: bytes of the kv value
+        :param codec: callable decoding raw
+        """
+        self.raw = raw
+        self.codec = codec
+
+    def __getstate__(self):
+        return self.raw, self.codec
+
+    def __setstate__(self, state):
+        self.raw, self.codec = state
+
+    def decode(self):
+        return self.codec(self.raw)
+
+    def __repr__(self):
+        return '<LazyValue {} bytes>'.format(len(self.raw))
+
+
+class LazyConfig(Config):
+    """
+    flask.Config that decodes LazyValues on first access and keeps the
+    decoded value in their place
+    """
+
+    def _resolve(self, key, value):
+        if isinstance(value, LazyValue):
+            value = value.decode()
+            # another thread may have replaced the value in the meantime
+            if isinstance(Config.get(self, key), LazyValue):
+                Config.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        return self._resolve(key, Config.__getitem__(self, key))
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+
+    def pop(self, key, *default):
+        value = Config.pop(self, key, *default)
+        if isinstance(value, LazyValue):
+            return value.decode()
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            Config.__setitem__(self, key, default)
+        return self[key]
+
+    def values(self):
+        return [self[k] for k in list(self.keys())]
+
+    def items(self):
+        return [(k, self[k]) for k in list(self.keys())]
+
+    def raw(self, key):
+        """
+        :return: the value of key without decoding it
+        """
+        return Config.__getitem__(self, key)
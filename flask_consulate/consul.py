@@ -1,13 +1,58 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
+import time
+import base64
+import random
+import threading
 
-import consulate
+from concurrent.futures import ThreadPoolExecutor
 
-from six import iteritems
+from six import iteritems, string_types
 
-from flask_consulate.decorators import with_retry_connections
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+from flask_consulate.agents import AgentPool, parse_agents
+from flask_consulate.breaker import BreakerRegistry
+from flask_consulate.bulk import iter_kv, export_kv, import_kv, TXN_MAX_OPS
+from flask_consulate.codecs import LazyConfig, LazyValue, get_codec
+from flask_consulate.decorators import with_retry_connections, \
+    get_retry_policy, RetryPolicy
+from flask_consulate.exceptions import ConsulConnectionError
+from flask_consulate.instrumentation import get_instrumentation
+from flask_consulate.locks import Lock, Semaphore
+from flask_consulate.registration import RegistrationManager
+from flask_consulate.shared import SharedConfig
+from flask_consulate.snapshot import ConfigSnapshot
+from flask_consulate.watch import KVWatcher
+
+
+class ConfigDiff(object):
+    """
+    The changes a pass over consul's kv store made to app.config
+    """
+
+    def __init__(self, added=None, changed=None, removed=None):
+        """
+        :param added: dict of keys that were not set by consul before
+        :param changed: dict of keys whose value changed in consul
+        :param removed: set of keys that disappeared from consul
+        """
+        self.added = added if added is not None else {}
+        self.changed = changed if changed is not None else {}
+        self.removed = removed if removed is not None else set()
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '<ConfigDiff added={!r} changed={!r} removed={!r}>'.format(
+            sorted(self.added), sorted(self.changed), sorted(self.removed),
+        )
 
 
 class Consul(object):
@@ -23,24 +68,74 @@ class Consul(object):
         :param app: flask.Flask application instance
         :param kwargs:
             consul_host: host to connect to, falling back to environmental
-                        variable $CONSUL_HOST, then 'localhost'
+                        variable $CONSUL_HOST, then 'localhost'. A list, or
+                        comma-separated string, of hosts (optionally as
+                        host:port) gives agents to fail over to, the local
+                        agent first.
             consul_port: port, falling back to $CONSUL_PORT, then 8500
+            agent_failover_cooldown: seconds an agent is avoided for after
+                        a failed call
             healthcheck: healthcheck that will be registered
             max_tries: integer number of attempts to make to connect to
                         consul_host. Useful if the host is an alias for
                         the consul cluster
+            retry_policy: RetryPolicy, or dict of RetryPolicy arguments, for
+                        the calls to consul; e.g. {'deadline': 5}
+            circuit_breaker: dict of CircuitBreaker arguments for the
+                        breaker kept per consul agent
+            snapshot_path: file to keep a copy of the remote config in,
+                        falling back to $CONSUL_SNAPSHOT. A '{namespace}'
+                        placeholder is replaced by the kv namespace, which
+                        allows snapshots of several namespaces.
+            snapshot_max_age: maximum age in seconds of a snapshot that may
+                        be loaded
+            codecs: dict of config key to the codec of its kv value: one of
+                        'json', 'msgpack', 'yaml', 'int', 'bool', 'text' and
+                        'raw', or a callable taking the raw bytes. Keys
+                        without a codec are decoded as json, falling back to
+                        the raw value.
+            lazy_config: store kv values undecoded and decode each on its
+                        first access; replaces app.config with a LazyConfig
+            instrumentation: Instrumentation receiving the config fetch
+                        and retry metrics
         :return: None
         """
         self.kwargs = kwargs if kwargs else {}
         self.app = None
 
-        self.host = self.kwargs.get('consul_host') or \
-            os.environ.get('CONSUL_HOST', 'localhost')
-        self.port = self.kwargs.get('consul_port') or \
+        hosts = self.kwargs.get('consul_host') or \
+            os.environ.get('CONSUL_HOST') or 'localhost'
+        port = self.kwargs.get('consul_port') or \
             os.environ.get('CONSUL_PORT', 8500)
         self.max_tries = self.kwargs.get('max_tries', 3)
+        self.retry_policy = get_retry_policy(
+            self.kwargs.get('retry_policy'),
+            RetryPolicy(max_tries=self.max_tries),
+        )
+        self.breakers = BreakerRegistry(
+            **self.kwargs.get('circuit_breaker', {})
+        )
+        self.agents = AgentPool(
+            parse_agents(hosts, port), self.breakers,
+            failover_cooldown=self.kwargs.get('agent_failover_cooldown', 10),
+        )
+        self.host, self.port = self.agents.primary.host, self.agents.primary.port
+        self.snapshot_path = self.kwargs.get('snapshot_path') or \
+            os.environ.get('CONSUL_SNAPSHOT')
+        self.snapshot_max_age = self.kwargs.get('snapshot_max_age')
+        self.codecs = dict(
+            (k, get_codec(codec))
+            for k, codec in iteritems(self.kwargs.get('codecs') or {})
+        )
+        self.lazy_config = self.kwargs.get('lazy_config', False)
+        self.instrumentation = get_instrumentation(
+            self.kwargs.get('instrumentation')
+        )
 
-        self.session = None
+        # namespace -> {key: ModifyIndex} of the kv values applied to app.config
+        self.kv_indexes = {}
+        # namespace -> X-Consul-Index of the last snapshot written or loaded
+        self.snapshot_indexes = {}
 
         if app is not None:
             self.init_app(app)
@@ -54,54 +149,551 @@ class Consul(object):
             raise RuntimeError('Flask application already initialized')
         app.extensions['consul'] = self
 
-        self.session = self._create_session(
+        if self.lazy_config and not isinstance(app.config, LazyConfig):
+            app.config = LazyConfig(app.config.root_path, app.config)
+
+        self._create_session(
             test_connection=self.kwargs.get('test_connection', False),
         )
 
+    @property
+    def session(self):
+        """
+        consulate.Session of the first agent, re-created in a process forked
+        after it was created
+        """
+        return self.agents.primary.session
+
+    @session.setter
+    def session(self, session):
+        self.agents.primary.session = session
+
+    @property
+    def http(self):
+        """
+        requests.Session to the first agent for the parts of the consul HTTP
+        API that consulate doesn't expose, re-created in a forked process
+        """
+        return self.agents.primary.http
+
     @with_retry_connections()
     def _create_session(self, test_connection=False):
         """
-        Create a consulate.session object, and query for its leader to ensure
-        that the connection is made.
+        Create the consulate.session object of an agent, and query for its
+        leader to ensure that the connection is made.
 
         :param test_connection: call .leader() to ensure that the connection
             is valid
         :type test_connection: bool
         :return consulate.Session instance
         """
-        session = consulate.Session(host=self.host, port=self.port)
-        if test_connection:
-            session.status.leader()
-        return session
+        if not test_connection:
+            return self.agents.choose().session
+        with self._agent_call() as agent:
+            agent.session.status.leader()
+        return agent.session
+
+    @property
+    def agent(self):
+        """
+        host:port of the first consul agent
+        """
+        return self.agents.primary.address
+
+    def _agent_call(self, agent=None, timed=True):
+        """
+        Guard a call to a consul agent with its circuit breaker: fail fast
+        while the breaker is open, and record the outcome of the call.
+        Calls go to the fastest healthy agent, and fail over to the others;
+        see AgentPool.
+
+        :param agent: Agent to call, instead of the one chosen
+        :param timed: count the duration of the call towards the agent's
+            latency; not for blocking queries
+        :return: context manager yielding the Agent to call
+        """
+        return self.agents.call(agent, timed=timed)
+
+    @property
+    def base_uri(self):
+        return self.agents.primary.base_uri
+
+    @staticmethod
+    def _default_namespace():
+        return "config/{service}/{environment}/".format(
+            service=os.environ.get('SERVICE', 'generic_service'),
+            environment=os.environ.get('ENVIRONMENT', 'generic_environment')
+        )
+
+    def _fetch_kv(self, namespace, index=None, wait=None, recurse=True):
+        """
+        Fetch the raw kv records under namespace, optionally as a blocking
+        query that only returns once the namespace changed past index or
+        wait seconds passed.
+
+        :param namespace: kv namespace/directory
+        :param index: X-Consul-Index of the previous response
+        :param wait: maximum number of seconds to block for
+        :param recurse: fetch the keys under namespace, rather than the
+            single key namespace
+        :return: tuple of (list of kv records, X-Consul-Index)
+        """
+        params = {'recurse': ''} if recurse else {}
+        timeout = (1, 30)
+        if index:
+            params['index'] = index
+            if wait is not None:
+                params['wait'] = '{}s'.format(wait)
+                # consul adds up to wait/16 of jitter to blocking queries
+                timeout = (1, wait + wait / 16.0 + 5)
+        # blocking queries mostly measure how long the namespace didn't change
+        start = monotonic() if self.instrumentation.enabled and \
+            'wait' not in params else None
+        with self._agent_call(timed='wait' not in params) as agent:
+            r = agent.http.get(
+                agent.base_uri + 'kv/' + namespace.lstrip('/'),
+                params=params,
+                timeout=timeout,
+            )
+            if start is not None:
+                self._observe_fetch(namespace, start, r)
+            index = int(r.headers.get('X-Consul-Index', 0))
+            if r.status_code == 404:
+                return [], index
+            if r.status_code != 200:
+                raise ConsulConnectionError(
+                    'Unexpected response {} from consul kv'.format(r.status_code)
+                )
+            return r.json(), index
+
+    def _observe_fetch(self, namespace, start, response):
+        labels = {'namespace': namespace}
+        self.instrumentation.observe(
+            'config_fetch_seconds', monotonic() - start, labels,
+        )
+        self.instrumentation.observe(
+            'config_fetch_bytes', len(response.content), labels,
+        )
+
+    def _fetch_kv_layers(self, namespaces):
+        """
+        Fetch the raw kv records under several namespaces in a single
+        transaction, or in parallel if the agent doesn't support
+        transactions.
+
+        :param namespaces: list of kv namespaces/directories
+        :return: list of kv records
+        """
+        ops = [
+            {'KV': {'Verb': 'get-tree', 'Key': ns.lstrip('/')}}
+            for ns in namespaces
+        ]
+        start = monotonic() if self.instrumentation.enabled else None
+        with self._agent_call() as agent:
+            r = agent.http.put(agent.base_uri + 'txn', json=ops, timeout=(1, 30))
+            if start is not None:
+                self._observe_fetch(','.join(namespaces), start, r)
+            if r.status_code == 200:
+                return [
+                    result['KV'] for result in r.json().get('Results') or []
+                ]
+            if r.status_code not in (404, 405):
+                raise ConsulConnectionError(
+                    'Unexpected response {} from consul txn: {}'.format(r.status_code, r.text)
+                )
+
+        # consul < 0.7 has no transactions
+        pool = ThreadPoolExecutor(max_workers=len(namespaces))
+        try:
+            return [
+                record
+                for records, _ in pool.map(self._fetch_kv, namespaces)
+                for record in records
+            ]
+        finally:
+            pool.shutdown(wait=False)
+
+    def _decode(self, value, key=None):
+        """
+        De-serialize a base64 encoded kv value with the codec of key
+
+        :return: the decoded value, or a LazyValue with lazy_config
+        """
+        if value is None:
+            return None
+        codec = self.codecs.get(key) or get_codec(None)
+        value = base64.b64decode(value)
+        if self.lazy_config:
+            return LazyValue(value, codec)
+        return codec(value)
+
+    @staticmethod
+    def _merge_records(namespaces, records):
+        """
+        Map the kv records to config keys relative to their namespace. A key
+        in a later namespace overrides the same key in an earlier one.
+
+        :param namespaces: list of kv namespaces/directories, lowest
+            precedence first
+        :param records: list of raw kv records
+        :return: dict of config key to (position of its namespace, record)
+        """
+        prefixes = [ns.lstrip('/') for ns in namespaces]
+        merged = {}
+        for record in records:
+            key = record['Key']
+            for i, prefix in enumerate(prefixes):
+                if not key.startswith(prefix):
+                    continue
+                k = key[len(prefix):]
+                if not k or k.endswith('/'):
+                    continue
+                if k not in merged or merged[k][0] < i:
+                    merged[k] = (i, record)
+        return merged
+
+    @staticmethod
+    def _relative_records(namespace, records):
+        """
+        Map the kv records of a single namespace to config keys relative to
+        it, one at a time
+
+        :return: generator of (config key, (0, record))
+        """
+        prefix = namespace.lstrip('/')
+        for record in records:
+            k = record['Key'][len(prefix):]
+            if k and not k.endswith('/'):
+                yield k, (0, record)
+
+    def _apply_records(self, namespace, records, indexes, prune=False,
+                       strict=True):
+        """
+        Apply the kv records whose ModifyIndex differs from the one recorded
+        in indexes to self.app.config, leaving unchanged keys untouched.
+
+        :param namespace: kv namespace/directory the records were fetched
+            from, or a list of them with the highest precedence last
+        :param records: iterable of raw kv records, consumed once
+        :param indexes: dict of key to the ModifyIndex last applied, which is
+            updated in place
+        :param prune: remove keys that disappeared from the records from
+            self.app.config
+        :param strict: raise if a value can't be decoded; otherwise log it
+            and skip the key without recording its ModifyIndex, so it is
+            tried again next time
+        :return: ConfigDiff
+        """
+        layered = not isinstance(namespace, string_types)
+        if layered:
+            merged = iteritems(self._merge_records(namespace, records))
+        else:
+            merged = self._relative_records(namespace, records)
+        diff = ConfigDiff()
+        seen = set()
+        for k, (i, record) in merged:
+            seen.add(k)
+            # a key may move between namespaces without its ModifyIndex
+            # changing if both were written in one transaction
+            modify_index = (i, record['ModifyIndex']) if layered \
+                else record['ModifyIndex']
+            previous = indexes.get(k)
+            if previous == modify_index:
+                continue
+            try:
+                v = self._decode(record.get('Value'), k)
+            except Exception:
+                if strict:
+                    raise
+                self.app.logger.warning("Couldn't decode %s from consul kv %r, skipping it", k, namespace, exc_info=True)
+                continue
+            self.app.config[k] = v
+            indexes[k] = modify_index
+            if previous is None:
+                diff.added[k] = v
+            else:
+                diff.changed[k] = v
+            self.app.logger.debug("Set %s=%s from consul kv %r", k, v, namespace)
+        for k in set(indexes) - seen:
+            del indexes[k]
+            diff.removed.add(k)
+            if prune:
+                self.app.config.pop(k, None)
+                self.app.logger.debug("Removed %s, gone from consul kv %r", k, namespace)
+        return diff
+
+    def watch_remote_config(self, namespace=None, callback=None, wait=300,
+                            prune=False):
+        """
+        Keep self.app.config in sync with consul's kv store in a background
+        thread. The thread uses consul's blocking queries, so it only wakes
+        up when something under namespace changed, and only de-serializes
+        and applies the keys whose ModifyIndex changed.
+
+        :param namespace: kv namespace/directory. Defaults to
+                DEFAULT_KV_NAMESPACE
+        :param callback: called with a ConfigDiff after every change;
+                exceptions it raises are logged
+        :param wait: maximum number of seconds a blocking query may wait
+        :param prune: remove keys that disappeared from consul's kv store
+                from self.app.config
+        :return: the started KVWatcher; call .stop() to stop watching
+        """
+        if namespace is None:
+            namespace = self._default_namespace()
+        watcher = KVWatcher(
+            self, namespace, callback=callback, wait=wait, prune=prune,
+        )
+        watcher.start()
+        return watcher
+
+    def _snapshot(self, namespace):
+        """
+        :return: ConfigSnapshot of namespace, or None if snapshots are off
+        """
+        if not self.snapshot_path:
+            return None
+        return ConfigSnapshot(
+            self.snapshot_path.format(namespace=namespace.strip('/').replace('/', '_')),
+            max_age=self.snapshot_max_age,
+        )
 
     @with_retry_connections()
-    def apply_remote_config(self, namespace=None):
+    def apply_remote_config(self, namespace=None, prune=False, page_size=None,
+                            strict=True):
         """
         Applies all config values defined in consul's kv store to self.app.
 
+        Keys whose ModifyIndex did not change since the last call are not
+        de-serialized or re-applied. If a snapshot_path is configured, the
+        fetched values are written to it.
+
+        Config assembled from several layers, e.g. shared, per-service and
+        per-environment, can be fetched in one transaction by passing a list
+        of namespaces; keys in later namespaces override those in earlier
+        ones. Snapshots are only kept for single namespaces.
+
         There is no guarantee that these values will not be overwritten later
         elsewhere.
 
+        :param namespace: kv namespace/directory, or list of them with the
+                highest precedence last. Defaults to DEFAULT_KV_NAMESPACE
+        :param prune: remove keys that disappeared from consul's kv store
+                from self.app.config
+        :param page_size: walk a single namespace with iter_kv, fetching
+                page_size values at a time instead of all of them in one
+                response, for namespaces too large to hold twice in memory.
+                Snapshots aren't written for walked namespaces.
+        :param strict: raise if a value can't be decoded with its codec;
+                otherwise skip the key, with a warning
+        :return: ConfigDiff
+        """
+
+        if namespace is None:
+            namespace = self._default_namespace()
+
+        if page_size and isinstance(namespace, string_types):
+            return self._apply_records(
+                namespace, iter_kv(self, namespace, page_size),
+                self.kv_indexes.setdefault(namespace, {}), prune=prune,
+                strict=strict,
+            )
+
+        if not isinstance(namespace, string_types):
+            namespace = tuple(namespace)
+            return self._apply_records(
+                namespace, self._fetch_kv_layers(namespace),
+                self.kv_indexes.setdefault(namespace, {}), prune=prune,
+                strict=strict,
+            )
+
+        records, index = self._fetch_kv(namespace)
+        diff = self._apply_records(
+            namespace, records, self.kv_indexes.setdefault(namespace, {}),
+            prune=prune, strict=strict,
+        )
+        snapshot = self._snapshot(namespace)
+        if snapshot is not None and \
+                (diff or self.snapshot_indexes.get(namespace) != index):
+            try:
+                snapshot.write(namespace, index, records)
+                self.snapshot_indexes[namespace] = index
+            except (IOError, OSError):
+                self.app.logger.warning("Couldn't write config snapshot %r", snapshot.path, exc_info=True)
+        return diff
+
+    def iter_kv(self, namespace=None, page_size=TXN_MAX_OPS):
+        """
+        Walk a kv namespace in pages of page_size keys, holding one page in
+        memory at a time; see flask_consulate.bulk.iter_kv
+
         :param namespace: kv namespace/directory. Defaults to
                 DEFAULT_KV_NAMESPACE
-        :return: None
+        :return: generator of raw kv records, in key order
+        """
+        if namespace is None:
+            namespace = self._default_namespace()
+        return iter_kv(self, namespace, page_size)
+
+    def export_kv(self, fileobj, namespace=None, page_size=TXN_MAX_OPS):
         """
+        Write the keys under namespace to fileobj as JSON lines, in bounded
+        memory; see flask_consulate.bulk.export_kv
 
+        :param fileobj: text file to write to
+        :param namespace: kv namespace/directory. Defaults to
+                DEFAULT_KV_NAMESPACE
+        :return: number of keys written
+        """
         if namespace is None:
-            namespace = "config/{service}/{environment}/".format(
-                service=os.environ.get('SERVICE', 'generic_service'),
-                environment=os.environ.get('ENVIRONMENT', 'generic_environment')
-            )
+            namespace = self._default_namespace()
+        return export_kv(self, namespace, fileobj, page_size)
+
+    def import_kv(self, fileobj, page_size=TXN_MAX_OPS):
+        """
+        Write the keys exported by export_kv back to consul's kv store in
+        transactions of page_size keys; see flask_consulate.bulk.import_kv
+
+        :param fileobj: text file to read from
+        :return: number of keys written
+        """
+        return import_kv(self, fileobj, page_size)
+
+    def apply_remote_config_async(self, namespace=None, prune=False):
+        """
+        Coroutine counterpart of apply_remote_config, for use in an asyncio
+        event loop. Requires Python 3.5+ and aiohttp.
+
+        :param namespace: kv namespace/directory. Defaults to
+                DEFAULT_KV_NAMESPACE
+        :param prune: remove keys that disappeared from consul's kv store
+                from self.app.config
+        :return: awaitable ConfigDiff
+        """
+        from flask_consulate.aio import apply_remote_config
+
+        if namespace is None:
+            namespace = self._default_namespace()
+        return apply_remote_config(self, namespace, prune=prune)
+
+    def load_snapshot(self, namespace=None):
+        """
+        Applies the config values from the snapshot file to self.app.
+
+        :param namespace: kv namespace/directory. Defaults to
+                DEFAULT_KV_NAMESPACE
+        :return: ConfigDiff, or None if there is no usable snapshot
+        """
+        if namespace is None:
+            namespace = self._default_namespace()
+
+        snapshot = self._snapshot(namespace)
+        loaded = snapshot.read(namespace) if snapshot is not None else None
+        if loaded is None:
+            return None
+        records, index = loaded
+        self.snapshot_indexes[namespace] = index
+        self.app.logger.debug("Loaded config snapshot %r at index %s", snapshot.path, index)
+        return self._apply_records(
+            namespace, records, self.kv_indexes.setdefault(namespace, {}),
+        )
+
+    def bootstrap_remote_config(self, namespace=None, prune=False,
+                                background=False, splay=0):
+        """
+        Applies the config snapshot, if there is one, and then reconciles it
+        with consul's kv store. Only keys that changed since the snapshot
+        was written are re-applied.
 
-        for k, v in iteritems(self.session.kv.find(namespace)):
-            k = k.replace(namespace, '')
+        :param namespace: kv namespace/directory. Defaults to
+                DEFAULT_KV_NAMESPACE
+        :param prune: remove keys that disappeared from consul's kv store
+                from self.app.config
+        :param background: if a snapshot was loaded, reconcile with consul in
+                a background thread instead of waiting for it
+        :param splay: wait a random number of seconds up to splay before
+                reconciling in the background, so that workers restarted
+                together don't all query consul at once
+        :return: ConfigDiff of the snapshot, or of consul if there was no
+                snapshot
+        """
+        if namespace is None:
+            namespace = self._default_namespace()
+
+        diff = self.load_snapshot(namespace)
+        if diff is None:
+            return self.apply_remote_config(namespace, prune=prune)
+        if not background:
+            self.apply_remote_config(namespace, prune=prune)
+            return diff
+
+        def reconcile():
+            time.sleep(random.uniform(0, splay))
             try:
-                self.app.config[k] = json.loads(v)
-            except (TypeError, ValueError):
-                self.app.logger.warning("Couldn't de-serialize %r to json, using raw value", v)
-                self.app.config[k] = v
+                # a bad value must not keep the other keys from being applied
+                self.apply_remote_config(namespace, prune=prune, strict=False)
+            except ConsulConnectionError:
+                self.app.logger.warning("Couldn't reconcile config snapshot with consul", exc_info=True)
 
-            self.app.logger.debug("Set %s=%s from consul kv %r", k, v, namespace)
+        thread = threading.Thread(target=reconcile, name='consul-reconcile')
+        thread.daemon = True
+        thread.start()
+        return diff
+
+    def share_remote_config(self, path, namespace=None, max_age=60,
+                            prune=False):
+        """
+        Applies the remote config through a file shared by the workers of a
+        pre-fork server. The first worker (or the master, with preloading)
+        to get here fetches the config from consul and shares the parsed
+        values; the others attach to them without querying consul. The
+        shared config is re-fetched once it is older than max_age.
+
+        :param path: path of the shared file, on a local filesystem
+        :param namespace: kv namespace/directory. Defaults to
+                DEFAULT_KV_NAMESPACE
+        :param max_age: seconds a shared config may be used for
+        :param prune: remove keys that disappeared from consul's kv store
+                from self.app.config
+        :return: ConfigDiff
+        """
+        if namespace is None:
+            namespace = self._default_namespace()
+
+        fetched = []
+
+        def fetch():
+            fetched.append(self.apply_remote_config(namespace, prune=prune))
+            indexes = self.kv_indexes[namespace]
+            return {
+                'namespace': namespace,
+                'indexes': dict(indexes),
+                # share lazy values undecoded
+                'config': dict(
+                    (k, dict.__getitem__(self.app.config, k)) for k in indexes
+                ),
+            }
+
+        payload, _ = SharedConfig(path, max_age=max_age).fetch(namespace, fetch)
+        if fetched:
+            return fetched[0]
+
+        diff = ConfigDiff()
+        indexes = self.kv_indexes.setdefault(namespace, {})
+        for k, v in payload['config'].items():
+            modify_index = payload['indexes'][k]
+            if indexes.get(k) == modify_index:
+                continue
+            (diff.added if k not in indexes else diff.changed)[k] = v
+            self.app.config[k] = v
+            indexes[k] = modify_index
+        for k in set(indexes) - set(payload['indexes']):
+            del indexes[k]
+            diff.removed.add(k)
+            if prune:
+                self.app.config.pop(k, None)
+        self.app.logger.debug("Attached to shared config %r", path)
+        return diff
 
     @with_retry_connections()
     def register_service(self, **kwargs):
@@ -110,4 +702,46 @@ class Consul(object):
         kwargs passed to Consul.agent.service.register
         """
         kwargs.setdefault('name', self.app.name)
-        self.session.agent.service.register(**kwargs)
+        # services belong to the node of the agent they are registered
+        # with, so they stay with the local agent instead of failing over
+        with self._agent_call(self.agents.primary) as agent:
+            agent.session.agent.service.register(**kwargs)
+
+    def register_services(self, *services, **kwargs):
+        """
+        Register services from a background thread, once per host, keep
+        their TTL checks alive and deregister them at exit; see
+        RegistrationManager. Returns right away.
+
+        :param services: dicts of RegistrationManager.add arguments
+        :param kwargs: RegistrationManager arguments
+        :return: the started RegistrationManager, to report the status of
+            TTL checks through
+        """
+        manager = RegistrationManager(self, **kwargs)
+        for service in services:
+            manager.add(**service)
+        return manager.start()
+
+    def lock(self, key, **kwargs):
+        """
+        A distributed lock on a kv key, held by a consul session; use it as
+        a context manager or call acquire() and release()
+
+        :param key: kv key to lock
+        :param kwargs: Lock arguments, e.g. timeout
+        :return: Lock
+        """
+        return Lock(self, key, **kwargs)
+
+    def semaphore(self, prefix, limit, **kwargs):
+        """
+        A distributed semaphore with limit slots under a kv prefix; use it
+        as a context manager or call acquire() and release()
+
+        :param prefix: kv prefix of the semaphore
+        :param limit: number of slots
+        :param kwargs: Semaphore arguments, e.g. timeout
+        :return: Semaphore
+        """
+        return Semaphore(self, prefix, limit, **kwargs)
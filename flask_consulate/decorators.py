@@ -1,34 +1,153 @@
 # coding: utf-8
 
 import time
+import random
 import functools
 
 from requests.exceptions import ConnectionError, ConnectTimeout
 
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
 from flask_consulate.exceptions import ConsulConnectionError
+from flask_consulate.instrumentation import Instrumentation, NOOP
+
+
+class RetryPolicy(object):
+    """
+    Describes when and how often with_retry_connections retries a call.
+
+    The sleep between tries grows exponentially from `sleep`, capped at
+    `max_sleep`, and with full jitter a random duration between 0 and that
+    value is used, so that clients failing together don't retry in lockstep.
+    """
+
+    def __init__(self, max_tries=3, sleep=0.05, max_sleep=2, jitter=True,
+                 deadline=None, exceptions=(ConnectionError, ConnectTimeout),
+                 status_codes=()):
+        """
+        :param max_tries: maximum number of attempts before giving up
+        :param sleep: time to sleep after the first failed try, or None
+        :param max_sleep: maximum time to sleep between tries
+        :param jitter: sleep a random time up to the backoff time
+        :param deadline: total number of seconds to spend on all tries, or
+            None for no limit
+        :param exceptions: tuple of exception classes to retry on
+        :param status_codes: HTTP status codes of responses to retry on,
+            e.g. (502, 503)
+        """
+        self.max_tries = max_tries
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+        self.jitter = jitter
+        self.deadline = deadline
+        self.exceptions = tuple(exceptions)
+        self.status_codes = frozenset(status_codes)
+
+    def replace(self, **kwargs):
+        """
+        :return: a copy of this policy with the given attributes replaced
+        """
+        attrs = dict(self.__dict__, **kwargs)
+        return RetryPolicy(**attrs)
+
+    def backoff(self, tries):
+        """
+        :param tries: number of tries that failed so far
+        :return: number of seconds to sleep before the next try
+        """
+        if not self.sleep:
+            return 0
+        backoff = min(self.sleep * 2 ** (tries - 1), self.max_sleep)
+        if self.jitter:
+            return random.uniform(0, backoff)
+        return backoff
+
+
+def get_retry_policy(policy, base=None):
+    """
+    :param policy: RetryPolicy, dict of RetryPolicy attributes to replace
+        in base, or None for base
+    :param base: RetryPolicy to derive from
+    :return: RetryPolicy
+    """
+    base = base if base is not None else RetryPolicy()
+    if policy is None:
+        return base
+    if isinstance(policy, dict):
+        return base.replace(**policy)
+    return policy
+
+
+def get_hooks(args):
+    """
+    :param args: arguments of a decorated call
+    :return: the Instrumentation of the object a method was called on, or
+        NOOP
+    """
+    hooks = getattr(args[0], 'instrumentation', None) if args else None
+    return hooks if isinstance(hooks, Instrumentation) else NOOP
 
 
-def with_retry_connections(max_tries=3, sleep=0.05):
+def with_retry_connections(max_tries=3, sleep=0.05, **kwargs):
     """
     Decorator that wraps an entire function in a try/except clause. On
     requests.exceptions.ConnectionError, will re-run the function code
-    until success or max_tries is reached.
+    until success or max_tries is reached, backing off exponentially with
+    jitter between tries.
+
+    The policy given here is the default. Methods of objects that have a
+    `retry_policy` attribute use that instead, and every call can pass a
+    `retry_policy` keyword argument (a RetryPolicy, or a dict of attributes
+    to override) that takes precedence over both.
+
+    Retries and the time slept for them are reported to the
+    `instrumentation` of the object, if it has one.
 
     :param max_tries: maximum number of attempts before giving up
-    :param sleep: time to sleep between tries, or None
+    :param sleep: time to sleep after the first failed try, or None
+    :param kwargs: further RetryPolicy arguments
     """
+    default = RetryPolicy(max_tries=max_tries, sleep=sleep, **kwargs)
+
     def decorator(f):
         @functools.wraps(f)
         def f_retry(*args, **kwargs):
+            policy = getattr(args[0], 'retry_policy', None) if args else None
+            policy = get_retry_policy(
+                kwargs.pop('retry_policy', None),
+                policy if isinstance(policy, RetryPolicy) else default,
+            )
+            start = monotonic()
             tries = 0
             while True:
                 try:
-                    return f(*args, **kwargs)
-                except (ConnectionError, ConnectTimeout) as e:
-                    tries += 1
-                    if tries >= max_tries:
-                        raise ConsulConnectionError(e)
-                    if sleep:
-                        time.sleep(sleep)
+                    result = f(*args, **kwargs)
+                except policy.exceptions as e:
+                    result, error = None, e
+                else:
+                    status_code = getattr(result, 'status_code', None)
+                    if status_code not in policy.status_codes:
+                        return result
+                    error = None
+                tries += 1
+                delay = policy.backoff(tries)
+                out_of_time = policy.deadline is not None and \
+                    monotonic() - start + delay >= policy.deadline
+                if tries >= policy.max_tries or out_of_time:
+                    if error is None:
+                        return result
+                    if isinstance(error, ConsulConnectionError):
+                        raise error
+                    raise ConsulConnectionError(error)
+                hooks = get_hooks(args)
+                if hooks.enabled:
+                    labels = {'call': f.__name__}
+                    hooks.increment('retries', 1, labels)
+                    hooks.observe('retry_sleep_seconds', delay, labels)
+                if delay:
+                    time.sleep(delay)
         return f_retry
     return decorator
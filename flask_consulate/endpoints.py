@@ -0,0 +1,138 @@
+# coding: utf-8
+
+
+class Endpoint(object):
+    """
+    A resolved instance of a service: where to reach it, its SRV weight and
+    priority, what consul knows about it, and the statistics the balancers
+    keep about it.
+
+    The base URL is formatted once, when the endpoint is resolved, and
+    endpoints whose fields didn't change are kept across re-resolutions
+    along with their statistics. Fields can also be read like the keys of
+    the dicts endpoints used to be, e.g. endpoint['url'] or
+    endpoint.get('node').
+    """
+
+    __slots__ = (
+        'addr', 'port', 'weight', 'priority', 'url', 'node', 'id', 'tags',
+        'meta', 'node_meta', 'datacenter', 'outstanding', 'latency',
+    )
+
+    FIELDS = __slots__[:-2]
+
+    def __init__(self, addr=None, port=None, weight=1, priority=1, url=None,
+                 node=None, id=None, tags=(), meta=None, node_meta=None,
+                 datacenter=None):
+        """
+        :param addr: IP address or host name
+        :param port: port
+        :param weight: SRV weight
+        :param priority: SRV priority; lower values are preferred
+        :param url: base URL, defaulting to http://<addr>:<port>
+        :param node: name of the consul node, if known
+        :param id: consul service id, if known
+        :param tags: tuple of service tags
+        :param meta: dict of service metadata
+        :param node_meta: dict of node metadata
+        :param datacenter: datacenter of the node
+        """
+        self.addr = addr
+        self.port = port
+        self.weight = weight
+        self.priority = priority
+        self.url = url or 'http://{}:{}'.format(addr, port)
+        self.node = node
+        self.id = id
+        self.tags = tuple(tags)
+        self.meta = meta or {}
+        self.node_meta = node_meta or {}
+        self.datacenter = datacenter
+        # requests in flight
+        self.outstanding = 0
+        # moving average latency of successful requests, seconds, or None
+        self.latency = None
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        :param record: dict with at least 'url', or 'addr' and 'port'
+        :return: Endpoint
+        """
+        return cls(**dict(
+            (k, v) for k, v in record.items() if k in cls.FIELDS
+        ))
+
+    def as_dict(self):
+        """
+        :return: dict of the fields that are set, without the statistics
+        """
+        return dict(
+            (k, getattr(self, k)) for k in self.FIELDS
+            if getattr(self, k) is not None
+        )
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.FIELDS else None
+        return default if value is None else value
+
+    def __eq__(self, other):
+        if not isinstance(other, Endpoint):
+            return NotImplemented
+        return all(
+            getattr(self, k) == getattr(other, k) for k in self.FIELDS
+        )
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.url)
+
+    def __repr__(self):
+        return '<Endpoint {} weight={} priority={}>'.format(
+            self.url, self.weight, self.priority,
+        )
+
+
+def as_endpoint(endpoint):
+    """
+    :param endpoint: Endpoint, or dict of its fields
+    :return: Endpoint
+    """
+    if isinstance(endpoint, Endpoint):
+        return endpoint
+    return Endpoint.from_dict(endpoint)
+
+
+def carry_over(endpoints, previous):
+    """
+    Keep the endpoints of the previous answer that didn't change, so their
+    statistics survive re-resolving, and the latency of those whose weight
+    or metadata changed
+
+    :param endpoints: iterable of newly resolved endpoints or dicts
+    :param previous: tuple of the endpoints cached so far, or None
+    :return: tuple of Endpoints
+    """
+    known = dict((e.url, e) for e in previous or ())
+    current = []
+    for endpoint in endpoints:
+        endpoint = as_endpoint(endpoint)
+        old = known.get(endpoint.url)
+        if old is not None:
+            if old == endpoint:
+                endpoint = old
+            else:
+                endpoint.latency = old.latency
+        current.append(endpoint)
+    return tuple(current)
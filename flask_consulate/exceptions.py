@@ -1,6 +1,6 @@
 # coding: utf-8
 
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, RequestException
 
 
 class ConsulConnectionError(ConnectionError):
@@ -8,3 +8,31 @@ class ConsulConnectionError(ConnectionError):
     A connection error related to Consul happened.
     """
     pass
+
+
+class CircuitOpenError(ConsulConnectionError):
+    """
+    All circuit breakers for the target are open, so no call was made.
+    """
+    pass
+
+
+class RateLimitExceeded(RequestException):
+    """
+    The client-side rate or concurrency limit of the target was reached, so
+    no call was made. Not retried, as retrying would only add load.
+    """
+
+    def __init__(self, message, retry_after=None):
+        """
+        :param retry_after: seconds after which the call may succeed
+        """
+        super(RateLimitExceeded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class LockNotAcquired(Exception):
+    """
+    A consul lock or semaphore couldn't be acquired within its timeout.
+    """
+    pass
@@ -0,0 +1,198 @@
+# coding: utf-8
+
+import logging
+import threading
+
+import requests
+
+from requests.exceptions import RequestException
+from six import iteritems
+
+from flask_consulate.agents import default_agent
+from flask_consulate.decorators import RetryPolicy
+from flask_consulate.endpoints import Endpoint
+from flask_consulate.exceptions import ConsulConnectionError
+
+logger = logging.getLogger(__name__)
+
+
+def parse_service(service):
+    """
+    Split a consul DNS name into its parts
+
+    :param service: [tag.]name.service[.datacenter].consul
+    :return: tuple of (name, tag or None, datacenter or None)
+    """
+    labels = service.rstrip('.').split('.')
+    if 'service' not in labels:
+        return service, None, None
+    i = labels.index('service')
+    tag = '.'.join(labels[:i - 1]) or None
+    datacenter = labels[i + 1] if len(labels) > i + 2 else None
+    return labels[i - 1], tag, datacenter
+
+
+def health_endpoints(entries):
+    """
+    :param entries: response of /v1/health/service/<name>
+    :return: list of Endpoint records
+    """
+    endpoints = []
+    for entry in entries:
+        node, service = entry['Node'], entry['Service']
+        weights = service.get('Weights') or {}
+        endpoints.append(Endpoint(
+            service.get('Address') or node['Address'], service['Port'],
+            weight=weights.get('Passing', 1),
+            priority=1,
+            id=service['ID'],
+            tags=service.get('Tags') or (),
+            meta=service.get('Meta'),
+            node=node['Node'],
+            node_meta=node.get('Meta'),
+            datacenter=node.get('Datacenter'),
+        ))
+    return endpoints
+
+
+class HealthQuery(object):
+    """
+    Queries consul's health API for the passing instances of a service.
+    Unlike DNS, the answer is never truncated and carries the tags and
+    metadata of every instance and its node.
+    """
+
+    def __init__(self, service, agent=None, name=None, tag=None,
+                 datacenter=None, node_meta=None, wait=300):
+        """
+        :param service: consul DNS name the defaults are taken from
+            ([tag.]name.service[.datacenter].consul)
+        :param agent: host:port of the consul agent, defaulting to
+            the first of $CONSUL_HOST:$CONSUL_PORT, then localhost:8500
+        :param name: service name
+        :param tag: only return instances with this tag
+        :param datacenter: datacenter to query instead of the agent's
+        :param node_meta: dict of node metadata instances' nodes must have
+        :param wait: maximum number of seconds a blocking query may wait
+        """
+        default_name, default_tag, default_dc = parse_service(service)
+        if agent is None:
+            agent = default_agent()
+        self.agent = agent
+        self.name = name or default_name
+        self.tag = tag if tag is not None else default_tag
+        self.datacenter = datacenter or default_dc
+        self.node_meta = node_meta or {}
+        self.wait = wait
+        self.session = requests.Session()
+
+    @property
+    def url(self):
+        return 'http://{}/v1/health/service/{}'.format(self.agent, self.name)
+
+    def fetch(self, index=None):
+        """
+        Fetch the passing instances, as a blocking query if index is given
+
+        :param index: X-Consul-Index of the previous response
+        :return: tuple of (list of endpoint records, X-Consul-Index)
+        """
+        params = [('passing', '')]
+        if self.tag:
+            params.append(('tag', self.tag))
+        if self.datacenter:
+            params.append(('dc', self.datacenter))
+        for k, v in sorted(iteritems(self.node_meta)):
+            params.append(('node-meta', '{}:{}'.format(k, v)))
+        timeout = (1, 30)
+        if index:
+            params += [('index', index), ('wait', '{}s'.format(self.wait))]
+            # consul adds up to wait/16 of jitter to blocking queries
+            timeout = (1, self.wait + self.wait / 16.0 + 5)
+        r = self.session.get(self.url, params=params, timeout=timeout)
+        if r.status_code != 200:
+            raise ConsulConnectionError(
+                'Unexpected response {} from consul health: {}'.format(r.status_code, r.text)
+            )
+        return (
+            health_endpoints(r.json()),
+            int(r.headers.get('X-Consul-Index', 0)),
+        )
+
+
+class HealthWatcher(threading.Thread):
+    """
+    Daemon thread that keeps the endpoints of a ConsulService up to date
+    with blocking queries on the health API, pushing every answer into the
+    service's cache as it arrives.
+    """
+
+    def __init__(self, service, query, retry_interval=1,
+                 max_retry_interval=60):
+        """
+        :param service: ConsulService instance to update
+        :param query: HealthQuery of the service
+        :param retry_interval: seconds to wait after the first failed query;
+            doubled after every further failure, with jitter
+        :param max_retry_interval: maximum seconds to wait between failures
+        """
+        super(HealthWatcher, self).__init__(
+            name='consul-health-{}'.format(query.name)
+        )
+        self.daemon = True
+        self.service = service
+        self.query = query
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._backoff = RetryPolicy(
+            sleep=retry_interval, max_sleep=max_retry_interval,
+        )
+        self.index = 0
+        # instance id -> endpoint record of the last answer
+        self.instances = {}
+        self._stopped = threading.Event()
+
+    @property
+    def ttl(self):
+        """
+        Seconds an answer stays valid: until the next blocking query must
+        have returned, plus a margin for retrying
+        """
+        return self.query.wait + self.query.wait / 16.0 + \
+            self.max_retry_interval
+
+    def stop(self):
+        self._stopped.set()
+
+    def poll(self):
+        """
+        Run a single blocking query and store its answer
+
+        :return: whether the set of instances changed
+        """
+        endpoints, index = self.query.fetch(index=self.index)
+        # consul may reset its index, e.g. after a snapshot restore, in
+        # which case the next query has to start over
+        self.index = index if index >= self.index else 0
+        instances = dict((e.id, e) for e in endpoints)
+        changed = instances != self.instances
+        self.instances = instances
+        self.service._store(endpoints, self.ttl, clamp=False)
+        return changed
+
+    def run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except (RequestException, ValueError, KeyError):
+                # unreachable agents, and answers that can't be parsed
+                failures += 1
+                delay = self._backoff.backoff(failures)
+                logger.warning(
+                    "Couldn't watch the health of %s, retrying in %ss",
+                    self.query.name, delay, exc_info=True,
+                )
+                self._stopped.wait(delay)
+            else:
+                failures = 0
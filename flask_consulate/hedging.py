@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import threading
+
+from collections import deque
+
+HEDGE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class HedgePolicy(object):
+    """
+    Decides when ConsulService sends a second, speculative request for an
+    idempotent method to another endpoint.
+
+    The hedge is sent once the first request has been outstanding for
+    `delay` seconds, or, with `percentile`, for longer than that percentile
+    of recently observed latencies. Every request earns `budget` hedge
+    tokens and every hedge spends one, so hedges stay below that share of
+    the traffic.
+    """
+
+    def __init__(self, delay=None, percentile=None, budget=0.1,
+                 max_tokens=10, samples=1000, min_samples=20):
+        """
+        :param delay: fixed number of seconds to wait before hedging
+        :param percentile: percentile (0-100) of observed latencies to wait
+            for before hedging; used instead of delay once min_samples
+            latencies were observed
+        :param budget: maximum share of requests that may be hedged
+        :param max_tokens: maximum number of hedge tokens that can be saved
+            up for bursts of slow requests
+        :param samples: number of recent latencies to keep
+        :param min_samples: latencies to observe before using percentile
+        """
+        assert delay is not None or percentile is not None, \
+            "Either delay or percentile is required"
+        self.delay = delay
+        self.percentile = percentile
+        self.budget = budget
+        self.max_tokens = max_tokens
+        self.min_samples = min_samples
+        self.hedged = 0
+        self.latencies = deque(maxlen=samples)
+        self._threshold = None
+        self._observed = 0
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, elapsed):
+        """
+        Record the latency of a successful request
+        """
+        self.latencies.append(elapsed)
+        self._observed += 1
+        # Sorting on every request would be too expensive; refresh the
+        # threshold every 10% of the sample window instead
+        if self._observed % max(self.latencies.maxlen // 10, 1) == 0:
+            self._threshold = None
+
+    def hedge_delay(self):
+        """
+        :return: seconds to wait for the first response before hedging, or
+            None to not hedge
+        """
+        if self.percentile is not None and \
+                len(self.latencies) >= self.min_samples:
+            if self._threshold is None:
+                ordered = sorted(self.latencies)
+                index = int(len(ordered) * self.percentile / 100.0)
+                self._threshold = ordered[min(index, len(ordered) - 1)]
+            return self._threshold
+        return self.delay
+
+    def earn(self):
+        """
+        Called for every request that could be hedged
+        """
+        with self._lock:
+            self._tokens = min(self._tokens + self.budget, self.max_tokens)
+
+    def spend(self):
+        """
+        :return: whether a hedge may be sent, spending a token if so
+        """
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.hedged += 1
+            return True
@@ -0,0 +1,192 @@
+# coding: utf-8
+
+import threading
+
+# Metrics emitted, by name:
+#
+#   resolve_seconds          histogram  service
+#   request_seconds          histogram  service, endpoint, status
+#   retries                  counter    call
+#   retry_sleep_seconds      histogram  call
+#   config_fetch_seconds     histogram  namespace
+#   config_fetch_bytes       histogram  namespace
+#   endpoint_churn           counter    service, change ('added'/'removed')
+#   locality_requests        counter    service, tier of the endpoint chosen
+#   rate_limited             counter    service
+#   rate_limit_wait_seconds  histogram  service
+HISTOGRAMS = frozenset([
+    'resolve_seconds', 'request_seconds', 'retry_sleep_seconds',
+    'config_fetch_seconds', 'config_fetch_bytes', 'rate_limit_wait_seconds',
+])
+COUNTERS = frozenset([
+    'retries', 'endpoint_churn', 'locality_requests', 'rate_limited',
+])
+
+
+class Instrumentation(object):
+    """
+    Receives the timings and counts of the calls made to consul and to
+    services resolved through it. This base class discards them; adapters
+    forward them to a metrics backend.
+
+    Callers check `enabled` before measuring anything, so with the default
+    instance the only cost on the hot path is that attribute lookup.
+    """
+
+    enabled = False
+
+    def observe(self, name, value, labels):
+        """
+        Record a sample of a histogram
+
+        :param name: one of HISTOGRAMS
+        :param value: the sample, in seconds for timings
+        :param labels: dict of label name to value
+        """
+
+    def increment(self, name, value, labels):
+        """
+        Increment a counter
+
+        :param name: one of COUNTERS
+        :param value: amount to add
+        :param labels: dict of label name to value
+        """
+
+
+NOOP = Instrumentation()
+
+
+class PrometheusInstrumentation(Instrumentation):
+    """
+    Exports the metrics as prometheus_client Histograms and Counters
+    """
+
+    enabled = True
+
+    def __init__(self, registry=None, prefix='consul_', buckets=None):
+        """
+        :param registry: prometheus_client CollectorRegistry, or None for
+            the default registry
+        :param prefix: prefix of the metric names
+        :param buckets: histogram buckets, or None for the defaults
+        """
+        try:
+            import prometheus_client
+        except ImportError:
+            raise RuntimeError('prometheus_client is required for prometheus metrics')
+        self.prometheus = prometheus_client
+        self.registry = registry
+        self.prefix = prefix
+        self.buckets = buckets
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _metric(self, cls, name, labels):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    kwargs = {'labelnames': sorted(labels)}
+                    if self.registry is not None:
+                        kwargs['registry'] = self.registry
+                    if cls is self.prometheus.Histogram and self.buckets:
+                        kwargs['buckets'] = self.buckets
+                    metric = self.metrics[name] = cls(
+                        self.prefix + name, name.replace('_', ' '), **kwargs
+                    )
+        return metric.labels(**labels) if labels else metric
+
+    def observe(self, name, value, labels):
+        self._metric(self.prometheus.Histogram, name, labels).observe(value)
+
+    def increment(self, name, value, labels):
+        self._metric(self.prometheus.Counter, name, labels).inc(value)
+
+
+class StatsdInstrumentation(Instrumentation):
+    """
+    Sends the metrics through a statsd client (statsd.StatsClient or
+    datadog's DogStatsd). Label values are appended to the metric name, as
+    in consul.request_seconds.api.http_10_0_0_1_80.200; timings are sent in
+    milliseconds.
+    """
+
+    enabled = True
+
+    def __init__(self, client, prefix='consul'):
+        """
+        :param client: statsd client with timing() and incr() methods
+        :param prefix: prefix of the metric names
+        """
+        self.client = client
+        self.prefix = prefix
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name] if self.prefix else [name]
+        for k in sorted(labels):
+            value = str(labels[k])
+            for c in ':/.':
+                value = value.replace(c, '_')
+            parts.append(value)
+        return '.'.join(parts)
+
+    def observe(self, name, value, labels):
+        if name.endswith('_seconds'):
+            self.client.timing(self._name(name, labels), value * 1000)
+        else:
+            histogram = getattr(self.client, 'histogram', self.client.timing)
+            histogram(self._name(name, labels), value)
+
+    def increment(self, name, value, labels):
+        self.client.incr(self._name(name, labels), value)
+
+
+class OpenTelemetryInstrumentation(Instrumentation):
+    """
+    Records the metrics with OpenTelemetry instruments created from a Meter
+    """
+
+    enabled = True
+
+    def __init__(self, meter, prefix='consul.'):
+        """
+        :param meter: opentelemetry.metrics.Meter
+        :param prefix: prefix of the instrument names
+        """
+        self.meter = meter
+        self.prefix = prefix
+        self.instruments = {}
+        self._lock = threading.Lock()
+
+    def _instrument(self, create, name):
+        instrument = self.instruments.get(name)
+        if instrument is None:
+            with self._lock:
+                instrument = self.instruments.get(name)
+                if instrument is None:
+                    unit = 's' if name.endswith('_seconds') else \
+                        'By' if name.endswith('_bytes') else '1'
+                    instrument = self.instruments[name] = create(
+                        self.prefix + name, unit=unit,
+                    )
+        return instrument
+
+    def observe(self, name, value, labels):
+        self._instrument(self.meter.create_histogram, name).record(
+            value, attributes=labels,
+        )
+
+    def increment(self, name, value, labels):
+        self._instrument(self.meter.create_counter, name).add(
+            value, attributes=labels,
+        )
+
+
+def get_instrumentation(instrumentation):
+    """
+    :param instrumentation: Instrumentation, or None for NOOP
+    :return: Instrumentation
+    """
+    return instrumentation if instrumentation is not None else NOOP
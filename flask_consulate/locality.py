@@ -0,0 +1,208 @@
+# coding: utf-8
+
+import math
+import logging
+import threading
+
+import requests
+
+from requests.exceptions import RequestException
+
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+from flask_consulate.agents import default_agent
+
+logger = logging.getLogger(__name__)
+
+# Locality tiers, closest first
+NODE = 'node'
+ZONE = 'zone'
+NEAR = 'near'
+REMOTE = 'remote'
+TIERS = (NODE, ZONE, NEAR, REMOTE)
+
+
+def estimate_rtt(a, b):
+    """
+    Estimate the round trip time between two nodes from their network
+    coordinates, as described in consul's documentation
+
+    :param a: 'Coord' of a node in /v1/coordinate/nodes
+    :param b: 'Coord' of another node
+    :return: seconds
+    """
+    distance = math.sqrt(sum(
+        (x - y) ** 2 for x, y in zip(a['Vec'], b['Vec'])
+    )) + a['Height'] + b['Height']
+    adjusted = distance + a['Adjustment'] + b['Adjustment']
+    return adjusted if adjusted > 0 else distance
+
+
+class Locality(object):
+    """
+    Orders the endpoints of a ConsulService into tiers by how close they are
+    to the local node: the same node, the same zone (a node metadata key),
+    near by network coordinates, and everything else. Requests go to the
+    closest tier with at least min_endpoints available endpoints; farther
+    tiers are only used to make up for missing ones, and never beyond
+    max_tier.
+
+    Endpoints are only known by node when resolved through the health API,
+    or through DNS answers naming their node; zones require the health API.
+    """
+
+    def __init__(self, node=None, zone=None, zone_key='zone',
+                 coordinates=False, near_rtt=0.002, min_endpoints=1,
+                 max_tier=REMOTE, agent=None, coordinate_ttl=60):
+        """
+        :param node: name of the local node; asked from the agent if None
+        :param zone: zone of the local node; taken from the agent's node
+            metadata if None
+        :param zone_key: node metadata key holding the zone
+        :param coordinates: use network coordinates to find near endpoints
+        :param near_rtt: estimated round trip time in seconds up to which
+            endpoints count as near
+        :param min_endpoints: number of available endpoints a tier needs to
+            be used on its own
+        :param max_tier: farthest tier that may be used; requests fail with
+            CircuitOpenError if no closer endpoint is available
+        :param agent: host:port of the consul agent, defaulting to
+            the first of $CONSUL_HOST:$CONSUL_PORT, then localhost:8500
+        :param coordinate_ttl: seconds to keep network coordinates for
+        """
+        assert max_tier in TIERS, "max_tier must be one of {}".format(TIERS)
+        if agent is None:
+            agent = default_agent()
+        self.node = node
+        self.zone = zone
+        self.zone_key = zone_key
+        self.coordinates = coordinates
+        self.near_rtt = near_rtt
+        self.min_endpoints = min_endpoints
+        self.max_tier = max_tier
+        self.agent = agent
+        self.coordinate_ttl = coordinate_ttl
+        # node name -> Coord
+        self.coords = {}
+        self._coords_fetched = None
+        self._fetching = False
+        self._discovery_attempted = None
+        self._discovered = node is not None and zone is not None
+        self._tiers = TIERS[:TIERS.index(max_tier) + 1]
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+
+    def _get(self, path):
+        r = self.session.get(
+            'http://{}/v1/{}'.format(self.agent, path), timeout=(1, 5),
+        )
+        r.raise_for_status()
+        return r.json()
+
+    def update(self):
+        """
+        Learn the local node and zone from the agent, and refresh the
+        network coordinates once they are older than coordinate_ttl. Called
+        whenever endpoints are resolved; failures only degrade the locality
+        preference.
+
+        Until the local node and a first set of coordinates are known, the
+        agent is asked synchronously, which may add up to two requests of at
+        most 5 seconds each to the caller resolving the endpoints; failed
+        lookups are retried at most every coordinate_ttl seconds. Later
+        coordinate refreshes run in a background thread and never block the
+        caller; they are used from the next resolution on.
+        """
+        with self._lock:
+            if not self._discovered and (
+                    self._discovery_attempted is None or
+                    monotonic() - self._discovery_attempted > self.coordinate_ttl):
+                self._discovery_attempted = monotonic()
+                try:
+                    agent = self._get('agent/self')
+                    if self.node is None:
+                        self.node = agent['Config']['NodeName']
+                    if self.zone is None:
+                        self.zone = (agent.get('Meta') or {}).get(self.zone_key)
+                    self._discovered = True
+                except (RequestException, ValueError, KeyError):
+                    logger.warning("Couldn't get locality from consul agent %s", self.agent, exc_info=True)
+            if not self.coordinates or self._fetching or (
+                    self._coords_fetched is not None and
+                    monotonic() - self._coords_fetched <= self.coordinate_ttl):
+                return
+            self._coords_fetched = monotonic()
+            if self.coords:
+                self._fetching = True
+                thread = threading.Thread(
+                    target=self._fetch_coordinates,
+                    name='consul-coordinates-{}'.format(self.agent),
+                )
+                thread.daemon = True
+                thread.start()
+                return
+        self._fetch_coordinates()
+
+    def _fetch_coordinates(self):
+        try:
+            self.coords = dict(
+                (c['Node'], c['Coord'])
+                for c in self._get('coordinate/nodes')
+            )
+        except (RequestException, ValueError, KeyError):
+            logger.warning("Couldn't get network coordinates from consul agent %s", self.agent, exc_info=True)
+        finally:
+            self._fetching = False
+
+    def tier(self, endpoint):
+        """
+        :return: name of the tier of endpoint
+        """
+        node = endpoint.node
+        if node is not None and node == self.node:
+            return NODE
+        if self.zone is not None and \
+                endpoint.node_meta.get(self.zone_key) == self.zone:
+            return ZONE
+        local = self.coords.get(self.node)
+        remote = self.coords.get(node)
+        if local is not None and remote is not None and \
+                estimate_rtt(local, remote) <= self.near_rtt:
+            return NEAR
+        return REMOTE
+
+    def rank(self, endpoints):
+        """
+        :param endpoints: endpoint records
+        :return: tuple of (tier name, tuple of endpoints) of the non-empty
+            tiers, closest first
+        """
+        tiers = dict((name, []) for name in TIERS)
+        for endpoint in endpoints:
+            tiers[self.tier(endpoint)].append(endpoint)
+        return tuple(
+            (name, tuple(tiers[name])) for name in TIERS if tiers[name]
+        )
+
+    def choose(self, ranked, available):
+        """
+        :param ranked: tiers as returned by rank()
+        :param available: list of endpoints that may be used
+        :return: tuple of (name of the farthest tier used, list of endpoints
+            to choose from), or (None, []) if none is available within
+            max_tier
+        """
+        urls = set(e.url for e in available)
+        chosen = []
+        used = None
+        for name, members in ranked:
+            if name not in self._tiers:
+                break
+            chosen.extend(e for e in members if e.url in urls)
+            used = name
+            if len(chosen) >= self.min_endpoints:
+                break
+        return (used, chosen) if chosen else (None, [])
@@ -0,0 +1,464 @@
+# coding: utf-8
+
+import json
+import time
+import base64
+import logging
+import threading
+
+from requests.exceptions import RequestException
+
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+from flask_consulate.decorators import with_retry_connections
+from flask_consulate.exceptions import ConsulConnectionError, LockNotAcquired
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    if value is None:
+        return None
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return base64.b64encode(value).decode('ascii')
+
+
+class Session(object):
+    """
+    A consul session, renewed from a daemon thread every ttl / 2 seconds
+    until it is destroyed. If consul invalidates it anyway, e.g. because
+    its node failed, `lost` is set.
+    """
+
+    def __init__(self, consul, name='flask-consulate', ttl=15,
+                 behavior='release', lock_delay=None):
+        """
+        :param consul: Consul extension to talk to the agents through
+        :param name: name of the session, shown in consul's UI
+        :param ttl: seconds the session survives without being renewed;
+            consul only accepts 10 to 86400
+        :param behavior: 'release' or 'delete' the keys the session holds
+            once it is invalidated
+        :param lock_delay: seconds during which keys released by an
+            invalidated session can't be acquired again, or None for
+            consul's default of 15
+        """
+        self.consul = consul
+        self.retry_policy = consul.retry_policy
+        self.instrumentation = consul.instrumentation
+        self.name = name
+        self.ttl = ttl
+        self.behavior = behavior
+        self.lock_delay = lock_delay
+        self.id = None
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @with_retry_connections()
+    def _put(self, path, payload=None):
+        with self.consul._agent_call() as agent:
+            r = agent.http.put(
+                agent.base_uri + path, json=payload, timeout=(1, 10),
+            )
+            if r.status_code not in (200, 404):
+                raise ConsulConnectionError(
+                    'Unexpected response {} from consul session: {}'.format(r.status_code, r.text)
+                )
+        return r
+
+    def create(self):
+        """
+        Create the session in consul and start renewing it
+
+        :return: self
+        """
+        payload = {
+            'Name': self.name,
+            'TTL': '{}s'.format(self.ttl),
+            'Behavior': self.behavior,
+        }
+        if self.lock_delay is not None:
+            payload['LockDelay'] = '{}s'.format(self.lock_delay)
+        self.id = self._put('session/create', payload).json()['ID']
+        self.lost.clear()
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._renew, name='consul-session-{}'.format(self.id),
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _renew(self):
+        session_id = self.id
+        while not self._stopped.wait(self.ttl / 2.0):
+            try:
+                r = self._put('session/renew/' + session_id)
+            except RequestException:
+                logger.warning("Couldn't renew consul session %s", session_id, exc_info=True)
+                continue
+            if r.status_code == 404:
+                logger.warning("Consul session %s was invalidated", session_id)
+                self.lost.set()
+                return
+
+    def destroy(self):
+        """
+        Stop renewing the session and invalidate it
+        """
+        self._stopped.set()
+        if self.id is None:
+            return
+        try:
+            self._put('session/destroy/' + self.id)
+        except RequestException:
+            logger.warning("Couldn't destroy consul session %s", self.id, exc_info=True)
+        self.id = None
+
+    @property
+    def valid(self):
+        return self.id is not None and not self.lost.is_set()
+
+
+class _Coordinator(object):
+    """
+    What Lock and Semaphore share: the session they hold the kv store with,
+    blocking reads, transactions and the context manager protocol
+    """
+
+    def __init__(self, consul, ttl, timeout, wait, retry_interval,
+                 session_kwargs):
+        self.consul = consul
+        self.retry_policy = consul.retry_policy
+        self.instrumentation = consul.instrumentation
+        self.ttl = ttl
+        self.timeout = timeout
+        self.wait = wait
+        self.retry_interval = retry_interval
+        self.session_kwargs = session_kwargs
+        self.session = None
+        # ModifyIndex of the write that acquired the lock or slot; it only
+        # grows, so services can reject writes with older tokens
+        self.token = None
+
+    @property
+    def held(self):
+        """
+        whether the lock or slot is held, as far as this process knows
+        """
+        return self.session is not None and self.session.valid
+
+    def _read(self, prefix, index, wait, recurse=True):
+        """
+        :param index: X-Consul-Index to block on, or None to read right away
+        :param recurse: read the keys under prefix, or only the key prefix
+        :return: tuple of (dict of key to kv record, X-Consul-Index)
+        """
+        if index:
+            records, index = self.consul._fetch_kv(
+                prefix, index=index, wait=max(int(wait), 1), recurse=recurse,
+            )
+        else:
+            records, index = self.consul._fetch_kv(prefix, recurse=recurse)
+        return dict((r['Key'], r) for r in records), index
+
+    @with_retry_connections()
+    def _txn(self, ops):
+        """
+        :return: list of result kv records, or None if an operation failed
+        """
+        with self.consul._agent_call() as agent:
+            r = agent.http.put(
+                agent.base_uri + 'txn', json=ops, timeout=(1, 10),
+            )
+            if r.status_code == 409:
+                return None
+            if r.status_code != 200:
+                raise ConsulConnectionError(
+                    'Unexpected response {} from consul txn: {}'.format(r.status_code, r.text)
+                )
+        return [result['KV'] for result in r.json().get('Results') or []]
+
+    def _wait(self, deadline):
+        """
+        :return: seconds the next blocking query may wait, or 0 once the
+            timeout passed
+        """
+        if deadline is None:
+            return self.wait
+        return max(min(self.wait, deadline - monotonic()), 0)
+
+    def acquire(self, timeout=None):
+        """
+        :param timeout: seconds to wait at most, 0 to try once, or None
+            for self.timeout
+        :return: whether it was acquired
+        """
+        raise NotImplementedError
+
+    def release(self):
+        raise NotImplementedError
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockNotAcquired(
+                'Timed out acquiring {}'.format(self)
+            )
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        self.release()
+
+
+class Lock(_Coordinator):
+    """
+    A lock on a kv key, held by a consul session that is renewed in the
+    background for as long as the lock is held.
+
+    Waiting for the lock is a blocking query on the key, so waiters don't
+    poll consul. If the session is invalidated while the lock is held - the
+    agent's node failed, or renewals didn't get through - consul releases
+    the lock and `held` turns False; long-running holders should check it,
+    or pass `token` on to the services they write to.
+
+        with consul.lock('locks/cron/cleanup', timeout=0) as lock:
+            cleanup(fencing_token=lock.token)
+    """
+
+    def __init__(self, consul, key, value=None, ttl=15, timeout=None,
+                 wait=60, retry_interval=5, **session_kwargs):
+        """
+        :param consul: Consul extension to talk to the agents through
+        :param key: kv key to lock
+        :param value: value to store in the key while locked
+        :param ttl: TTL of the session in seconds
+        :param timeout: default seconds to wait for the lock, 0 to try once,
+            or None to wait until it is acquired
+        :param wait: maximum seconds a single blocking query may wait
+        :param retry_interval: seconds to wait before trying again while
+            the key is held back by consul's lock delay
+        :param session_kwargs: further Session arguments
+        """
+        super(Lock, self).__init__(
+            consul, ttl, timeout, wait, retry_interval, session_kwargs,
+        )
+        self.key = key.lstrip('/')
+        self.value = value
+
+    def __repr__(self):
+        return '<Lock {!r}>'.format(self.key)
+
+    def _try_lock(self, session):
+        """
+        :return: the fencing token if the lock was acquired, otherwise None
+        """
+        results = self._txn([{'KV': {
+            'Verb': 'lock', 'Key': self.key, 'Value': _encode(self.value),
+            'Session': session.id,
+        }}])
+        return results[0]['ModifyIndex'] if results else None
+
+    def _locked(self, records):
+        """
+        :return: whether a session holds the key in records
+        """
+        record = records.get(self.key)
+        return record is not None and bool(record.get('Session'))
+
+    def acquire(self, timeout=None):
+        if self.held:
+            raise RuntimeError('{} is already held'.format(self))
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout if timeout is not None else None
+        session = Session(
+            self.consul, ttl=self.ttl, name='lock {}'.format(self.key),
+            **self.session_kwargs
+        ).create()
+        try:
+            # ModifyIndex of the key when it was last seen unlocked after a
+            # failed attempt
+            free_at = None
+            while True:
+                token = self._try_lock(session)
+                if token is not None:
+                    self.session, self.token = session, token
+                    return True
+                wait = self._wait(deadline)
+                if deadline is not None and wait <= 0:
+                    session.destroy()
+                    return False
+                records, index = self._read(self.key, None, 0, recurse=False)
+                if not self._locked(records):
+                    record = records.get(self.key)
+                    modify_index = record['ModifyIndex'] if record else 0
+                    if modify_index == free_at:
+                        # unlocked and unchanged, yet the lock failed: consul
+                        # holds keys back for the lock delay after their
+                        # session was invalidated
+                        time.sleep(min(self.retry_interval, wait))
+                    # otherwise it was released since the attempt; try again
+                    free_at = modify_index
+                    continue
+                free_at = None
+                # wait for the holder to release the lock
+                while self._locked(records):
+                    wait = self._wait(deadline)
+                    if deadline is not None and wait <= 0:
+                        session.destroy()
+                        return False
+                    records, index = self._read(
+                        self.key, index, wait, recurse=False,
+                    )
+        except BaseException:
+            session.destroy()
+            raise
+
+    def release(self):
+        """
+        Release the lock and destroy its session
+        """
+        session, self.session = self.session, None
+        if session is None:
+            return
+        try:
+            if session.valid:
+                self._txn([{'KV': {
+                    'Verb': 'unlock', 'Key': self.key,
+                    'Value': _encode(self.value), 'Session': session.id,
+                }}])
+        finally:
+            session.destroy()
+
+
+class Semaphore(_Coordinator):
+    """
+    A counting semaphore under a kv prefix, compatible with consul's own
+    semaphore recipe: every contender holds a key <prefix>/<session id>
+    with its session, and <prefix>/.lock lists the `limit` holders, updated
+    with check-and-set. Holders whose session was invalidated no longer
+    count, so their slots are taken over by the next contender.
+
+        with consul.semaphore('locks/reports', 3):
+            render_report()
+    """
+
+    def __init__(self, consul, prefix, limit, value=None, ttl=15,
+                 timeout=None, wait=60, retry_interval=5, **session_kwargs):
+        """
+        :param consul: Consul extension to talk to the agents through
+        :param prefix: kv prefix of the semaphore
+        :param limit: number of slots
+        :param value: value to store in the key of this contender
+        :param ttl: TTL of the session in seconds
+        :param timeout: default seconds to wait for a slot, 0 to try once,
+            or None to wait until one is acquired
+        :param wait: maximum seconds a single blocking query may wait
+        :param retry_interval: seconds to wait before trying again after a
+            conflicting update
+        :param session_kwargs: further Session arguments
+        """
+        session_kwargs.setdefault('behavior', 'delete')
+        super(Semaphore, self).__init__(
+            consul, ttl, timeout, wait, retry_interval, session_kwargs,
+        )
+        self.prefix = prefix.strip('/') + '/'
+        self.lock_key = self.prefix + '.lock'
+        self.limit = limit
+        self.value = value
+
+    def __repr__(self):
+        return '<Semaphore {!r} limit={}>'.format(self.prefix, self.limit)
+
+    def _holders(self, records):
+        """
+        :return: tuple of (record of the .lock key or None, list of the
+            holders whose session is still alive)
+        """
+        live = set(
+            r['Session'] for k, r in records.items()
+            if k != self.lock_key and r.get('Session')
+        )
+        lock = records.get(self.lock_key)
+        holders = []
+        if lock is not None and lock.get('Value'):
+            state = json.loads(base64.b64decode(lock['Value']).decode('utf-8'))
+            if state.get('Limit') != self.limit:
+                raise ValueError('{} has a limit of {} in consul'.format(
+                    self, state.get('Limit'),
+                ))
+            holders = [h for h in state.get('Holders') or {} if h in live]
+        return lock, holders
+
+    def _cas(self, lock, holders):
+        """
+        :return: the fencing token if .lock was updated, otherwise None
+        """
+        state = {'Limit': self.limit, 'Holders': dict((h, True) for h in holders)}
+        results = self._txn([{'KV': {
+            'Verb': 'cas', 'Key': self.lock_key,
+            'Value': _encode(json.dumps(state, sort_keys=True)),
+            'Index': lock['ModifyIndex'] if lock is not None else 0,
+        }}])
+        return results[0]['ModifyIndex'] if results else None
+
+    def acquire(self, timeout=None):
+        if self.held:
+            raise RuntimeError('{} is already held'.format(self))
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout if timeout is not None else None
+        session = Session(
+            self.consul, ttl=self.ttl, name='semaphore {}'.format(self.prefix),
+            **self.session_kwargs
+        ).create()
+        try:
+            if not self._txn([{'KV': {
+                'Verb': 'lock', 'Key': self.prefix + session.id,
+                'Value': _encode(self.value), 'Session': session.id,
+            }}]):
+                raise ConsulConnectionError(
+                    "Couldn't create the contender key of {}".format(self)
+                )
+            index = None
+            while True:
+                records, index = self._read(
+                    self.prefix, index, self._wait(deadline),
+                )
+                lock, holders = self._holders(records)
+                if len(holders) < self.limit:
+                    token = self._cas(lock, holders + [session.id])
+                    if token is not None:
+                        self.session, self.token = session, token
+                        return True
+                    # someone else updated .lock; read it again right away
+                    index = None
+                    continue
+                if deadline is not None and self._wait(deadline) <= 0:
+                    session.destroy()
+                    return False
+        except BaseException:
+            session.destroy()
+            raise
+
+    def release(self):
+        """
+        Give up the slot and destroy the session, deleting the contender key
+        """
+        session, self.session = self.session, None
+        if session is None:
+            return
+        try:
+            while session.valid:
+                records, _ = self._read(self.prefix, None, 0)
+                lock, holders = self._holders(records)
+                if session.id not in holders:
+                    break
+                holders.remove(session.id)
+                if self._cas(lock, holders) is not None:
+                    break
+        finally:
+            session.destroy()
@@ -0,0 +1,331 @@
+# coding: utf-8
+
+import threading
+
+from six import iteritems
+
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+from flask_consulate.exceptions import RateLimitExceeded
+
+# seconds after which a call rejected for concurrency may try again; waiting
+# callers are woken as soon as a call finishes instead
+CONCURRENCY_RETRY = 0.01
+
+
+class TokenBucket(object):
+    """
+    Lets `rate` calls per second through on average, and bursts of up to
+    `burst` calls after a quiet period.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added per second
+        :param burst: maximum number of tokens held, defaulting to rate
+        """
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = float(self.burst)
+        self._updated = monotonic()
+
+    def _fill(self):
+        now = monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def take(self):
+        """
+        :return: None if a token was taken, otherwise the number of seconds
+            until one is available
+        """
+        self._fill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """
+        Give back a token taken for a call that wasn't made
+        """
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class ConcurrencyLimit(object):
+    """
+    Lets at most `limit` calls be in flight at once
+    """
+
+    def __init__(self, limit):
+        """
+        :param limit: maximum number of calls in flight
+        """
+        self.limit = limit
+        self.in_flight = 0
+
+    def take(self):
+        """
+        :return: whether a call may start, counting it as in flight if so
+        """
+        if self.in_flight >= self.limit:
+            return False
+        self.in_flight += 1
+        return True
+
+    def give(self, elapsed=None, status=None):
+        """
+        Count a call as finished
+
+        :param elapsed: seconds the call took, or None if it was abandoned
+        :param status: HTTP status code of its response, 'error' if it
+            raised, or None if it was abandoned
+        """
+        self.in_flight = max(self.in_flight - 1, 0)
+
+
+class AdaptiveLimit(ConcurrencyLimit):
+    """
+    Concurrency limit that adapts to the capacity of the upstream by
+    additive increase, multiplicative decrease: every call that isn't
+    overloaded raises the limit by `increase` / limit, so by about
+    `increase` per round trip while the limit is in use, and an overloaded
+    call - an overload status code, an error, or a response slower than
+    `latency` - multiplies it by `backoff`. Only calls started after the
+    last decrease can decrease the limit again, so a burst of failures
+    backs off once.
+    """
+
+    def __init__(self, initial=10, min_limit=1, max_limit=200, increase=1.0,
+                 backoff=0.5, latency=None, overload_status_codes=(429, 503)):
+        """
+        :param initial: limit to start with
+        :param min_limit: lowest the limit may drop to
+        :param max_limit: highest the limit may grow to
+        :param increase: amount the limit grows by per limit's worth of
+            successful calls
+        :param backoff: factor the limit is multiplied with on overload
+        :param latency: seconds above which a response counts as
+            overloaded, or None to only go by status codes and errors
+        :param overload_status_codes: HTTP status codes signalling overload
+        """
+        super(AdaptiveLimit, self).__init__(float(initial))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.latency = latency
+        self.overload_status_codes = frozenset(overload_status_codes)
+        self._decreased_at = None
+
+    def give(self, elapsed=None, status=None):
+        in_flight = self.in_flight
+        super(AdaptiveLimit, self).give(elapsed, status)
+        if status is None:
+            return
+        overloaded = status == 'error' or \
+            status in self.overload_status_codes or \
+            (self.latency is not None and elapsed > self.latency)
+        if overloaded:
+            now = monotonic()
+            if self._decreased_at is None or now - elapsed >= self._decreased_at:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._decreased_at = now
+        elif in_flight * 2 >= self.limit:
+            # only grow while the limit is actually in use
+            self.limit = min(
+                self.max_limit, self.limit + self.increase / self.limit
+            )
+
+
+class Limits(object):
+    """
+    The token bucket and concurrency limit of a single service or endpoint
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None, adaptive=None):
+        """
+        :param rate: calls per second, or None for no rate limit
+        :param burst: calls that may be made at once after a quiet period
+        :param concurrency: maximum number of calls in flight, or None. With
+            adaptive, the initial limit.
+        :param adaptive: dict of AdaptiveLimit arguments, or True for the
+            defaults, to adapt the concurrency limit to the upstream
+        """
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        if adaptive:
+            kwargs = dict(adaptive) if isinstance(adaptive, dict) else {}
+            if concurrency:
+                kwargs.setdefault('initial', concurrency)
+            self.concurrency = AdaptiveLimit(**kwargs)
+        elif concurrency:
+            self.concurrency = ConcurrencyLimit(concurrency)
+        else:
+            self.concurrency = None
+        self.rejected = 0
+
+    def take(self):
+        """
+        :return: None if a call may start, otherwise the number of seconds
+            after which to try again
+        """
+        if self.concurrency is not None and not self.concurrency.take():
+            self.rejected += 1
+            return CONCURRENCY_RETRY
+        if self.bucket is not None:
+            wait = self.bucket.take()
+            if wait is not None:
+                if self.concurrency is not None:
+                    self.concurrency.give()
+                self.rejected += 1
+                return wait
+        return None
+
+    def refund(self):
+        """
+        Undo take() for a call that wasn't made
+        """
+        if self.bucket is not None:
+            self.bucket.refund()
+        if self.concurrency is not None:
+            self.concurrency.give()
+
+    def give(self, elapsed, status):
+        if self.concurrency is not None:
+            self.concurrency.give(elapsed, status)
+
+    def snapshot(self):
+        """
+        :return: dict describing the limits, for monitoring
+        """
+        snapshot = {'rejected': self.rejected}
+        if self.bucket is not None:
+            self.bucket._fill()
+            snapshot['tokens'] = self.bucket.tokens
+        if self.concurrency is not None:
+            snapshot['limit'] = self.concurrency.limit
+            snapshot['in_flight'] = self.concurrency.in_flight
+        return snapshot
+
+
+class RateLimiter(object):
+    """
+    Client-side rate and concurrency limits of a ConsulService, for the
+    service as a whole and for each of its endpoints.
+
+    Every request, including every retry, needs a token and a free slot of
+    both the service and the endpoint it is sent to. Requests that can't
+    get them wait for up to `timeout` seconds, then fail with
+    RateLimitExceeded, which isn't retried; with the default timeout of 0
+    they fail right away.
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None,
+                 adaptive=None, per_endpoint=None, timeout=0):
+        """
+        :param rate: requests per second to the service, or None
+        :param burst: requests that may be made at once after a quiet period
+        :param concurrency: maximum number of requests to the service in
+            flight, or None; with adaptive, the initial limit
+        :param adaptive: dict of AdaptiveLimit arguments, or True for the
+            defaults, to adapt the service's concurrency limit to latency and
+            overload responses
+        :param per_endpoint: dict of Limits arguments (rate, burst,
+            concurrency, adaptive) applied to every endpoint, or None
+        :param timeout: seconds a request may wait for its limits
+        """
+        self.service = Limits(rate, burst, concurrency, adaptive)
+        self.per_endpoint = per_endpoint
+        # endpoint url -> Limits
+        self.endpoints = {}
+        self.timeout = timeout
+        self._released = threading.Condition()
+
+    def _endpoint(self, url):
+        if self.per_endpoint is None:
+            return None
+        limits = self.endpoints.get(url)
+        if limits is None:
+            limits = self.endpoints[url] = Limits(**self.per_endpoint)
+        return limits
+
+    def try_acquire(self, url):
+        """
+        Claim the limits of the service and of the endpoint at url if they
+        are all free, without waiting
+
+        :return: None if claimed, otherwise the number of seconds after
+            which to try again
+        """
+        with self._released:
+            return self._take(url)
+
+    def _take(self, url):
+        wait = self.service.take()
+        if wait is not None:
+            return wait
+        endpoint = self._endpoint(url)
+        if endpoint is not None:
+            wait = endpoint.take()
+            if wait is not None:
+                self.service.refund()
+                return wait
+        return None
+
+    def acquire(self, url, timeout=None):
+        """
+        Claim the limits of the service and of the endpoint at url, waiting
+        for them if necessary
+
+        :param timeout: seconds to wait at most, defaulting to self.timeout
+        :raises RateLimitExceeded: if the limits weren't free in time
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = monotonic() + timeout
+        with self._released:
+            while True:
+                wait = self._take(url)
+                if wait is None:
+                    return
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise RateLimitExceeded(
+                        'Rate limit of {} exceeded'.format(url),
+                        retry_after=wait,
+                    )
+                # woken early when a request finishes
+                self._released.wait(min(wait, remaining))
+
+    def release(self, url, elapsed=None, status=None):
+        """
+        Give back the limits claimed for a request to url
+
+        :param elapsed: seconds the request took, or None if it was abandoned
+        :param status: HTTP status code of the response, 'error' if the
+            request raised, or None if it was abandoned
+        """
+        with self._released:
+            self.service.give(elapsed, status)
+            endpoint = self._endpoint(url)
+            if endpoint is not None:
+                endpoint.give(elapsed, status)
+            self._released.notify_all()
+
+    def snapshot(self):
+        """
+        :return: dict describing the limits of the service and of every
+            endpoint, for monitoring
+        """
+        with self._released:
+            return {
+                'service': self.service.snapshot(),
+                'endpoints': dict(
+                    (url, limits.snapshot())
+                    for url, limits in iteritems(self.endpoints)
+                ),
+            }
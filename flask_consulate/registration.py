@@ -0,0 +1,308 @@
+# coding: utf-8
+
+import os
+import atexit
+import hashlib
+import logging
+import tempfile
+import threading
+
+from requests.exceptions import RequestException
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+from flask_consulate.decorators import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+PASSING = 'passing'
+WARNING = 'warning'
+CRITICAL = 'critical'
+
+
+class RegistrationManager(object):
+    """
+    Registers a batch of services with the local consul agent from a
+    background thread, keeps their TTL checks alive, and deregisters them
+    when the process exits.
+
+    Of all processes on a host using the same lock file - the workers of a
+    pre-fork server, say - only the one holding the lock registers and
+    heartbeats; the others stand by and take over once it exits. Service
+    ids therefore have to be the same in every process, which they are by
+    default. The lock file name is derived from the agent and the service
+    ids unless given.
+
+    Statuses reported with set_status() are coalesced: the thread sends
+    the latest one as soon as the status changes, and otherwise re-sends it
+    every heartbeat_interval. Note that only the statuses reported in the
+    process holding the lock reach consul.
+    """
+
+    def __init__(self, consul, lock_path=None, heartbeat_interval=None,
+                 standby_interval=5, retry_interval=1, max_retry_interval=60,
+                 deregister=True):
+        """
+        :param consul: Consul extension whose agent to register with
+        :param lock_path: lock file electing the registering process
+        :param heartbeat_interval: seconds between updates of an unchanged
+            TTL check, defaulting to a third of its TTL
+        :param standby_interval: seconds between attempts of standby
+            processes to take the lock
+        :param retry_interval: seconds to wait after the first failed call
+            to the agent; doubled after every further failure, with jitter
+        :param max_retry_interval: maximum seconds to wait between failures
+        :param deregister: deregister the services when the process holding
+            the lock exits
+        """
+        self.consul = consul
+        self.lock_path = lock_path
+        self.heartbeat_interval = heartbeat_interval
+        self.standby_interval = standby_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._backoff = RetryPolicy(
+            sleep=retry_interval, max_sleep=max_retry_interval,
+        )
+        self.deregister = deregister
+        # service id -> registration payload, in the agent's format
+        self.services = {}
+        # service id -> TTL in seconds, of the services with a TTL check
+        self.ttls = {}
+        # service id -> (status, output) last reported
+        self.statuses = {}
+        # service id -> (status, output) last sent to the agent
+        self._sent = {}
+        # service id -> time its check was last updated
+        self._heartbeats = {}
+        self.registered = False
+        self._lock_file = None
+        self._thread = None
+        self._pid = None
+        self._exit_hooked = False
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def add(self, name, port=None, service_id=None, address=None, tags=(),
+            meta=None, ttl=None, http=None, interval=None,
+            deregister_after=None):
+        """
+        Add a service to register
+
+        :param name: name of the service
+        :param port: port it listens on
+        :param service_id: id of the service, defaulting to its name
+        :param address: address it listens on, defaulting to the node's
+        :param tags: list of tags
+        :param meta: dict of service metadata
+        :param ttl: seconds within which the service must report its
+            status, for a TTL check
+        :param http: URL for an HTTP check, polled every interval
+        :param interval: interval of the HTTP check, e.g. '10s'
+        :param deregister_after: duration after which consul removes a
+            critical service, e.g. '10m', so services of processes that died
+            without deregistering don't linger
+        :return: service id
+        """
+        service_id = service_id or name
+        payload = {'ID': service_id, 'Name': name, 'Tags': list(tags)}
+        if port is not None:
+            payload['Port'] = port
+        if address:
+            payload['Address'] = address
+        if meta:
+            payload['Meta'] = dict(meta)
+        check = {}
+        if ttl is not None:
+            check['TTL'] = '{}s'.format(ttl)
+            self.ttls[service_id] = ttl
+        elif http:
+            check.update(HTTP=http, Interval=interval or '10s')
+        if check:
+            if deregister_after:
+                check['DeregisterCriticalServiceAfter'] = deregister_after
+            payload['Check'] = check
+        self.services[service_id] = payload
+        return service_id
+
+    def start(self):
+        """
+        Start the background thread; returns right away
+
+        :return: self
+        """
+        if self._pid != os.getpid():
+            # the thread and the lock of a parent process aren't ours
+            self._pid = os.getpid()
+            self._thread = None
+            self._lock_file = None
+            self.registered = False
+            self._sent = {}
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='consul-registration',
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        if not self._exit_hooked:
+            self._exit_hooked = True
+            atexit.register(self._at_exit)
+        return self
+
+    def stop(self, deregister=None):
+        """
+        Stop the background thread, deregister the services if this process
+        registered them, and release the lock
+
+        :param deregister: override self.deregister
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None and \
+                self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        deregister = self.deregister if deregister is None else deregister
+        if self.registered and deregister:
+            for service_id in self.services:
+                try:
+                    self._agent_put('agent/service/deregister/' + service_id)
+                except RequestException:
+                    logger.warning("Couldn't deregister service %s", service_id, exc_info=True)
+        self.registered = False
+        self._release()
+
+    def _at_exit(self):
+        if self._pid == os.getpid():
+            self.stop()
+
+    def set_status(self, service_id, status, output=''):
+        """
+        Report the status of the TTL check of a service. Returns right away;
+        the thread sends it.
+
+        :param status: PASSING, WARNING or CRITICAL
+        :param output: text shown with the check
+        """
+        with self._lock:
+            previous = self.statuses.get(service_id, (PASSING, ''))
+            self.statuses[service_id] = (status, output)
+        if previous[0] != status:
+            self._wake.set()
+
+    @property
+    def default_lock_path(self):
+        digest = hashlib.sha1(
+            '\n'.join([self.consul.agent] + sorted(self.services)).encode('utf-8')
+        ).hexdigest()[:16]
+        return os.path.join(
+            tempfile.gettempdir(), 'consul-registration-{}.lock'.format(digest)
+        )
+
+    def _acquire(self):
+        """
+        :return: whether this process holds the lock
+        """
+        if self._lock_file is not None or fcntl is None:
+            return True
+        lock_file = open(self.lock_path or self.default_lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _agent_put(self, path, payload=None, check=True):
+        """
+        :param check: raise HTTPError for error statuses
+        :return: requests.Response
+        """
+        # services belong to the node of the agent they are registered
+        # with, so they stay with the local agent instead of failing over
+        with self.consul._agent_call(self.consul.agents.primary) as agent:
+            r = agent.http.put(
+                agent.base_uri + path, json=payload, timeout=(1, 10),
+            )
+        if check:
+            r.raise_for_status()
+        return r
+
+    def _register(self):
+        for payload in self.services.values():
+            self._agent_put('agent/service/register', payload)
+        self.registered = True
+        self._sent = {}
+        self._heartbeats = {}
+        logger.info("Registered services %s", ', '.join(sorted(self.services)))
+
+    def _heartbeat(self):
+        """
+        Update the TTL checks whose status changed or whose heartbeat is due
+
+        :return: seconds until the next heartbeat is due
+        """
+        now = monotonic()
+        next_due = self.standby_interval
+        for service_id, ttl in self.ttls.items():
+            interval = self.heartbeat_interval or ttl / 3.0
+            with self._lock:
+                status = self.statuses.get(service_id, (PASSING, ''))
+            last = self._heartbeats.get(service_id)
+            sent = self._sent.get(service_id)
+            # a new output alone waits for the next heartbeat
+            if sent is not None and sent[0] == status[0] and \
+                    now - last < interval:
+                next_due = min(next_due, interval - (now - last))
+                continue
+            r = self._agent_put(
+                'agent/check/update/service:' + service_id,
+                {'Status': status[0], 'Output': status[1]}, check=False,
+            )
+            if r.status_code == 404:
+                # the agent lost the service, e.g. after a restart
+                self.registered = False
+                return 0
+            r.raise_for_status()
+            self._sent[service_id] = status
+            self._heartbeats[service_id] = now
+            next_due = min(next_due, interval)
+        return next_due
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                if not self._acquire():
+                    wait = self.standby_interval
+                else:
+                    if not self.registered:
+                        self._register()
+                    wait = self._heartbeat()
+            except RequestException:
+                failures += 1
+                wait = self._backoff.backoff(failures)
+                logger.warning(
+                    "Couldn't register services with consul, retrying in %ss",
+                    wait, exc_info=True,
+                )
+            else:
+                failures = 0
+            self._wake.wait(wait)
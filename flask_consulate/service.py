@@ -1,8 +1,18 @@
 # coding: utf-8
 
+import logging
+import threading
+
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 import requests
 
+from requests.adapters import HTTPAdapter
+from dns.exception import DNSException
 from dns.resolver import Resolver
+from requests.exceptions import ConnectionError
 
 try:
     from urllib.parse import urljoin
@@ -10,7 +20,261 @@ except ImportError:   # Python2 compat
     # noinspection PyUnresolvedReferences
     from urlparse import urljoin
 
-from flask_consulate.decorators import with_retry_connections
+try:
+    from time import monotonic
+except ImportError:  # Python2 compat
+    from time import time as monotonic
+
+from flask_consulate.balancers import get_balancer
+from flask_consulate.breaker import BreakerRegistry
+from flask_consulate.decorators import with_retry_connections, \
+    get_retry_policy
+from flask_consulate.endpoints import Endpoint, carry_over
+from flask_consulate.exceptions import CircuitOpenError, RateLimitExceeded
+from flask_consulate.health import HealthQuery, HealthWatcher
+from flask_consulate.hedging import HedgePolicy, HEDGE_METHODS
+from flask_consulate.instrumentation import get_instrumentation
+from flask_consulate.locality import Locality
+from flask_consulate.ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+RESOLVE_ERRORS = (DNSException, EnvironmentError)
+
+
+def _close_response(future):
+    """
+    Release the connection of the losing request of a hedged pair
+    """
+    if future.exception() is None:
+        future.result().close()
+
+
+class ResolutionCache(object):
+    """
+    Keeps the endpoints of the last SRV answer for the lifetime of the
+    record, so that not every request has to query the DNS server.
+
+    The TTL advertised by consul is clamped to [min_ttl, max_ttl]; consul
+    advertises a TTL of 0 for services unless configured otherwise. Expired
+    answers are kept for another stale_ttl seconds to fall back on if the
+    DNS server can't be reached.
+
+    Endpoints are stored as an immutable tuple of Endpoint records that is
+    swapped as a whole, so readers never see a partially updated endpoint
+    list. The tuple is only replaced when an answer is stored, and records
+    that didn't change are carried over into the new tuple.
+    """
+
+    def __init__(self, min_ttl=1, max_ttl=60, stale_ttl=300):
+        """
+        :param min_ttl: minimum number of seconds to keep an answer
+        :param max_ttl: maximum number of seconds to keep an answer
+        :param stale_ttl: number of seconds an expired answer may still be
+            served when re-resolving fails
+        """
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._entry = None
+
+    def get(self):
+        """
+        :return: tuple of cached endpoints, or None if the cache is empty
+            or expired
+        """
+        entry = self._entry
+        if entry is not None and monotonic() < entry[1]:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def get_stale(self):
+        """
+        :return: tuple of cached endpoints, including expired ones that are
+            still within stale_ttl, or None
+        """
+        entry = self._entry
+        if entry is not None and monotonic() < entry[1] + self.stale_ttl:
+            self.stale_hits += 1
+            return entry[0]
+        return None
+
+    def set(self, endpoints, ttl, clamp=True):
+        """
+        :param endpoints: list of Endpoints, or dicts of their fields, to
+            cache
+        :param ttl: TTL of the record the endpoints were resolved from
+        :param clamp: clamp ttl to [min_ttl, max_ttl]; answers pushed by a
+            watcher stay valid until its next update is due instead
+        :return: tuple of cached endpoints
+        """
+        if clamp:
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        entry = self._entry
+        self._entry = (
+            carry_over(endpoints, entry[0] if entry else None),
+            monotonic() + ttl,
+        )
+        return self._entry[0]
+
+    def remaining(self):
+        """
+        :return: number of seconds until the cached answer expires
+        """
+        entry = self._entry
+        if entry is None:
+            return 0
+        return max(entry[1] - monotonic(), 0)
+
+    def invalidate(self, endpoint=None):
+        """
+        Drop a single endpoint from the cache, or the whole cache if no
+        endpoint is given. Dropping the last endpoint empties the cache.
+
+        :param endpoint: endpoint record to drop
+        """
+        entry = self._entry
+        if entry is None:
+            return
+        if endpoint is None:
+            self._entry = None
+            return
+        remaining = tuple(e for e in entry[0] if e.url != endpoint.url)
+        self._entry = (remaining, entry[1]) if remaining else None
+
+
+class EndpointRefresher(threading.Thread):
+    """
+    Daemon thread that re-resolves the endpoints of a ConsulService before
+    the cached answer expires, so that requests never wait for DNS.
+    """
+
+    def __init__(self, service, ahead=0.25, retry_interval=1):
+        """
+        :param service: ConsulService instance to refresh
+        :param ahead: fraction of the TTL before expiry at which to refresh
+        :param retry_interval: seconds to wait after a failed refresh
+        """
+        super(EndpointRefresher, self).__init__(
+            name='consul-refresh-{}'.format(service.service)
+        )
+        self.daemon = True
+        self.service = service
+        self.ahead = ahead
+        self.retry_interval = retry_interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        wait = self.service.cache.remaining() * (1 - self.ahead)
+        while not self._stopped.wait(wait):
+            try:
+                ttl = self.service._refresh()
+            except RESOLVE_ERRORS:
+                logger.warning(
+                    "Couldn't refresh endpoints of %s, serving stale ones",
+                    self.service.service, exc_info=True,
+                )
+                wait = self.retry_interval
+            else:
+                wait = ttl * (1 - self.ahead)
+
+
+class EndpointPools(object):
+    """
+    Mounts a dedicated HTTPAdapter, and so a dedicated connection pool, per
+    endpoint on a requests.Session. Pools of endpoints that dropped out of
+    the SRV answer are closed and unmounted, and pools that weren't used for
+    idle_timeout seconds are closed, so long-lived workers don't accumulate
+    sockets.
+
+    Other threads iterate session.adapters on every request, so it is never
+    changed in place: adapters are mounted and unmounted on a copy that
+    then replaces it.
+    """
+
+    def __init__(self, session, maxsize=10, block=False, idle_timeout=None):
+        """
+        :param session: requests.Session to mount the adapters on
+        :param maxsize: maximum number of connections kept per endpoint
+        :param block: wait for a free connection when maxsize connections
+            are in use, instead of opening an extra one that isn't kept
+        :param idle_timeout: seconds after which the connections of an
+            unused endpoint are closed, or None
+        """
+        self.session = session
+        self.maxsize = maxsize
+        self.block = block
+        self.idle_timeout = idle_timeout
+        # endpoint url -> [HTTPAdapter, last time used]
+        self.adapters = {}
+        self._lock = threading.Lock()
+
+    def use(self, url):
+        """
+        Mount the adapter of the endpoint at url if it isn't yet, and mark
+        it as used
+        """
+        entry = self.adapters.get(url)
+        if entry is None:
+            with self._lock:
+                entry = self.adapters.get(url)
+                if entry is None:
+                    adapter = HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=self.maxsize,
+                        pool_block=self.block,
+                    )
+                    self._remount(mount=(url.rstrip('/') + '/', adapter))
+                    entry = self.adapters[url] = [adapter, 0]
+        entry[1] = monotonic()
+
+    def prune(self, endpoints):
+        """
+        Close and unmount the adapters of endpoints that are gone, and close
+        the connections of idle ones
+
+        :param endpoints: endpoint records that are still advertised
+        """
+        current = set(e.url for e in endpoints)
+        now = monotonic()
+        with self._lock:
+            gone = []
+            for url, (adapter, last_used) in list(self.adapters.items()):
+                if url not in current:
+                    del self.adapters[url]
+                    gone.append((url.rstrip('/') + '/', adapter))
+                elif self.idle_timeout is not None and \
+                        now - last_used > self.idle_timeout:
+                    adapter.close()
+            if gone:
+                self._remount(unmount=[prefix for prefix, _ in gone])
+        for _, adapter in gone:
+            adapter.close()
+
+    def _remount(self, mount=None, unmount=()):
+        """
+        Replace session.adapters with a copy with the (prefix, adapter) of
+        mount added, in the order requests.Session.mount keeps, and the
+        prefixes in unmount removed. Called with self._lock held.
+        """
+        adapters = OrderedDict(self.session.adapters)
+        for prefix in unmount:
+            adapters.pop(prefix, None)
+        if mount is not None:
+            prefix, adapter = mount
+            adapters[prefix] = adapter
+            # longer prefixes are matched first
+            for key in [k for k in adapters if len(k) < len(prefix)]:
+                adapters[key] = adapters.pop(key)
+        self.session.adapters = adapters
 
 
 class ConsulService(object):
@@ -25,58 +289,451 @@ class ConsulService(object):
         # Set the DNS nameserver to the default docker0 bridge ip
     cs = ConsulService("consul://tag.FOO.server", nameservers=['172.17.42.1'])
 
-        # returns a random choice from the DNS-advertised routes
+        # returns one of the DNS-advertised routes, chosen in turn
         # in our case, either http://10.1.1.1:8001 or http://10.1.1.2:8002
+        # The routes are cached for the TTL of the SRV record
     cs.base_url
 
+        # Resolve passing instances in dc2 through the health API instead of
+        # DNS; a background blocking query pushes every change
+    cs = ConsulService("consul://tag.FOO.service",
+                       health={'datacenter': 'dc2', 'node_meta': {'zone': 'a'}})
+
+        # Prefer instances in the same zone as this node, and only use other
+        # zones if fewer than 2 are available; see flask_consulate.locality
+    cs = ConsulService("consul://tag.FOO.service", health=True,
+                       locality={'min_endpoints': 2})
+
+        # Choose routes by SRV weight instead; see flask_consulate.balancers
+        # for the available strategies
+    cs = ConsulService("consul://tag.FOO.service", balancer='weighted_random')
+
+        # Keep resolved routes for at least 5 and at most 30 seconds
+    cs = ConsulService("consul://tag.FOO.service", min_ttl=5, max_ttl=30)
+
+        # Re-resolve routes in a background thread before they expire, and
+        # keep serving the last known routes for 10 minutes if that fails
+    cs = ConsulService("consul://tag.FOO.service", refresh=True, stale_ttl=600)
+
         # send an http-get to base_url+'/v1/status', re-resolving and
         # re-retrying if that connection failed
     cs.get('/v1/status')
 
+        # Also retry on 503, for at most 2 seconds in total
+    cs = ConsulService("consul://tag.FOO.service",
+                       retry_policy={'status_codes': [503], 'deadline': 2})
+
+        # Don't retry this particular request
+    cs.post('/v1/status', retry_policy={'max_tries': 1})
+
+        # Keep up to 50 connections per endpoint, and close the connections
+        # to endpoints that weren't used for 5 minutes
+    cs = ConsulService("consul://tag.FOO.service", pool_maxsize=50,
+                       pool_idle_timeout=300)
+
+        # If a GET hasn't been answered after the 95th percentile of observed
+        # latencies, send it to a second endpoint as well, for at most 5% of
+        # the requests
+    cs = ConsulService("consul://tag.FOO.service",
+                       hedge={'delay': 0.1, 'percentile': 95, 'budget': 0.05})
+
+        # Send at most 100 requests per second and 20 at once, waiting up to
+        # half a second for a slot before failing with RateLimitExceeded,
+        # and adapt the number of requests in flight per endpoint to 503s
+    cs = ConsulService("consul://tag.FOO.service",
+                       rate_limit={'rate': 100, 'concurrency': 20,
+                                   'timeout': 0.5,
+                                   'per_endpoint': {'adaptive': True}})
+
         #Subsequent http requests will now have the "X-Added" header
     cs.session.headers.update({"X-Added": "Value"})
     cs.post('/v1/status')
     """
-    def __init__(self, service_uri, nameservers=None):
+    def __init__(self, service_uri, nameservers=None, min_ttl=1, max_ttl=60,
+                 balancer='round_robin', refresh=False, stale_ttl=300,
+                 retry_policy=None, circuit_breaker=None,
+                 failure_status_codes=(502, 503, 504), pool_maxsize=10,
+                 pool_block=False, pool_idle_timeout=None, hedge=None,
+                 hedge_workers=32, instrumentation=None, health=None,
+                 locality=None, rate_limit=None):
         """
         :param service_uri: string formatted service identifier
             (consul://production.solr_service.consul)
         :param nameservers: use custom nameservers
         :type nameservers: list
+        :param min_ttl: minimum number of seconds to cache resolved endpoints
+        :param max_ttl: maximum number of seconds to cache resolved endpoints
+        :param balancer: strategy to choose an endpoint per request; the name
+            of one of flask_consulate.balancers.BALANCERS, or a Balancer
+        :param refresh: re-resolve endpoints in a background thread before
+            they expire. The thread is started on first use.
+        :param stale_ttl: number of seconds expired endpoints may still be
+            used when re-resolving fails
+        :param retry_policy: RetryPolicy, or dict of RetryPolicy arguments,
+            for requests to the service
+        :param circuit_breaker: dict of CircuitBreaker arguments for the
+            breakers kept per endpoint
+        :param failure_status_codes: HTTP status codes that count as a
+            failure of the endpoint for its circuit breaker
+        :param pool_maxsize: maximum number of connections kept per endpoint
+        :param pool_block: block when pool_maxsize connections to an endpoint
+            are in use, instead of opening extra connections
+        :param pool_idle_timeout: seconds after which the connections to an
+            endpoint that isn't used are closed, or None
+        :param hedge: HedgePolicy, or dict of HedgePolicy arguments, to send
+            a second request to another endpoint when a GET, HEAD or OPTIONS
+            request is slow
+        :param hedge_workers: number of threads hedged requests run in
+        :param instrumentation: Instrumentation receiving the resolve,
+            request, retry and endpoint churn metrics
+        :param health: dict of HealthQuery arguments, or True for the
+            defaults, to resolve the passing instances through consul's
+            health API instead of DNS. The tag, name and datacenter default
+            to those in service_uri. Endpoints are then kept up to date by a
+            background blocking query, and requests never wait for them
+            unless it stalls.
+        :param locality: Locality, or dict of Locality arguments, to prefer
+            endpoints on the same node, in the same zone or near by network
+            coordinates
+        :param rate_limit: RateLimiter, or dict of RateLimiter arguments, to
+            limit the rate and concurrency of requests to the service and
+            to each endpoint
         """
         assert service_uri.startswith('consul://'), "Invalid consul service URI"
         self.service_uri = service_uri
         self.service = service_uri.replace('consul://', '')
         self.resolver = Resolver()
-        self.session = requests.Session()
+        self.cache = ResolutionCache(
+            min_ttl=min_ttl, max_ttl=max_ttl, stale_ttl=stale_ttl,
+        )
+        self.balancer = get_balancer(balancer)
+        self.refresh = refresh
+        self._refresher = None
+        # concurrent first requests would each start a refresher otherwise
+        self._refresher_lock = threading.Lock()
+        self.retry_policy = get_retry_policy(retry_policy)
+        self.breakers = BreakerRegistry(**(circuit_breaker or {}))
+        self.failure_status_codes = frozenset(failure_status_codes)
+        self._init_session(pool_maxsize, pool_block, pool_idle_timeout)
+        if isinstance(hedge, dict):
+            hedge = HedgePolicy(**hedge)
+        self.hedge = hedge
+        self.hedge_workers = hedge_workers
+        self._executor = None
+        self.instrumentation = get_instrumentation(instrumentation)
+        if health is not None and health is not False:
+            health = HealthQuery(
+                self.service, **(health if isinstance(health, dict) else {})
+            )
+            self.refresh = True
+        else:
+            health = None
+        self.health = health
+        if isinstance(locality, dict):
+            locality = Locality(**locality)
+        self.locality = locality
+        # (endpoints, their locality tiers, the choice among all of them)
+        # of the last ranking
+        self._ranked = None
+        if isinstance(rate_limit, dict):
+            rate_limit = RateLimiter(**rate_limit)
+        self.rate_limit = rate_limit
         if nameservers is not None:
             self.resolver.nameservers = nameservers
 
+    def _init_session(self, pool_maxsize, pool_block, pool_idle_timeout):
+        """
+        Create the requests.Session requests are sent through, and its
+        connection pools
+        """
+        self.session = requests.Session()
+        self.pools = EndpointPools(
+            self.session, maxsize=pool_maxsize, block=pool_block,
+            idle_timeout=pool_idle_timeout,
+        )
+
     def _resolve(self):
         """
         Query the consul DNS server for the service IP and port
+
+        :return: tuple of (list of endpoint records, TTL of the SRV record)
         """
-        endpoints = {}
-        r = self.resolver.query(self.service, 'SRV')
-        for rec in r.response.additional:
-            name = rec.name.to_text()
-            addr = rec.items[0].address
-            endpoints[name] = {'addr': addr}
-        for rec in r.response.answer[0].items:
-            name = '.'.join(rec.target.labels)
-            endpoints[name]['port'] = rec.port
-        return [
-            'http://{ip}:{port}'.format(
-                ip=v['addr'], port=v['port']
-            ) for v in endpoints.values()
-        ]
+        start = monotonic() if self.instrumentation.enabled else None
+        if self.health is not None:
+            # the watcher's next answer is due any moment
+            resolved = self.health.fetch()[0], 0
+        else:
+            r = self.resolver.query(self.service, 'SRV')
+            resolved = self._parse_srv(r.response)
+        if start is not None:
+            self._observe_resolve(start)
+        return resolved
+
+    def _observe_resolve(self, start):
+        self.instrumentation.observe(
+            'resolve_seconds', monotonic() - start, {'service': self.service},
+        )
+
+    @staticmethod
+    def _parse_srv(response):
+        """
+        :param response: dns.message.Message answering a SRV query
+        :return: tuple of (list of endpoint records, TTL of the SRV record)
+        """
+        addresses = dict(
+            (rec.name.to_text(), rec.items[0].address)
+            for rec in response.additional
+        )
+        endpoints = []
+        for rec in response.answer[0].items:
+            name = rec.target.to_text()
+            # consul names targets <node>.node.<datacenter>.<domain> unless
+            # the service has an address of its own
+            labels = name.split('.')
+            node = labels[0] if len(labels) > 2 and labels[1] == 'node' \
+                else None
+            endpoints.append(Endpoint(
+                addresses[name], rec.port, weight=rec.weight,
+                priority=rec.priority, node=node,
+            ))
+        return endpoints, response.answer[0].ttl
+
+    def _refresh(self):
+        """
+        Re-resolve the endpoints and store them in the cache
+
+        :return: number of seconds the new answer is cached for
+        """
+        endpoints, ttl = self._resolve()
+        self._store(endpoints, ttl)
+        return self.cache.remaining()
+
+    def _store(self, endpoints, ttl, clamp=True):
+        """
+        Cache newly resolved endpoints and prune the connection pools of
+        endpoints that are gone
+
+        :return: tuple of cached endpoints
+        """
+        hooks = self.instrumentation
+        if hooks.enabled:
+            entry = self.cache._entry
+            before = set(e.url for e in entry[0]) if entry else set()
+        endpoints = self.cache.set(endpoints, ttl, clamp=clamp)
+        if self.pools is not None:
+            self.pools.prune(endpoints)
+        if self.locality is not None:
+            self.locality.update()
+            self._ranked = None
+        if hooks.enabled:
+            after = set(e.url for e in endpoints)
+            for change, urls in (('added', after - before),
+                                 ('removed', before - after)):
+                if urls:
+                    hooks.increment('endpoint_churn', len(urls), {
+                        'service': self.service, 'change': change,
+                    })
+        return endpoints
+
+    def start_refresh(self):
+        """
+        Start the background thread that keeps the endpoints fresh
+        """
+        self.refresh = True
+        with self._refresher_lock:
+            if self._refresher is None or not self._refresher.is_alive():
+                if self.health is not None:
+                    self._refresher = HealthWatcher(self, self.health)
+                else:
+                    self._refresher = EndpointRefresher(self)
+                self._refresher.start()
+
+    def stop_refresh(self):
+        """
+        Stop the background refresh thread, if running
+        """
+        self.refresh = False
+        with self._refresher_lock:
+            if self._refresher is not None:
+                self._refresher.stop()
+                self._refresher = None
+
+    def _refreshing(self):
+        """
+        :return: whether a background thread keeps the endpoints fresh
+        """
+        refresher = self._refresher
+        return refresher is not None and refresher.is_alive()
+
+    @property
+    def endpoints(self):
+        """
+        tuple of Endpoint records, served from the cache while the SRV record
+        is still valid and re-resolved otherwise. If re-resolving fails,
+        expired endpoints are served for up to stale_ttl seconds.
+
+        While a refresher is running, expired endpoints are served without
+        re-resolving, which is left to the refresher; they are only
+        re-resolved here once they are older than stale_ttl, too.
+        """
+        endpoints = self.cache.get()
+        if endpoints is None and self._refreshing():
+            endpoints = self.cache.get_stale()
+        if endpoints is None:
+            try:
+                endpoints, ttl = self._resolve()
+            except RESOLVE_ERRORS:
+                endpoints = self.cache.get_stale()
+                if endpoints is None:
+                    raise
+                logger.warning(
+                    "Couldn't resolve %s, serving stale endpoints",
+                    self.service, exc_info=True,
+                )
+            else:
+                endpoints = self._store(endpoints, ttl)
+        if self.refresh and self._refresher is None:
+            self.start_refresh()
+        return endpoints
+
+    def _select(self, endpoints):
+        """
+        :param endpoints: endpoint records to choose from
+        :return: the endpoint record chosen by self.balancer among the ones
+            whose circuit breaker isn't open
+        """
+        if not self.breakers.unclosed:
+            # every breaker is closed, so the balancer can choose from the
+            # cached tuple itself, and whatever it precomputed for it
+            available = endpoints
+        else:
+            available = [
+                e for e in endpoints
+                if self.breakers.get(e.url).available()
+            ]
+            if not available:
+                raise CircuitOpenError(
+                    'Circuit breakers of all endpoints of {} are open'.format(self.service)
+                )
+        if self.locality is not None:
+            available = self._localize(endpoints, available)
+        return self.balancer.select(available)
+
+    def _localize(self, endpoints, available):
+        """
+        :return: the available endpoints of the closest usable locality tier
+        """
+        ranked = self._ranked
+        if ranked is None or ranked[0] is not endpoints:
+            # endpoints is a new tuple whenever the cache changed
+            tiers = self.locality.rank(endpoints)
+            ranked = self._ranked = (
+                endpoints, tiers, self.locality.choose(tiers, endpoints),
+            )
+        if available is endpoints:
+            tier, available = ranked[2]
+        else:
+            tier, available = self.locality.choose(ranked[1], available)
+        if not available:
+            raise CircuitOpenError(
+                'No endpoint of {} available within tier {}'.format(
+                    self.service, self.locality.max_tier,
+                )
+            )
+        if self.instrumentation.enabled:
+            self.instrumentation.increment('locality_requests', 1, {
+                'service': self.service, 'tier': tier,
+            })
+        return available
 
     @property
     def base_url(self):
         """
-        get the next endpoint from self.endpoints
+        get the next endpoint from self.endpoints, as chosen by self.balancer,
+        skipping endpoints whose circuit breaker is open
+        """
+        return self._select(self.endpoints).url
+
+    def _begin_request(self, endpoints, timeout=None):
+        """
+        Choose the endpoint for a request and claim its circuit breaker and
+        rate limits
+
+        :param endpoints: endpoint records to choose from
+        :param timeout: seconds to wait for the rate limits, defaulting to
+            the timeout of self.rate_limit
+        :return: tuple of (endpoint record, its CircuitBreaker, start time)
+        """
+        target = self._select(endpoints)
+        breaker = self.breakers.get(target.url)
+        if not breaker.allow():
+            raise CircuitOpenError(
+                'Circuit breaker of {} is open'.format(target.url)
+            )
+        if self.rate_limit is not None:
+            try:
+                self._acquire(target, timeout)
+            except RateLimitExceeded:
+                breaker.release()
+                raise
+        self.balancer.on_start(target)
+        return target, breaker, monotonic()
+
+    def _acquire(self, target, timeout):
+        """
+        Claim the rate limits for a request to target
+        """
+        hooks = self.instrumentation
+        start = monotonic() if hooks.enabled else None
+        try:
+            self.rate_limit.acquire(target.url, timeout)
+        except RateLimitExceeded:
+            if start is not None:
+                hooks.increment('rate_limited', 1, {'service': self.service})
+            raise
+        if start is not None:
+            hooks.observe('rate_limit_wait_seconds', monotonic() - start,
+                          {'service': self.service})
+
+    def _finish_request(self, target, breaker, start, status_code):
+        """
+        Record a request that got a response
+        """
+        elapsed = monotonic() - start
+        if self.rate_limit is not None:
+            self.rate_limit.release(target.url, elapsed, status_code)
+        self.balancer.on_finish(target, elapsed)
+        if self.instrumentation.enabled:
+            self._observe_request(target, elapsed, status_code)
+        if status_code in self.failure_status_codes:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+            if self.hedge is not None:
+                self.hedge.observe(elapsed)
+
+    def _fail_request(self, target, breaker, start, connection_error):
+        """
+        Record a request that raised an exception
+
+        :param connection_error: whether the endpoint couldn't be reached
         """
-        return self._resolve().pop()
+        elapsed = monotonic() - start
+        if self.rate_limit is not None:
+            self.rate_limit.release(target.url, elapsed, 'error')
+        self.balancer.on_finish(target, elapsed, failed=True)
+        if self.instrumentation.enabled:
+            self._observe_request(target, elapsed, 'error')
+        breaker.record_failure()
+        if connection_error:
+            # Don't hand out this endpoint again until it is re-resolved
+            self.cache.invalidate(target)
+
+    def _observe_request(self, target, elapsed, status):
+        self.instrumentation.observe('request_seconds', elapsed, {
+            'service': self.service, 'endpoint': target.url,
+            'status': status,
+        })
 
     @with_retry_connections()
     def request(self, method, endpoint, **kwargs):
@@ -88,12 +745,86 @@ class ConsulService(object):
         :return:
         """
         kwargs.setdefault('timeout', (1, 30))
-        return self.session.request(
-            method,
-            urljoin(self.base_url, endpoint),
-            **kwargs
+        endpoints = self.endpoints
+        if self.hedge is not None and method.upper() in HEDGE_METHODS:
+            return self._hedged_send(method, endpoint, endpoints, kwargs)
+        return self._send(
+            self._begin_request(endpoints), method, endpoint, kwargs
         )
 
+    def _send(self, begun, method, endpoint, kwargs):
+        """
+        Send a request to the endpoint chosen by _begin_request
+
+        :param begun: tuple returned by _begin_request
+        :return: requests.Response
+        """
+        target, breaker, start = begun
+        self.pools.use(target.url)
+        try:
+            response = self.session.request(
+                method,
+                urljoin(target.url, endpoint),
+                **kwargs
+            )
+        except Exception as e:
+            self._fail_request(
+                target, breaker, start, isinstance(e, ConnectionError)
+            )
+            raise
+        self._finish_request(target, breaker, start, response.status_code)
+        return response
+
+    @property
+    def executor(self):
+        """
+        ThreadPoolExecutor that hedged requests run in, created on first use
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.hedge_workers)
+        return self._executor
+
+    def _hedged_send(self, method, endpoint, endpoints, kwargs):
+        """
+        Send a request, and if it hasn't been answered within the hedge
+        delay, a second one to another endpoint. The first successful
+        response wins; the other one is closed once it arrives, as a
+        request in flight can't be aborted.
+
+        :return: requests.Response
+        """
+        self.hedge.earn()
+        begun = self._begin_request(endpoints)
+        delay = self.hedge.hedge_delay()
+        if delay is None:
+            return self._send(begun, method, endpoint, kwargs)
+
+        pending = [self.executor.submit(
+            self._send, begun, method, endpoint, kwargs
+        )]
+        done, _ = wait(pending, timeout=delay)
+        others = [e for e in endpoints if e.url != begun[0].url]
+        if not done and others and self.hedge.spend():
+            try:
+                # a hedge that can't start right away isn't worth waiting for
+                pending.append(self.executor.submit(
+                    self._send, self._begin_request(others, timeout=0),
+                    method, endpoint, kwargs,
+                ))
+            except (CircuitOpenError, RateLimitExceeded):
+                pass
+
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.add_done_callback(_close_response)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
     def get(self, endpoint, **kwargs):
         return self.request('GET', endpoint, **kwargs)
 
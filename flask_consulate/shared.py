@@ -0,0 +1,121 @@
+# coding: utf-8
+
+import os
+import mmap
+import time
+import pickle
+import struct
+import tempfile
+
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+from flask_consulate.snapshot import replace
+
+SEGMENT_MAGIC = b'FCSC'
+SEGMENT_VERSION = 1
+# magic, format version, time written, payload length
+SEGMENT_HEADER = struct.Struct('>4sHdQ')
+
+
+class SharedConfig(object):
+    """
+    Parsed remote config shared between the forked workers of a pre-fork
+    server (gunicorn, uWSGI) through a memory-mapped file.
+
+    The first process to take the lock fetches the config from consul and
+    writes it; every other process waiting on the lock then maps the file
+    and unpickles the config instead of querying consul itself. The file is
+    created readable by its owner only, and must live in a directory that
+    only the user running the service can write to.
+    """
+
+    def __init__(self, path, max_age=60):
+        """
+        :param path: path of the shared file; a lock file is created next to it
+        :param max_age: number of seconds a shared config is used for before
+            the next process to attach fetches it again
+        """
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.max_age = max_age
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read(self, namespace):
+        """
+        :param namespace: kv namespace/directory the config must be of
+        :return: the shared payload, or None if there is no fresh one
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            if len(segment) < SEGMENT_HEADER.size:
+                return None
+            magic, version, written, length = \
+                SEGMENT_HEADER.unpack_from(segment)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or \
+                    time.time() - written > self.max_age:
+                return None
+            payload = pickle.loads(
+                segment[SEGMENT_HEADER.size:SEGMENT_HEADER.size + length]
+            )
+        finally:
+            segment.close()
+        if payload.get('namespace') != namespace:
+            return None
+        return payload
+
+    def write(self, payload):
+        """
+        Atomically replace the shared file
+
+        :param payload: dict holding at least the 'namespace' key
+        """
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.consul-shared-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(SEGMENT_HEADER.pack(
+                    SEGMENT_MAGIC, SEGMENT_VERSION, time.time(), len(data)
+                ))
+                f.write(data)
+            replace(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def fetch(self, namespace, fetch):
+        """
+        Return the shared payload of namespace, calling fetch to create it
+        if no fresh one exists. Only one process at a time calls fetch.
+
+        :param namespace: kv namespace/directory
+        :param fetch: callable returning a new payload
+        :return: tuple of (payload, whether this process fetched it)
+        """
+        with self._locked():
+            payload = self.read(namespace)
+            if payload is not None:
+                return payload, False
+            payload = fetch()
+            self.write(payload)
+            return payload, True
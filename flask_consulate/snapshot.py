@@ -0,0 +1,77 @@
+# coding: utf-8
+
+import os
+import json
+import time
+import tempfile
+
+SNAPSHOT_VERSION = 1
+
+# os.rename can't overwrite an existing file on windows
+replace = getattr(os, 'replace', os.rename)
+
+
+class ConfigSnapshot(object):
+    """
+    On-disk copy of the raw kv records of a namespace, so that workers can
+    start from the last known config without waiting for consul.
+
+    The file is a json document with a header holding the format version,
+    the namespace, the X-Consul-Index the records were fetched at and the
+    time they were written. Snapshots with a different format version or
+    namespace, or older than max_age, are rejected.
+    """
+
+    def __init__(self, path, max_age=None):
+        """
+        :param path: path of the snapshot file
+        :param max_age: maximum age in seconds of a usable snapshot, or None
+        """
+        self.path = path
+        self.max_age = max_age
+
+    def write(self, namespace, index, records):
+        """
+        Atomically replace the snapshot file
+
+        :param namespace: kv namespace/directory the records were fetched from
+        :param index: X-Consul-Index the records were fetched at
+        :param records: list of raw kv records
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.consul-snapshot-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'version': SNAPSHOT_VERSION,
+                    'namespace': namespace,
+                    'index': index,
+                    'written': time.time(),
+                    'records': records,
+                }, f)
+                f.flush()
+                os.fsync(f.fileno())
+            replace(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def read(self, namespace):
+        """
+        :param namespace: kv namespace/directory the snapshot must be of
+        :return: tuple of (list of raw kv records, X-Consul-Index), or None
+            if there is no usable snapshot
+        """
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(snapshot, dict) or \
+                snapshot.get('version') != SNAPSHOT_VERSION or \
+                snapshot.get('namespace') != namespace:
+            return None
+        if self.max_age is not None and \
+                time.time() - snapshot.get('written', 0) > self.max_age:
+            return None
+        return snapshot['records'], snapshot['index']
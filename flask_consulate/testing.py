@@ -0,0 +1,907 @@
+# coding: utf-8
+"""
+In-process fake consul agent for tests and load tests, speaking the real
+HTTP and DNS protocols over sockets on localhost.
+
+    with FakeConsul() as fake:
+        fake.set_kv('config/service/env/DEBUG', True)
+        fake.serve('api', instances=2, tags=['v1'])
+
+        consul = Consul(app, **fake.consul_kwargs)
+        consul.apply_remote_config('config/service/env/')
+
+        cs = fake.service('consul://v1.api.service.consul')
+        cs.get('/status')
+        fake.endpoints('api')[0].stop()    # fail over to the other instance
+
+It implements the parts of the consul API flask_consulate talks to: the kv
+store with modify indexes, blocking queries and transactions, sessions and
+kv locks, agent service and check registration, the health API and SRV
+lookups through DNS.
+"""
+
+import re
+import json
+import time
+import uuid
+import base64
+import binascii
+import random
+import socket
+import threading
+
+import dns.message
+import dns.rcode
+import dns.rrset
+
+from six import iteritems
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+except ImportError:  # Python2 compat
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+
+PASSING = 'passing'
+WARNING = 'warning'
+CRITICAL = 'critical'
+
+DURATION = re.compile(r'^(\d+(?:\.\d+)?)(ms|s|m|h)?$')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, None: 1}
+
+
+def parse_duration(value, default=300):
+    """
+    :param value: consul duration, e.g. '10s', '5m' or '100ms'
+    :return: number of seconds
+    """
+    match = DURATION.match(value or '')
+    if match is None:
+        return default
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def _lower_keys(payload):
+    """
+    consul accepts any casing of the keys of registration payloads
+    """
+    return dict((k.lower(), v) for k, v in iteritems(payload or {}))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately; don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=None, index=None, raw=False):
+        if raw:
+            data = body or b''
+        else:
+            data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream' if raw
+                         else 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if index is not None:
+            self.send_header('X-Consul-Index', str(index))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def handle_any(self):
+        url = urlparse(self.path)
+        query = dict(
+            (k, v[-1]) for k, v in iteritems(
+                parse_qs(url.query, keep_blank_values=True)
+            )
+        )
+        body = self.read_body()
+        try:
+            result = self.server.owner.dispatch(
+                self.command, unquote(url.path), query, body,
+            )
+        except Exception as e:
+            result = 500, repr(e)
+        if result is None:
+            self.close_connection = True
+            return
+        self.respond(*result)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = do_OPTIONS = handle_any
+
+
+def _serve(owner, host, port=0):
+    """
+    Start a threaded HTTP server dispatching to owner.dispatch
+    """
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    server.owner = owner
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class FakeEndpoint(object):
+    """
+    HTTP server standing in for one instance of a service. Answers every
+    request with 200 and a json body naming the endpoint, unless latency
+    or failures are injected.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.latency = 0
+        self.failure_rate = 0
+        # 'unavailable' answers 503, 'reset' drops the connection
+        self.failure_mode = 'unavailable'
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._server = _serve(self, host, port)
+        self.port = self._server.server_address[1]
+        self.running = True
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def dispatch(self, method, path, query, body):
+        with self._lock:
+            self.hits += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            if self.failure_mode == 'reset':
+                return None
+            return 503, {'error': 'injected failure'}
+        return 200, {'endpoint': self.url, 'method': method, 'path': path}
+
+    def stop(self):
+        """
+        Stop answering, so that connections to the endpoint are refused
+        """
+        if self.running:
+            self.running = False
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class FakeConsul(object):
+    """
+    Fake consul agent serving its HTTP API and DNS interface on localhost.
+    All state lives in memory; the attributes may be inspected and changed
+    by tests directly.
+    """
+
+    def __init__(self, host='127.0.0.1', node='node1', datacenter='dc1',
+                 node_meta=None, dns_ttl=0):
+        """
+        :param host: address to listen on
+        :param node: name of the node of the agent
+        :param datacenter: name of the datacenter of the agent
+        :param node_meta: dict of node metadata of the agent's node
+        :param dns_ttl: TTL of the SRV records served
+        """
+        self.host = host
+        self.node = node
+        self.datacenter = datacenter
+        self.dns_ttl = dns_ttl
+        # seconds to wait before answering HTTP and DNS requests
+        self.latency = 0
+        self.dns_latency = 0
+        # statuses to answer the next HTTP API requests with
+        self.errors = []
+        # raft index of the last write
+        self.index = 0
+        # key -> kv record, with the value as bytes
+        self.kv = {}
+        # deleted key -> index of its deletion, for blocking queries
+        self.tombstones = {}
+        # session id -> session, as returned by /v1/session/info
+        self.sessions = {}
+        # session id -> time its TTL runs out
+        self._session_expiry = {}
+        # node name -> {'Address': ..., 'Datacenter': ..., 'Meta': {...}}
+        self.nodes = {node: {
+            'Address': host, 'Datacenter': datacenter,
+            'Meta': dict(node_meta or {}),
+        }}
+        # node name -> network coordinate ({'Vec': [...], 'Error': ...,
+        # 'Adjustment': ..., 'Height': ...})
+        self.coordinates = {}
+        # service id -> service definition
+        self.services = {}
+        # check id -> check
+        self.checks = {}
+        self.health_index = 1
+        # service name -> FakeEndpoints started by serve()
+        self.backends = {}
+        # (method, path) of every HTTP API request, in order
+        self.requests = []
+        self._changed = threading.Condition()
+        self._server = None
+        self._dns = None
+
+    def start(self):
+        self._server = _serve(self, self.host)
+        self.http_port = self._server.server_address[1]
+        self._dns = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._dns.bind((self.host, 0))
+        self.dns_port = self._dns.getsockname()[1]
+        thread = threading.Thread(target=self._serve_dns)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        for endpoints in self.backends.values():
+            for endpoint in endpoints:
+                endpoint.stop()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._dns is not None:
+            self._dns.close()
+            self._dns = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, etype, value, traceback):
+        self.stop()
+
+    @property
+    def consul_kwargs(self):
+        """
+        Arguments for flask_consulate.Consul to talk to this agent
+        """
+        return {'consul_host': self.host, 'consul_port': self.http_port}
+
+    def service(self, service_uri, cls=None, **kwargs):
+        """
+        :param service_uri: consul://[tag.]name.service.consul
+        :param cls: ConsulService subclass to create
+        :return: ConsulService resolving through this agent's DNS interface
+        """
+        if cls is None:
+            from flask_consulate.service import ConsulService as cls
+        cs = cls(service_uri, nameservers=[self.host], **kwargs)
+        cs.resolver.port = self.dns_port
+        return cs
+
+    # State
+
+    def _write(self):
+        """
+        Bump the raft index and wake up blocking queries; call with
+        self._changed held
+        """
+        self.index += 1
+        self._changed.notify_all()
+        return self.index
+
+    def _block(self, current, index, wait):
+        """
+        Wait until current() returns more than index, for up to wait
+        seconds; call with self._changed held
+        """
+        deadline = time.time() + wait + random.uniform(0, wait / 16.0)
+        while current() <= index:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            # wake up now and then to expire sessions
+            self._changed.wait(min(remaining, 0.05))
+            self._expire_sessions()
+        return current()
+
+    def create_session(self, name='', ttl=None, behavior='release', node=None):
+        """
+        Create a session, as /v1/session/create does
+
+        :param ttl: seconds the session lives for unless renewed, or None
+        :param behavior: 'release' or 'delete' the keys it holds once it is
+            invalidated
+        :return: session id
+        """
+        with self._changed:
+            session_id = str(uuid.uuid4())
+            index = self._write()
+            self.sessions[session_id] = {
+                'ID': session_id, 'Name': name, 'Node': node or self.node,
+                'TTL': '{}s'.format(ttl) if ttl else '',
+                'Behavior': behavior, 'LockDelay': 15000000000,
+                'Checks': ['serfHealth'], 'CreateIndex': index,
+                'ModifyIndex': index,
+            }
+            if ttl:
+                self._session_expiry[session_id] = time.time() + ttl
+            return session_id
+
+    def destroy_session(self, session_id):
+        """
+        Invalidate a session, releasing or deleting the keys it holds
+        """
+        with self._changed:
+            return self._invalidate(session_id)
+
+    def _invalidate(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        self._session_expiry.pop(session_id, None)
+        if session is None:
+            return False
+        held = [k for k, r in iteritems(self.kv) if r.get('Session') == session_id]
+        if session['Behavior'] == 'delete':
+            for key in held:
+                self._delete(key)
+        elif held:
+            index = self._write()
+            for key in held:
+                self.kv[key].pop('Session')
+                self.kv[key]['ModifyIndex'] = index
+        return True
+
+    def _expire_sessions(self):
+        """
+        Invalidate the sessions whose TTL ran out; call with self._changed
+        held. Unlike consul, which waits up to twice the TTL, sessions
+        expire right at their TTL.
+        """
+        now = time.time()
+        for session_id, expiry in list(self._session_expiry.items()):
+            if expiry < now:
+                self._invalidate(session_id)
+
+    def _lock(self, key, session_id, value, flags=0):
+        record = self.kv.get(key)
+        holder = record.get('Session') if record else None
+        if holder is not None and holder != session_id:
+            return None
+        record = self._set(key, value, flags)
+        if holder is None:
+            record['LockIndex'] += 1
+            record['Session'] = session_id
+        return record
+
+    def _unlock(self, key, session_id, value, flags=0):
+        record = self.kv.get(key)
+        if record is None or record.get('Session') != session_id:
+            return None
+        record = self._set(key, value, flags)
+        record.pop('Session')
+        return record
+
+    def set_kv(self, key, value, flags=0):
+        """
+        Store value under key; bytes are stored as they are, anything else
+        serialized to json
+        """
+        if not isinstance(value, bytes):
+            value = json.dumps(value).encode('utf-8')
+        with self._changed:
+            return self._set(key, value, flags)
+
+    def _set(self, key, value, flags=0):
+        index = self._write()
+        record = self.kv.get(key)
+        if record is None:
+            record = self.kv[key] = {
+                'Key': key, 'CreateIndex': index, 'LockIndex': 0,
+            }
+        record.update(ModifyIndex=index, Flags=flags, Value=value)
+        self.tombstones.pop(key, None)
+        return record
+
+    def delete_kv(self, key, recurse=False):
+        with self._changed:
+            return self._delete(key, recurse)
+
+    def _delete(self, key, recurse=False):
+        keys = [k for k in self.kv if k.startswith(key)] if recurse \
+            else [key] if key in self.kv else []
+        if keys:
+            index = self._write()
+            for k in keys:
+                del self.kv[k]
+                self.tombstones[k] = index
+        return bool(keys)
+
+    def _kv_index(self, prefix):
+        indexes = [r['ModifyIndex'] for k, r in iteritems(self.kv)
+                   if k.startswith(prefix)]
+        indexes.extend(i for k, i in iteritems(self.tombstones)
+                       if k.startswith(prefix))
+        return max(indexes) if indexes else 1
+
+    @staticmethod
+    def _export(record, value=True):
+        exported = dict(record)
+        if value and record['Value'] is not None:
+            exported['Value'] = base64.b64encode(
+                record['Value']
+            ).decode('ascii')
+        elif not value:
+            exported.pop('Value')
+        return exported
+
+    def register(self, name, port, address=None, service_id=None, tags=(),
+                 meta=None, node=None, node_meta=None, status=PASSING):
+        """
+        Register an instance of a service in the catalog, as if its own
+        agent had done it, with a single check of the given status
+
+        :return: service id
+        """
+        node = node or self.node
+        with self._changed:
+            node_record = self.nodes.setdefault(node, {
+                'Address': address or self.host,
+                'Datacenter': self.datacenter, 'Meta': {},
+            })
+            if node_meta:
+                node_record['Meta'].update(node_meta)
+            service_id = self._register_service(node, {
+                'id': service_id, 'name': name, 'port': port,
+                'address': address, 'tags': list(tags), 'meta': meta,
+            })
+            self._register_check(node, {
+                'id': 'service:' + service_id, 'name': name,
+                'serviceid': service_id, 'status': status,
+            })
+            return service_id
+
+    def _register_service(self, node, payload):
+        payload = _lower_keys(payload)
+        service_id = payload.get('id') or payload['name']
+        self.services[service_id] = {
+            'ID': service_id,
+            'Service': payload['name'],
+            'Tags': list(payload.get('tags') or []),
+            'Address': payload.get('address') or '',
+            'Port': payload.get('port') or 0,
+            'Meta': dict(payload.get('meta') or {}),
+            'Node': node,
+        }
+        checks = list(payload.get('checks') or [])
+        if payload.get('check'):
+            checks.append(payload['check'])
+        for i, check in enumerate(checks):
+            check = _lower_keys(check)
+            check.setdefault('id', 'service:' + service_id +
+                             (':{}'.format(i + 1) if len(checks) > 1 else ''))
+            check.setdefault('name', 'Service ' + payload['name'])
+            check['serviceid'] = service_id
+            check.setdefault('status', CRITICAL)
+            self._register_check(node, check)
+        self.health_index = self._write()
+        return service_id
+
+    def deregister(self, service_id):
+        with self._changed:
+            return self._deregister_service(service_id)
+
+    def _deregister_service(self, service_id):
+        if self.services.pop(service_id, None) is None:
+            return False
+        for check_id, check in list(self.checks.items()):
+            if check['ServiceID'] == service_id:
+                del self.checks[check_id]
+        self.health_index = self._write()
+        return True
+
+    def _register_check(self, node, payload):
+        payload = _lower_keys(payload)
+        check_id = payload.get('checkid') or payload.get('id') or \
+            payload['name']
+        service_id = payload.get('serviceid') or ''
+        service = self.services.get(service_id)
+        self.checks[check_id] = {
+            'Node': node,
+            'CheckID': check_id,
+            'Name': payload.get('name') or check_id,
+            'Status': payload.get('status') or CRITICAL,
+            'Output': payload.get('output') or '',
+            'ServiceID': service_id,
+            'ServiceName': service['Service'] if service else '',
+            'TTL': payload.get('ttl'),
+        }
+        self.health_index = self._write()
+        return check_id
+
+    def set_check(self, check_id, status, output=''):
+        """
+        Update the status of a check
+
+        :return: whether the check exists
+        """
+        with self._changed:
+            check = self.checks.get(check_id)
+            if check is None:
+                return False
+            check.update(Status=status, Output=output)
+            self.health_index = self._write()
+            return True
+
+    def health(self, name, passing=False, tag=None, node_meta=None):
+        """
+        :return: list of health entries of the instances of service name,
+            as returned by /v1/health/service/<name>
+        """
+        entries = []
+        for service_id, service in sorted(self.services.items()):
+            if service['Service'] != name:
+                continue
+            if tag is not None and tag not in service['Tags']:
+                continue
+            node = self.nodes[service['Node']]
+            if node_meta and any(node['Meta'].get(k) != v
+                                 for k, v in iteritems(node_meta)):
+                continue
+            checks = [
+                dict(c) for c in self.checks.values()
+                if c['Node'] == service['Node'] and
+                c['ServiceID'] in ('', service_id)
+            ]
+            if passing and any(c['Status'] != PASSING for c in checks):
+                continue
+            entries.append({
+                'Node': {
+                    'Node': service['Node'], 'Address': node['Address'],
+                    'Datacenter': node['Datacenter'],
+                    'Meta': dict(node['Meta']),
+                },
+                'Service': dict(
+                    (k, v) for k, v in iteritems(service) if k != 'Node'
+                ),
+                'Checks': checks,
+            })
+        return entries
+
+    def serve(self, name, instances=1, tags=(), **kwargs):
+        """
+        Start instances FakeEndpoints and register them as service name
+
+        :param kwargs: further arguments for register()
+        :return: list of the FakeEndpoints
+        """
+        endpoints = []
+        for _ in range(instances):
+            endpoint = FakeEndpoint(self.host)
+            self.register(
+                name, endpoint.port, address=self.host, tags=tags,
+                service_id='{}-{}'.format(name, endpoint.port), **kwargs
+            )
+            endpoints.append(endpoint)
+        self.backends.setdefault(name, []).extend(endpoints)
+        return endpoints
+
+    def endpoints(self, name):
+        """
+        :return: list of FakeEndpoints started for service name
+        """
+        return self.backends.get(name, [])
+
+    def fail(self, status=500, count=1):
+        """
+        Answer the next count HTTP API requests with status
+        """
+        self.errors.extend([status] * count)
+
+    # HTTP API
+
+    def dispatch(self, method, path, query, body):
+        self.requests.append((method, path))
+        if self.latency:
+            time.sleep(self.latency)
+        if self.errors:
+            return self.errors.pop(0), {'error': 'injected failure'}
+        with self._changed:
+            self._expire_sessions()
+        parts = path.strip('/').split('/', 3)
+        if parts[:2] == ['v1', 'kv']:
+            key = path[len('/v1/kv/'):]
+            return self._http_kv(method, key, query, body)
+        route = '/'.join(parts[1:3])
+        arg = parts[3] if len(parts) > 3 else None
+        with self._changed:
+            if route == 'txn':
+                return self._http_txn(json.loads(body.decode('utf-8')))
+            if route.startswith('session/'):
+                return self._http_session(method, route, arg, body)
+            if route == 'status/leader':
+                return 200, '{}:8300'.format(self.host)
+            if route == 'agent/self':
+                return 200, {'Config': {
+                    'NodeName': self.node, 'Datacenter': self.datacenter,
+                }, 'Meta': self.nodes[self.node]['Meta']}
+            if route == 'coordinate/nodes':
+                return 200, [
+                    {'Node': n, 'Segment': '', 'Coord': c}
+                    for n, c in sorted(iteritems(self.coordinates))
+                ]
+            if route == 'agent/services':
+                return 200, dict(
+                    (k, dict((f, v) for f, v in iteritems(s) if f != 'Node'))
+                    for k, s in iteritems(self.services)
+                    if s['Node'] == self.node
+                )
+            if route == 'agent/checks':
+                return 200, dict(
+                    (k, c) for k, c in iteritems(self.checks)
+                    if c['Node'] == self.node
+                )
+            if route == 'agent/service' and method == 'PUT':
+                if arg == 'register':
+                    self._register_service(
+                        self.node, json.loads(body.decode('utf-8'))
+                    )
+                    return 200, None
+                if arg.startswith('deregister/'):
+                    found = self._deregister_service(arg.split('/', 1)[1])
+                    return (200, None) if found else (404, 'Unknown service')
+            if route == 'agent/check' and method == 'PUT':
+                return self._http_check(arg, query, body)
+            if route == 'health/service' and method == 'GET':
+                return self._http_health(arg, query)
+        return 404, 'Not found: {} {}'.format(method, path)
+
+    def _http_kv(self, method, key, query, body):
+        with self._changed:
+            if method == 'GET':
+                return self._http_kv_get(key, query)
+            if method == 'PUT' and ('acquire' in query or 'release' in query):
+                session_id = query.get('acquire') or query.get('release')
+                if session_id not in self.sessions:
+                    return 500, 'invalid session "{}"'.format(session_id)
+                lock = self._lock if 'acquire' in query else self._unlock
+                record = lock(key, session_id, body, int(query.get('flags') or 0))
+                return 200, record is not None
+            if method == 'PUT':
+                record = self.kv.get(key)
+                if 'cas' in query and int(query['cas']) != (
+                        record['ModifyIndex'] if record else 0):
+                    return 200, False
+                self._set(key, body, int(query.get('flags') or 0))
+                return 200, True
+            if method == 'DELETE':
+                record = self.kv.get(key)
+                if 'cas' in query and (record is None or
+                                       int(query['cas']) != record['ModifyIndex']):
+                    return 200, False
+                self._delete(key, recurse='recurse' in query)
+                return 200, True
+        return 405, 'Method not allowed'
+
+    def _http_kv_get(self, key, query):
+        recurse = 'recurse' in query or 'keys' in query
+        prefix = key if recurse else None
+
+        def current():
+            if recurse:
+                return self._kv_index(prefix)
+            record = self.kv.get(key)
+            return record['ModifyIndex'] if record else \
+                self.tombstones.get(key, 1)
+
+        index = current()
+        if query.get('index'):
+            index = self._block(
+                current, int(query['index']), parse_duration(query.get('wait')),
+            )
+        if 'keys' in query:
+            separator = query.get('separator')
+            keys = set()
+            for k in self.kv:
+                if not k.startswith(key):
+                    continue
+                if separator:
+                    position = k.find(separator, len(key))
+                    if position != -1:
+                        k = k[:position + len(separator)]
+                keys.add(k)
+            if not keys:
+                return 404, None, index
+            return 200, sorted(keys), index
+        if recurse:
+            records = [self._export(r) for k, r in sorted(self.kv.items())
+                       if k.startswith(key)]
+        else:
+            records = [self._export(self.kv[key])] if key in self.kv else []
+        if not records:
+            return 404, None, index
+        if 'raw' in query and not recurse:
+            return 200, self.kv[key]['Value'], index, True
+        return 200, records, index
+
+    def _http_txn(self, ops):
+        results = []
+        for i, op in enumerate(ops):
+            kv = op.get('KV') or {}
+            verb, key = kv.get('Verb'), kv.get('Key', '')
+            record = self.kv.get(key)
+            if verb == 'get':
+                if record is None:
+                    return 409, {'Results': None, 'Errors': [
+                        {'OpIndex': i, 'What': 'key "{}" doesn\'t exist'.format(key)},
+                    ]}
+                results.append({'KV': self._export(record)})
+            elif verb == 'get-tree':
+                results.extend(
+                    {'KV': self._export(r)} for k, r in sorted(self.kv.items())
+                    if k.startswith(key)
+                )
+            elif verb in ('set', 'cas'):
+                if verb == 'cas' and kv.get('Index', 0) != (
+                        record['ModifyIndex'] if record else 0):
+                    return 409, {'Results': None, 'Errors': [
+                        {'OpIndex': i, 'What': 'failed to set key "{}"'.format(key)},
+                    ]}
+                value = base64.b64decode(kv.get('Value') or '')
+                record = self._set(key, value, kv.get('Flags', 0))
+                results.append({'KV': self._export(record, value=False)})
+            elif verb in ('lock', 'unlock'):
+                session_id = kv.get('Session')
+                lock = self._lock if verb == 'lock' else self._unlock
+                value = base64.b64decode(kv.get('Value') or '')
+                record = lock(key, session_id, value, kv.get('Flags', 0)) \
+                    if session_id in self.sessions else None
+                if record is None:
+                    return 409, {'Results': None, 'Errors': [
+                        {'OpIndex': i, 'What': 'failed to {} key "{}"'.format(verb, key)},
+                    ]}
+                results.append({'KV': self._export(record, value=False)})
+            elif verb in ('delete', 'delete-tree'):
+                self._delete(key, recurse=verb == 'delete-tree')
+            else:
+                return 400, 'Unsupported txn verb {!r}'.format(verb)
+        return 200, {'Results': results, 'Errors': None}, self.index
+
+    def _http_session(self, method, route, arg, body):
+        action = route.split('/', 1)[1]
+        if action == 'create' and method == 'PUT':
+            payload = _lower_keys(json.loads(body.decode('utf-8') or '{}'))
+            ttl = payload.get('ttl')
+            session_id = self.create_session(
+                name=payload.get('name', ''),
+                ttl=parse_duration(ttl) if ttl else None,
+                behavior=payload.get('behavior') or 'release',
+                node=payload.get('node'),
+            )
+            return 200, {'ID': session_id}
+        if action == 'renew' and method == 'PUT':
+            session = self.sessions.get(arg)
+            if session is None:
+                return 404, 'Session id \'{}\' not found'.format(arg)
+            if arg in self._session_expiry:
+                self._session_expiry[arg] = time.time() + \
+                    parse_duration(session['TTL'])
+            return 200, [session]
+        if action == 'destroy' and method == 'PUT':
+            self._invalidate(arg)
+            return 200, True
+        if action == 'info' and method == 'GET':
+            session = self.sessions.get(arg)
+            return 200, [session] if session else []
+        if action == 'list' and method == 'GET':
+            return 200, list(self.sessions.values())
+        return 404, 'Not found'
+
+    def _http_check(self, arg, query, body):
+        action, _, check_id = (arg or '').partition('/')
+        if action == 'register':
+            self._register_check(self.node, json.loads(body.decode('utf-8')))
+            return 200, None
+        if action == 'deregister':
+            found = self.checks.pop(check_id, None) is not None
+            self.health_index = self._write()
+            return (200, None) if found else (404, 'Unknown check')
+        statuses = {'pass': PASSING, 'warn': WARNING, 'fail': CRITICAL}
+        if action in statuses:
+            status, output = statuses[action], query.get('note', '')
+        elif action == 'update':
+            payload = _lower_keys(json.loads(body.decode('utf-8') or '{}'))
+            status, output = payload.get('status'), payload.get('output', '')
+        else:
+            return 404, 'Not found'
+        check = self.checks.get(check_id)
+        if check is None:
+            return 404, 'Unknown check'
+        check.update(Status=status, Output=output)
+        self.health_index = self._write()
+        return 200, None
+
+    def _http_health(self, name, query):
+        if query.get('dc', self.datacenter) != self.datacenter:
+            return 500, 'No path to datacenter'
+        index = self.health_index
+        if query.get('index'):
+            index = self._block(
+                lambda: self.health_index, int(query['index']),
+                parse_duration(query.get('wait')),
+            )
+        node_meta = dict([query['node-meta'].split(':', 1)]) \
+            if 'node-meta' in query else None
+        return 200, self.health(
+            name, passing='passing' in query, tag=query.get('tag'),
+            node_meta=node_meta,
+        ), index
+
+    # DNS
+
+    def _serve_dns(self):
+        sock = self._dns
+        while True:
+            try:
+                data, addr = sock.recvfrom(4096)
+            except (OSError, socket.error, AttributeError):
+                return
+            try:
+                response = self._answer(dns.message.from_wire(data))
+            except Exception:
+                continue
+            if self.dns_latency:
+                time.sleep(self.dns_latency)
+            try:
+                sock.sendto(response.to_wire(), addr)
+            except (OSError, socket.error):
+                return
+
+    def _answer(self, query):
+        """
+        Answer [tag.]name.service[.dc].consul SRV queries with the passing
+        instances of the service
+        """
+        response = dns.message.make_response(query)
+        name = query.question[0].name
+        labels = name.to_text().rstrip('.').lower().split('.')
+        if 'service' not in labels:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            return response
+        i = labels.index('service')
+        tag = labels[i - 2] if i >= 2 else None
+        dc = labels[i + 1] if len(labels) > i + 2 else self.datacenter
+        with self._changed:
+            entries = self.health(labels[i - 1], passing=True, tag=tag) \
+                if dc == self.datacenter else []
+        if not entries:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            return response
+        srv, additional = [], {}
+        for entry in entries:
+            node = entry['Node']
+            address = entry['Service']['Address'] or node['Address']
+            # like consul, name targets after their node unless the service
+            # has an address of its own
+            if address == node['Address']:
+                target = '{}.node.{}.consul.'.format(node['Node'], self.datacenter)
+            else:
+                target = '{}.addr.{}.consul.'.format(
+                    binascii.hexlify(socket.inet_aton(address)).decode('ascii'),
+                    self.datacenter,
+                )
+            srv.append('1 1 {} {}'.format(entry['Service']['Port'], target))
+            additional[target] = dns.rrset.from_text(
+                target, self.dns_ttl, 'IN', 'A', address,
+            )
+        additional = list(additional.values())
+        response.answer.append(dns.rrset.from_text_list(
+            name, self.dns_ttl, 'IN', 'SRV', srv,
+        ))
+        response.additional.extend(additional)
+        return response
@@ -0,0 +1,95 @@
+# coding: utf-8
+
+import threading
+
+from requests.exceptions import RequestException
+
+from flask_consulate.decorators import RetryPolicy
+
+
+class KVWatcher(threading.Thread):
+    """
+    Daemon thread that long-polls a kv namespace using consul's blocking
+    queries and applies changed keys to the app config of a Consul instance.
+    """
+
+    def __init__(self, consul, namespace, callback=None, wait=300,
+                 prune=False, retry_interval=1, max_retry_interval=60):
+        """
+        :param consul: flask_consulate.Consul instance
+        :param namespace: kv namespace/directory to watch
+        :param callback: called with a ConfigDiff after every change;
+            exceptions it raises are logged
+        :param wait: maximum number of seconds a blocking query may wait
+        :param prune: remove keys that disappeared from the namespace from
+            the app config
+        :param retry_interval: seconds to wait after the first failed query;
+            doubled after every further failure, with jitter
+        :param max_retry_interval: maximum seconds to wait between failures
+        """
+        super(KVWatcher, self).__init__(
+            name='consul-watch-{}'.format(namespace)
+        )
+        self.daemon = True
+        self.consul = consul
+        self.namespace = namespace
+        self.callback = callback
+        self.wait = wait
+        self.prune = prune
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._backoff = RetryPolicy(
+            sleep=retry_interval, max_sleep=max_retry_interval,
+        )
+        self.index = 0
+        # shared with Consul.apply_remote_config, so keys it already applied
+        # are not applied again
+        self.indexes = consul.kv_indexes.setdefault(namespace, {})
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def poll(self):
+        """
+        Run a single blocking query and apply its changes
+
+        :return: ConfigDiff
+        """
+        records, index = self.consul._fetch_kv(
+            self.namespace, index=self.index, wait=self.wait,
+        )
+        diff = self.consul._apply_records(
+            self.namespace, records, self.indexes, prune=self.prune,
+            strict=False,
+        )
+        # consul may reset its index, e.g. after a snapshot restore, in
+        # which case the next query has to start over
+        self.index = index if index >= self.index else 0
+        if diff and self.callback is not None:
+            try:
+                self.callback(diff)
+            except Exception:
+                # the changes are applied; a broken callback must not stop
+                # the config from being kept in sync
+                self.consul.app.logger.error(
+                    "Callback of the watch of consul kv %r failed",
+                    self.namespace, exc_info=True,
+                )
+        return diff
+
+    def run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except RequestException:
+                failures += 1
+                delay = self._backoff.backoff(failures)
+                self.consul.app.logger.warning(
+                    "Couldn't watch consul kv %r, retrying in %ss",
+                    self.namespace, delay, exc_info=True,
+                )
+                self._stopped.wait(delay)
+            else:
+                failures = 0
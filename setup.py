@@ -28,6 +28,9 @@ INSTALL_REQUIRES = [
     dnspython,
 ]
 
+if sys.version_info[0] == 2:
+    INSTALL_REQUIRES.append('futures')
+
 TESTS_REQUIRE = [
     'httpretty',
     'mock',
@@ -62,6 +65,10 @@ setup(
     tests_require=TESTS_REQUIRE,
     extras_require={
         'test': TESTS_REQUIRE,
+        'async': ['aiohttp>=3.3'],
+        'msgpack': ['msgpack>=0.6'],
+        'yaml': ['PyYAML'],
+        'prometheus': ['prometheus_client'],
     },
     test_suite='tests',
 
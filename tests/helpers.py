@@ -0,0 +1,66 @@
+# coding: utf-8
+"""
+Helpers shared by the test modules
+"""
+
+import json
+import time
+import base64
+
+import httpretty
+
+from flask_consulate.endpoints import Endpoint
+
+
+def endpoint(url, weight=1, priority=1):
+    """
+    Build an endpoint record as returned by ConsulService._resolve
+    """
+    return Endpoint(url=url, weight=weight, priority=priority)
+
+
+def record(key, modify_index, value, raw=False):
+    """
+    Build a raw kv record as returned by consul
+
+    :param value: serialized to json, or stored as is if raw
+    """
+    if not raw:
+        value = json.dumps(value).encode('utf-8')
+    return {
+        'Key': key,
+        'ModifyIndex': modify_index,
+        'Value': base64.b64encode(value).decode('ascii'),
+    }
+
+
+def records(namespace='ns/', raw=False, **values):
+    """
+    Build raw kv records for values, given as key=(ModifyIndex, value),
+    sorted by key
+    """
+    return [
+        record(namespace + k, modify_index, v, raw=raw)
+        for k, (modify_index, v) in sorted(values.items())
+    ]
+
+
+def kv_response(index, namespace='ns/', **values):
+    """
+    Build a blocking query response for the records of values
+    """
+    return httpretty.Response(
+        body=json.dumps(records(namespace, **values)),
+        adding_headers={'X-Consul-Index': str(index)},
+    )
+
+
+def wait_for(condition, timeout=5):
+    """
+    Poll condition until it holds or timeout seconds passed
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out waiting for condition')
+        time.sleep(0.01)
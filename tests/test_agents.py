@@ -0,0 +1,146 @@
+# coding: utf-8
+
+import os
+import mock
+import unittest
+
+from flask import Flask
+from requests.exceptions import ConnectionError
+
+from flask_consulate import Consul
+from flask_consulate.agents import AgentPool, parse_agents
+from flask_consulate.breaker import BreakerRegistry
+from flask_consulate.exceptions import CircuitOpenError
+from flask_consulate.testing import FakeConsul
+
+
+class TestAgentPool(unittest.TestCase):
+    """
+    Test choosing among several consul agents
+    """
+
+    def setUp(self):
+        patcher = mock.patch('flask_consulate.agents.monotonic')
+        self.clock = patcher.start()
+        self.clock.return_value = 100
+        self.addCleanup(patcher.stop)
+        self.pool = AgentPool(
+            parse_agents('a, b:8501,c', 8500),
+            BreakerRegistry(min_calls=1, failure_rate=1, reset_timeout=60),
+            failover_cooldown=10,
+        )
+        self.a, self.b, self.c = self.pool.agents
+
+    def test_parse_agents(self):
+        """
+        hosts should be split on commas, with the default port unless given
+        """
+        self.assertEqual(parse_agents('a, b:8501,,c', '8500'),
+                         [('a', 8500), ('b', 8501), ('c', 8500)])
+        self.assertEqual(parse_agents(['a:1']), [('a', 1)])
+
+    def test_choose(self):
+        """
+        the fastest agent should be chosen, agents not called yet last
+        """
+        self.assertIs(self.pool.choose(), self.a)
+        self.a.record_success(0.01)
+        self.assertIs(self.pool.choose(), self.a)
+        self.b.record_success(0.002)
+        self.c.record_success(0.005)
+        self.assertIs(self.pool.choose(), self.b)
+        self.b.record_success(0.05)
+        self.assertIs(self.pool.choose(), self.c)
+
+    def test_failover(self):
+        """
+        failed agents should be avoided for the cooldown, and agents whose
+        breaker is open should not be called at all
+        """
+        for agent in self.pool.agents:
+            agent.latency = 0.01
+        with self.assertRaises(ValueError):
+            with self.pool.call() as agent:
+                self.assertIs(agent, self.a)
+                raise ValueError
+        self.assertEqual(self.a.breaker.state, 'open')
+        self.assertIs(self.pool.choose(), self.b)
+
+        self.b.failed_at = 95
+        self.c.failed_at = 98
+        self.assertIs(self.pool.choose(), self.b)
+        self.clock.return_value = 106
+        self.assertIs(self.pool.choose(), self.b)
+        self.b.breaker._trip()
+        self.c.breaker._trip()
+        with self.assertRaises(CircuitOpenError):
+            self.pool.choose()
+
+
+class TestConsulFailover(unittest.TestCase):
+    """
+    Test the Consul extension failing over between agents
+    """
+
+    def setUp(self):
+        self.first = FakeConsul().start()
+        self.second = FakeConsul().start()
+        self.addCleanup(self.first.stop)
+        self.addCleanup(self.second.stop)
+        for fake in (self.first, self.second):
+            fake.set_kv('ns/key', 'value')
+
+    def test_failover(self):
+        """
+        calls should move on to the next agent when one fails, reusing the
+        connections to each agent
+        """
+        app = Flask(__name__)
+        consul = Consul(app, consul_host=[
+            '{}:{}'.format(fake.host, fake.http_port)
+            for fake in (self.first, self.second)
+        ], retry_policy={'sleep': None})
+        first, second = consul.agents.agents
+        consul.apply_remote_config('ns/')
+        self.assertEqual(len(self.first.requests), 1)
+        http = second.http
+
+        self.first.fail(500, count=100)
+        app.config['key'] = None
+        consul.kv_indexes.clear()
+        consul.apply_remote_config('ns/')
+        self.assertEqual(app.config['key'], 'value')
+        self.assertEqual(len(self.second.requests), 1)
+        self.assertIsNotNone(first.failed_at)
+
+        consul.kv_indexes.clear()
+        consul.apply_remote_config('ns/')
+        self.assertEqual(len(self.second.requests), 2)
+        self.assertIs(second.http, http)
+
+    def test_register_locally(self):
+        """
+        services should only be registered with the first agent, never
+        failing over to another node
+        """
+        consul = Consul(Flask(__name__), consul_host='local,remote',
+                        retry_policy={'sleep': None})
+        local, remote = consul.agents.agents
+        local.session, remote.session = mock.Mock(), mock.Mock()
+        register = local.session.agent.service.register
+        register.side_effect = ConnectionError
+        with self.assertRaises(ConnectionError):
+            consul.register_service(name='web')
+        self.assertGreater(register.call_count, 1)
+        remote.session.agent.service.register.assert_not_called()
+
+    def test_environment(self):
+        """
+        $CONSUL_HOST may list several agents
+        """
+        with mock.patch.dict(os.environ, {'CONSUL_HOST': 'a,b:8501',
+                                          'CONSUL_PORT': '8502'}):
+            consul = Consul()
+        self.assertEqual([a.address for a in consul.agents.agents],
+                         ['a:8502', 'b:8501'])
+        self.assertEqual(consul.agent, 'a:8502')
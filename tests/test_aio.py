@@ -0,0 +1,169 @@
+# coding: utf-8
+
+import asyncio
+import unittest
+
+import dns.message
+import dns.rrset
+import mock
+
+from flask_consulate.aio import AsyncConsulService, aiohttp
+from flask_consulate.exceptions import ConsulConnectionError
+
+
+class DNSServer(asyncio.DatagramProtocol):
+    """
+    Answers every SRV query with two endpoints
+    """
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(
+            query.question[0].name, 15, 'IN', 'SRV',
+            '1 1 8001 node1.node.dc1.consul.',
+            '1 5 8002 node2.node.dc1.consul.',
+        ))
+        for i in (1, 2):
+            response.additional.append(dns.rrset.from_text(
+                'node{}.node.dc1.consul.'.format(i), 15, 'IN', 'A',
+                '10.1.1.{}'.format(i),
+            ))
+        self.transport.sendto(response.to_wire(), addr)
+
+
+class FakeResponse(object):
+    """
+    Stands in for aiohttp.ClientResponse
+    """
+
+    def __init__(self, status):
+        self.status = status
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read(self):
+        return b''
+
+
+class TestAsyncConsulService(unittest.TestCase):
+    """
+    Test the asyncio counterpart of ConsulService
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_resolve(self):
+        """
+        SRV records should be resolved without blocking the event loop, and
+        be cached like ConsulService does
+        """
+        transport, _ = self.run_async(self.loop.create_datagram_endpoint(
+            DNSServer, local_addr=('127.0.0.1', 0),
+        ))
+        try:
+            port = transport.get_extra_info('sockname')[1]
+            cs = AsyncConsulService('consul://foo.service.consul',
+                                    nameservers=['127.0.0.1'])
+            cs.resolver.port = port
+            endpoints = self.run_async(cs.get_endpoints())
+            self.assertEqual(
+                sorted((e['url'], e['weight']) for e in endpoints),
+                [('http://10.1.1.1:8001', 1), ('http://10.1.1.2:8002', 5)],
+            )
+            self.assertGreater(cs.cache.remaining(), 14)
+            self.run_async(cs.get_endpoints())
+            self.assertEqual(cs.cache.hits, 1)
+        finally:
+            transport.close()
+
+    def test_request(self):
+        """
+        requests should go through the pooled client, and be retried on
+        timeouts with the same endpoint selection as ConsulService
+        """
+        cs = AsyncConsulService('consul://foo', retry_policy={'sleep': None})
+        cs.cache.set([
+            {'url': 'http://a:80/', 'weight': 1, 'priority': 1},
+            {'url': 'http://b:80/', 'weight': 1, 'priority': 1},
+        ], 30)
+        cs._client = mock.Mock(closed=False)
+        cs._client.request.side_effect = [
+            asyncio.TimeoutError, FakeResponse(200),
+        ]
+        response = self.run_async(cs.get('/v1/status', timeout=5))
+        self.assertEqual(response.status, 200)
+        self.assertEqual(
+            [c[0][1] for c in cs._client.request.call_args_list],
+            ['http://a:80/v1/status', 'http://b:80/v1/status'],
+        )
+        self.assertEqual(
+            cs.breakers.snapshot()['http://a:80/']['failures'], 1
+        )
+
+        cs._client.request.side_effect = asyncio.TimeoutError
+        with self.assertRaises(ConsulConnectionError):
+            self.run_async(cs.get('/v1/status', timeout=5))
+
+    def test_sync_only_arguments(self):
+        """
+        arguments of the requests session and hedging should be rejected,
+        and no requests session be created
+        """
+        with self.assertRaises(TypeError):
+            AsyncConsulService('consul://foo', hedge={'delay': 0.1})
+        with self.assertRaises(TypeError):
+            AsyncConsulService('consul://foo', pool_maxsize=50)
+        cs = AsyncConsulService('consul://foo')
+        self.assertIsNone(cs.session)
+        self.assertIsNone(cs.pools)
+        cs._store([{'url': 'http://a:80/', 'weight': 1, 'priority': 1}], 30)
+
+    def test_background_refresh(self):
+        """
+        refresh should run as an asyncio task
+        """
+        cs = AsyncConsulService('consul://foo', refresh=True, min_ttl=0.01)
+
+        async def resolve():
+            return [{'url': 'http://a:80/', 'weight': 1, 'priority': 1}], 0
+
+        async def run():
+            with mock.patch.object(cs, '_resolve_async',
+                                   side_effect=resolve) as mocked:
+                await cs.get_endpoints()
+                await asyncio.sleep(0.1)
+                self.assertGreater(mocked.call_count, 2)
+            await cs.close()
+
+        self.run_async(run())
+        self.assertIsNone(cs._refresher)
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_client(self):
+        """
+        the aiohttp session should be created with the configured pool size
+        """
+        cs = AsyncConsulService('consul://foo', connection_limit=5)
+
+        async def run():
+            self.assertEqual(cs.client.connector.limit, 5)
+            await cs.close()
+
+        self.run_async(run())
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+import mock
+
+from unittest import TestCase
+
+from flask_consulate.balancers import get_balancer, Balancer, RoundRobin, \
+    WeightedRandom, LeastOutstanding, PowerOfTwoChoices
+
+from helpers import endpoint
+
+
+class TestBalancers(TestCase):
+    """
+    Test the strategies that ConsulService uses to choose an endpoint
+    """
+
+    def test_get_balancer(self):
+        """
+        get_balancer should accept names and Balancer instances
+        """
+        self.assertIsInstance(get_balancer('round_robin'), RoundRobin)
+        balancer = WeightedRandom()
+        self.assertIs(get_balancer(balancer), balancer)
+        with self.assertRaises(ValueError):
+            get_balancer('unknown')
+
+    def test_round_robin(self):
+        """
+        RoundRobin should hand out every endpoint in turn
+        """
+        endpoints = [endpoint('a'), endpoint('b'), endpoint('c')]
+        balancer = RoundRobin()
+        self.assertEqual(
+            [balancer.select(endpoints)['url'] for _ in range(4)],
+            ['a', 'b', 'c', 'a'],
+        )
+
+    def test_weighted_random(self):
+        """
+        WeightedRandom should only use the lowest priority value and choose
+        in proportion to the weights
+        """
+        endpoints = [
+            endpoint('a', weight=1),
+            endpoint('b', weight=3),
+            endpoint('backup', weight=100, priority=2),
+        ]
+        balancer = WeightedRandom()
+        with mock.patch('flask_consulate.balancers.random.uniform') as uniform:
+            uniform.return_value = 0.5
+            self.assertEqual(balancer.select(endpoints)['url'], 'a')
+            uniform.return_value = 1.5
+            self.assertEqual(balancer.select(endpoints)['url'], 'b')
+            uniform.assert_called_with(0, 4)
+
+    def test_least_outstanding(self):
+        """
+        LeastOutstanding should avoid endpoints with requests in flight
+        """
+        a, b = endpoint('a'), endpoint('b')
+        balancer = LeastOutstanding()
+        balancer.on_start(a)
+        self.assertEqual(balancer.select([a, b]), b)
+        balancer.on_start(b)
+        balancer.on_start(b)
+        self.assertEqual(balancer.select([a, b]), a)
+        balancer.on_finish(b, 0.1)
+        balancer.on_finish(b, 0.1)
+        self.assertEqual(balancer.select([a, b]), b)
+
+    def test_power_of_two(self):
+        """
+        PowerOfTwoChoices should prefer the endpoint with the lower observed
+        latency, and ignore failed requests for the latency average
+        """
+        a, b = endpoint('a'), endpoint('b')
+        balancer = PowerOfTwoChoices()
+        for e, elapsed in [(a, 0.5), (b, 0.1)]:
+            balancer.on_start(e)
+            balancer.on_finish(e, elapsed)
+        balancer.on_start(b)
+        balancer.on_finish(b, 10, failed=True)
+        self.assertEqual(balancer.select([a, b]), b)
+        self.assertEqual(balancer.select([a]), a)
+        self.assertEqual((a.latency, b.latency), (0.5, 0.1))
+        self.assertEqual((a.outstanding, b.outstanding), (0, 0))
+
+    def test_interface(self):
+        """
+        the base class should not implement select
+        """
+        with self.assertRaises(NotImplementedError):
+            Balancer().select([endpoint('a')])
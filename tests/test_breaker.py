@@ -0,0 +1,98 @@
+# coding: utf-8
+
+import mock
+
+from unittest import TestCase
+
+from flask_consulate.breaker import CircuitBreaker, BreakerRegistry, \
+    CLOSED, OPEN, HALF_OPEN
+
+
+class TestCircuitBreaker(TestCase):
+    """
+    Test the circuit breaker kept per consul agent and service endpoint
+    """
+
+    def setUp(self):
+        patcher = mock.patch('flask_consulate.breaker.monotonic')
+        self.clock = patcher.start()
+        self.clock.return_value = 0
+        self.addCleanup(patcher.stop)
+
+    def test_trip(self):
+        """
+        the breaker should open once the failure rate is reached over at
+        least min_calls calls
+        """
+        breaker = CircuitBreaker(failure_rate=0.5, min_calls=4)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertFalse(breaker.available())
+
+    def test_window(self):
+        """
+        calls older than the window should not count
+        """
+        breaker = CircuitBreaker(min_calls=2, window=10)
+        breaker.record_failure()
+        self.clock.return_value = 11
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_half_open(self):
+        """
+        after reset_timeout a limited number of probes should be let through;
+        a successful probe closes the breaker, a failed one re-opens it
+        """
+        breaker = CircuitBreaker(min_calls=1, reset_timeout=10, probes=1)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.clock.return_value = 10
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.opened, 2)
+
+        self.clock.return_value = 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_registry(self):
+        """
+        the registry should keep one breaker per key and report their state
+        """
+        registry = BreakerRegistry(min_calls=1)
+        self.assertIs(registry.get('a'), registry.get('a'))
+        registry.get('a').record_failure()
+        registry.get('b').record_success()
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['a']['state'], OPEN)
+        self.assertEqual(snapshot['b'], {
+            'state': CLOSED, 'successes': 1, 'failures': 0, 'opened': 0,
+        })
+
+    def test_unclosed(self):
+        """
+        the registry should count the breakers that aren't closed
+        """
+        registry = BreakerRegistry(min_calls=1, reset_timeout=10)
+        registry.get('a').record_failure()
+        registry.get('b').record_success()
+        self.assertEqual(registry.unclosed, 1)
+        self.clock.return_value = 10
+        self.assertTrue(registry.get('a').allow())
+        registry.get('a').record_failure()
+        self.assertEqual(registry.unclosed, 1)
+        self.clock.return_value = 20
+        self.assertTrue(registry.get('a').allow())
+        registry.get('a').record_success()
+        self.assertEqual(registry.unclosed, 0)
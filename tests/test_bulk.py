@@ -0,0 +1,90 @@
+# coding: utf-8
+
+import io
+import json
+import unittest
+
+from flask import Flask
+
+from flask_consulate import Consul
+from flask_consulate.bulk import iter_kv, _get_page
+from flask_consulate.testing import FakeConsul
+
+
+class TestBulk(unittest.TestCase):
+    """
+    Test walking, exporting and importing kv namespaces in pages
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul().start()
+        self.addCleanup(self.fake.stop)
+        self.app = Flask(__name__)
+        self.consul = Consul(self.app, **self.fake.consul_kwargs)
+        self.keys = ['config/app/a', 'config/app/b', 'config/app/db/host',
+                     'config/app/db/port', 'config/app/z']
+        self.keys += ['config/app/many/{:02d}'.format(i) for i in range(10)]
+        for i, key in enumerate(self.keys):
+            self.fake.set_kv(key, i, flags=i)
+        self.fake.set_kv('config/apple', 'not in the namespace')
+        self.keys.sort()
+
+    def test_iter_kv(self):
+        """
+        all keys should be walked in order, a directory level and a page of
+        values at a time
+        """
+        records = list(self.consul.iter_kv('config/app/', page_size=3))
+        self.assertEqual([r['Key'] for r in records], self.keys)
+        self.assertEqual(records[0]['Flags'], self.keys.index('config/app/a'))
+        listings = [r for r in self.fake.requests if r[0] == 'GET']
+        pages = [r for r in self.fake.requests if r == ('PUT', '/v1/txn')]
+        self.assertEqual(len(listings), 3)
+        self.assertEqual(len(pages), 7)
+
+    def test_deleted_keys(self):
+        """
+        keys deleted after they were listed should be skipped
+        """
+        records = _get_page(self.consul, ['config/app/a', 'config/app/gone',
+                                          'config/app/z'])
+        self.assertEqual([r['Key'] for r in records],
+                         ['config/app/a', 'config/app/z'])
+        self.assertEqual(list(iter_kv(self.consul, 'missing/')), [])
+
+    def test_apply_remote_config(self):
+        """
+        a walked namespace should be applied like a fetched one
+        """
+        diff = self.consul.apply_remote_config('config/app/', page_size=4)
+        self.assertEqual(len(diff.added), len(self.keys))
+        self.assertEqual(self.app.config['db/port'], 3)
+        self.fake.delete_kv('config/app/b')
+        self.fake.set_kv('config/app/z', 'changed')
+        diff = self.consul.apply_remote_config(
+            'config/app/', page_size=4, prune=True,
+        )
+        self.assertEqual(diff.changed, {'z': 'changed'})
+        self.assertEqual(diff.removed, set(['b']))
+        self.assertNotIn('b', self.app.config)
+
+    def test_export_import(self):
+        """
+        exported keys should be imported into another agent unchanged
+        """
+        exported = io.StringIO()
+        self.assertEqual(self.consul.export_kv(exported, 'config/app/'),
+                         len(self.keys))
+        lines = exported.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[0])['key'], 'config/app/a')
+
+        other = FakeConsul().start()
+        self.addCleanup(other.stop)
+        consul = Consul(Flask(__name__), **other.consul_kwargs)
+        exported.seek(0)
+        self.assertEqual(consul.import_kv(exported, page_size=4),
+                         len(self.keys))
+        self.assertEqual(sorted(other.kv), self.keys)
+        for key in self.keys:
+            self.assertEqual(other.kv[key]['Value'], self.fake.kv[key]['Value'])
+            self.assertEqual(other.kv[key]['Flags'], self.fake.kv[key]['Flags'])
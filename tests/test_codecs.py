@@ -0,0 +1,117 @@
+# coding: utf-8
+
+import json
+import pickle
+import unittest
+
+import httpretty
+import mock
+
+from flask import Flask
+
+from flask_consulate import Consul
+from flask_consulate.codecs import LazyConfig, LazyValue, get_codec, \
+    decode_json
+
+from helpers import records
+
+URL = 'http://localhost:8500/v1/kv/ns/'
+
+
+class TestCodecs(unittest.TestCase):
+    """
+    Test the codecs of kv values
+    """
+
+    def test_builtin(self):
+        """
+        the builtin codecs should decode their formats and reject others
+        """
+        self.assertEqual(get_codec('int')(b' 42\n'), 42)
+        self.assertIs(get_codec('bool')(b'yes'), True)
+        self.assertIs(get_codec('bool')(b'0'), False)
+        self.assertRaises(ValueError, get_codec('bool'), b'maybe')
+        self.assertEqual(get_codec('json')(b'{"a": [1]}'), {'a': [1]})
+        self.assertRaises(ValueError, get_codec('json'), b'plain')
+        self.assertEqual(get_codec('text')(b'plain'), u'plain')
+        self.assertEqual(get_codec('raw')(b'\xff'), b'\xff')
+        self.assertEqual(get_codec(None)(b'plain'), u'plain')
+        self.assertEqual(get_codec(None)(b'\xff'), b'\xff')
+        self.assertRaises(ValueError, get_codec, 'xml')
+
+    def test_lazy_config(self):
+        """
+        LazyConfig should decode a LazyValue on first access only
+        """
+        codec = mock.Mock(return_value={'a': 1})
+        config = LazyConfig('.', {'plain': 1})
+        config['lazy'] = LazyValue(b'{"a": 1}', codec)
+
+        self.assertEqual(config['lazy'], {'a': 1})
+        self.assertEqual(config.get('lazy'), {'a': 1})
+        self.assertEqual(dict(config.items())['lazy'], {'a': 1})
+        self.assertEqual(codec.call_count, 1)
+        self.assertEqual(config.get('missing', 2), 2)
+        self.assertEqual(config['plain'], 1)
+
+        config['other'] = LazyValue(b'[1]', decode_json)
+        self.assertIsInstance(config.raw('other'), LazyValue)
+        self.assertEqual(config.get_namespace('oth'), {'er': [1]})
+
+        value = pickle.loads(pickle.dumps(LazyValue(b'[1]', decode_json)))
+        self.assertEqual(value.decode(), [1])
+
+
+class TestLazyRemoteConfig(unittest.TestCase):
+    """
+    Test applying the remote config with codecs and lazy decoding
+    """
+
+    def setUp(self):
+        httpretty.enable()
+        httpretty.register_uri(httpretty.GET, URL, body=json.dumps(records(
+            raw=True,
+            flags=(1, b'{"feature": true}'),
+            workers=(2, b'8'),
+            name=(3, b'plain'),
+        )))
+        self.app = Flask('tests')
+
+    def tearDown(self):
+        httpretty.reset()
+        httpretty.disable()
+
+    def test_codecs(self):
+        """
+        keys with a codec should be decoded with it, without falling back
+        to the raw value
+        """
+        consul = Consul(self.app, consul_host='localhost',
+                        codecs={'workers': 'int', 'name': 'json'})
+        self.assertRaises(ValueError, consul.apply_remote_config, 'ns/')
+
+        consul.codecs['name'] = get_codec('text')
+        consul.apply_remote_config('ns/')
+        self.assertEqual(self.app.config['workers'], 8)
+        self.assertEqual(self.app.config['name'], u'plain')
+        self.assertEqual(self.app.config['flags'], {'feature': True})
+
+    def test_lazy(self):
+        """
+        values should only be decoded once they are read from app.config
+        """
+        codec = mock.Mock(side_effect=decode_json)
+        consul = Consul(self.app, consul_host='localhost', lazy_config=True,
+                        codecs={'workers': 'int', 'flags': codec})
+        self.assertIsInstance(self.app.config, LazyConfig)
+
+        diff = consul.apply_remote_config('ns/')
+        self.assertFalse(codec.called)
+        self.assertIsInstance(diff.added['flags'], LazyValue)
+        self.assertIsInstance(self.app.config.raw('flags'), LazyValue)
+
+        self.assertEqual(self.app.config['flags'], {'feature': True})
+        self.assertEqual(self.app.config['flags'], {'feature': True})
+        self.assertEqual(codec.call_count, 1)
+        self.assertEqual(self.app.config['workers'], 8)
+        self.assertEqual(self.app.config.raw('workers'), 8)
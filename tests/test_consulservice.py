@@ -1,10 +1,25 @@
 # coding: utf-8
 
+import time
 import mock
+import threading
+import requests
 
-from unittest import TestCase, skip
+from unittest import TestCase
+
+import dns.message
+import dns.rrset
+
+from dns.exception import Timeout
+from requests.exceptions import ConnectionError
 
 from flask_consulate import ConsulService
+from flask_consulate.endpoints import Endpoint
+from flask_consulate.exceptions import ConsulConnectionError, CircuitOpenError
+from flask_consulate.service import ResolutionCache, EndpointPools, \
+    EndpointRefresher
+
+from helpers import endpoint
 
 
 class TestConsulService(TestCase):
@@ -23,28 +38,207 @@ class TestConsulService(TestCase):
         with self.assertRaises(AssertionError):
             ConsulService('http://')
 
-    @skip('!! Test not implemented !!')
     def test_resolve(self):
         """
-        resolve() should return a list of string formatted service endpoints
-        and set ConsulService.endpoints
+        resolve() should return the endpoint records of the SRV answer and
+        its TTL
         """
-        pass
+        query = dns.message.make_query('foo.service.consul', 'SRV')
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(
+            'foo.service.consul.', 15, 'IN', 'SRV',
+            '1 3 8001 node1.node.dc1.consul.',
+        ))
+        response.additional.append(dns.rrset.from_text(
+            'node1.node.dc1.consul.', 15, 'IN', 'A', '10.1.1.1',
+        ))
+        cs = ConsulService('consul://foo.service.consul')
+        with mock.patch.object(cs.resolver, 'query') as query:
+            query.return_value.response = response
+            endpoints, ttl = cs._resolve()
+        self.assertEqual(ttl, 15)
+        self.assertEqual(endpoints, [Endpoint(
+            '10.1.1.1', 8001, weight=3, priority=1, node='node1',
+        )])
+        self.assertEqual(endpoints[0].url, 'http://10.1.1.1:8001')
 
     @mock.patch('flask_consulate.ConsulService._resolve')
     def test_baseurl(self, mocked):
         """
-        the class property base_url should call _resolve() and return the last
-        element from that result list
+        the class property base_url should call _resolve() once per TTL and
+        hand out the resolved endpoints in turn
         """
-        mocked.side_effect = lambda: ['addr-{}:80'.format(i) for i in range(5)]
+        mocked.side_effect = lambda: (
+            [endpoint('addr-{}:80'.format(i)) for i in range(3)], 30
+        )
         cs = ConsulService('consul://')
-        urls = [cs.base_url, cs.base_url, cs.base_url]
-        self.assertEqual(mocked.call_count, 3)
-        self.assertEquals(
-            ['addr-4:80', 'addr-4:80', 'addr-4:80'],
+        urls = [cs.base_url, cs.base_url, cs.base_url, cs.base_url]
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(
+            ['addr-0:80', 'addr-1:80', 'addr-2:80', 'addr-0:80'],
             urls
         )
+        self.assertEqual(cs.cache.misses, 1)
+        self.assertEqual(cs.cache.hits, 3)
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    def test_baseurl_expired(self, mocked):
+        """
+        an expired cache entry should be re-resolved
+        """
+        mocked.return_value = ([endpoint('addr-1:80')], 0)
+        cs = ConsulService('consul://', min_ttl=0)
+        cs.base_url
+        cs.base_url
+        self.assertEqual(mocked.call_count, 2)
+
+    def test_cache_ttl_bounds(self):
+        """
+        the TTL of a cached answer should be clamped to [min_ttl, max_ttl]
+        """
+        with mock.patch('flask_consulate.service.monotonic') as clock:
+            clock.return_value = 100
+            cache = ResolutionCache(min_ttl=5, max_ttl=10)
+            cache.set([endpoint('a')], 0)
+            clock.return_value = 104
+            self.assertEqual(cache.get(), (endpoint('a'),))
+            clock.return_value = 105
+            self.assertIsNone(cache.get())
+
+            cache.set([endpoint('a')], 3600)
+            clock.return_value = 114
+            self.assertEqual(cache.get(), (endpoint('a'),))
+            clock.return_value = 115
+            self.assertIsNone(cache.get())
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    def test_stale_while_error(self, mocked):
+        """
+        expired endpoints should be served for up to stale_ttl seconds if
+        re-resolving fails
+        """
+        mocked.return_value = ([endpoint('addr-1:80')], 0)
+        with mock.patch('flask_consulate.service.monotonic') as clock:
+            clock.return_value = 100
+            cs = ConsulService('consul://', min_ttl=1, stale_ttl=10)
+            self.assertEqual(cs.base_url, 'addr-1:80')
+
+            mocked.side_effect = Timeout
+            clock.return_value = 110
+            self.assertEqual(cs.base_url, 'addr-1:80')
+            self.assertEqual(cs.cache.stale_hits, 1)
+
+            clock.return_value = 111
+            with self.assertRaises(Timeout):
+                cs.base_url
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    def test_background_refresh(self, mocked):
+        """
+        with refresh=True, endpoints should be re-resolved in the background
+        before they expire
+        """
+        mocked.return_value = ([endpoint('addr-1:80')], 0)
+        cs = ConsulService('consul://', refresh=True, min_ttl=0.05)
+        try:
+            self.assertEqual(cs.base_url, 'addr-1:80')
+            self.assertTrue(cs._refresher.daemon)
+            mocked.return_value = ([endpoint('addr-2:80')], 0)
+            time.sleep(0.2)
+            self.assertGreater(mocked.call_count, 2)
+            self.assertEqual(cs.cache._entry[0], (endpoint('addr-2:80'),))
+        finally:
+            cs.stop_refresh()
+        self.assertIsNone(cs._refresher)
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    def test_refresh_started_once(self, mocked):
+        """
+        concurrent first requests should start a single refresher, which
+        stop_refresh stops
+        """
+        mocked.return_value = ([endpoint('addr-1:80')], 30)
+        cs = ConsulService('consul://racy.service', refresh=True)
+        self.addCleanup(cs.stop_refresh)
+        start = threading.Event()
+        refreshers = []
+        init = EndpointRefresher.__init__
+
+        def slow_init(refresher, *args, **kwargs):
+            # widen the window between checking and setting _refresher
+            time.sleep(0.05)
+            refreshers.append(refresher)
+            init(refresher, *args, **kwargs)
+
+        def request():
+            start.wait()
+            cs.endpoints
+
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        with mock.patch.object(EndpointRefresher, '__init__', slow_init):
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(refreshers), 1)
+        cs.stop_refresh()
+        refreshers[0].join(1)
+        self.assertFalse(refreshers[0].is_alive())
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    def test_refresh_serves_stale(self, mocked):
+        """
+        while the refresher runs, request threads should serve expired
+        endpoints instead of resolving them, until stale_ttl runs out
+        """
+        callers = []
+
+        def resolve():
+            callers.append(threading.current_thread())
+            if len(callers) > 1:
+                raise Timeout
+            return [endpoint('addr-1:80')], 0
+
+        mocked.side_effect = resolve
+        cs = ConsulService('consul://', refresh=True, min_ttl=0, max_ttl=0,
+                           stale_ttl=60)
+        self.addCleanup(cs.stop_refresh)
+        self.assertEqual(cs.base_url, 'addr-1:80')
+        for _ in range(3):
+            self.assertEqual(cs.base_url, 'addr-1:80')
+        self.assertNotIn(threading.current_thread(), callers[1:])
+
+        cs.stop_refresh()
+        cs.cache.stale_ttl = 0
+        with self.assertRaises(Timeout):
+            cs.endpoints
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    @mock.patch('flask_consulate.service.requests.Session')
+    def test_request_invalidates_endpoint(self, mocked, mocked_resolve):
+        """
+        an endpoint that fails with ConnectionError should be dropped from
+        the cache so that the retry goes to a different endpoint
+        """
+        mocked_resolve.return_value = (
+            [endpoint('http://a:80/'), endpoint('http://b:80/')], 30
+        )
+        instance = mocked.return_value
+        ok = mock.Mock(status_code=200)
+        instance.request.side_effect = [ConnectionError, ok]
+        cs = ConsulService('consul://')
+        self.assertIs(cs.get('/v1/status'), ok)
+        self.assertEqual(
+            [c[0][1] for c in instance.request.call_args_list],
+            ['http://a:80/v1/status', 'http://b:80/v1/status'],
+        )
+        self.assertEqual(cs.endpoints, (endpoint('http://b:80/'),))
+        self.assertEqual(mocked_resolve.call_count, 1)
+
+        instance.request.side_effect = ConnectionError
+        with self.assertRaises(ConsulConnectionError):
+            cs.get('/v1/status')
 
     @mock.patch('flask_consulate.ConsulService._resolve')
     @mock.patch('flask_consulate.service.requests.Session')
@@ -53,7 +247,7 @@ class TestConsulService(TestCase):
         the ConsulService.request should be a thin wrapper around
         requests
         """
-        mocked_resolve.return_value = ['http://base_url:80/']
+        mocked_resolve.return_value = ([endpoint('http://base_url:80/')], 30)
         instance = mocked.return_value
         cs = ConsulService('consul://')
         cs.get('/v1/status')
@@ -62,3 +256,128 @@ class TestConsulService(TestCase):
             'http://base_url:80/v1/status',
             timeout=(1, 30),
         )
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    @mock.patch('flask_consulate.service.requests.Session')
+    def test_request_retry_policy(self, mocked, mocked_resolve):
+        """
+        the retry policy given to the constructor should apply to requests,
+        and be overridable per call
+        """
+        mocked_resolve.return_value = ([endpoint('http://a:80/')], 30)
+        instance = mocked.return_value
+        instance.request.side_effect = ConnectionError
+        cs = ConsulService('consul://', retry_policy={'max_tries': 1})
+        with self.assertRaises(ConsulConnectionError):
+            cs.get('/')
+        self.assertEqual(instance.request.call_count, 1)
+
+        with self.assertRaises(ConsulConnectionError):
+            cs.get('/', retry_policy={'max_tries': 2, 'sleep': None})
+        self.assertEqual(instance.request.call_count, 3)
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    @mock.patch('flask_consulate.service.requests.Session')
+    def test_circuit_breaker(self, mocked, mocked_resolve):
+        """
+        endpoints whose circuit breaker opened should be skipped until they
+        may be probed again
+        """
+        mocked_resolve.return_value = (
+            [endpoint('http://a:80/'), endpoint('http://b:80/')], 30
+        )
+        instance = mocked.return_value
+        instance.request.side_effect = lambda method, url, **kwargs: \
+            mock.Mock(status_code=503 if url.startswith('http://a') else 200)
+        cs = ConsulService('consul://', circuit_breaker={
+            'min_calls': 2, 'reset_timeout': 60,
+        })
+        for _ in range(4):
+            cs.get('/')
+        self.assertEqual(cs.breakers.snapshot()['http://a:80/']['state'], 'open')
+        self.assertEqual(cs.breakers.snapshot()['http://b:80/']['state'], 'closed')
+        self.assertEqual(
+            [cs.base_url for _ in range(3)],
+            ['http://b:80/'] * 3,
+        )
+
+        cs.breakers.get('http://b:80/')._trip()
+        with self.assertRaises(CircuitOpenError):
+            cs.base_url
+
+    def test_endpoint_pools(self):
+        """
+        every endpoint should get its own pool; pools of endpoints that are
+        gone should be unmounted and idle ones closed
+        """
+        session = requests.Session()
+        pools = EndpointPools(session, maxsize=20, idle_timeout=60)
+        with mock.patch('flask_consulate.service.monotonic') as clock:
+            clock.return_value = 0
+            pools.use('http://a:80')
+            clock.return_value = 100
+            pools.use('http://b:80')
+            adapter_a = pools.adapters['http://a:80'][0]
+            self.assertIs(session.get_adapter('http://a:80/x'), adapter_a)
+            self.assertEqual(adapter_a._pool_maxsize, 20)
+
+            with mock.patch.object(adapter_a, 'close') as close_a:
+                pools.prune([endpoint('http://a:80'), endpoint('http://b:80')])
+                self.assertEqual(close_a.call_count, 1)
+                pools.prune([endpoint('http://b:80')])
+            self.assertNotIn('http://a:80', pools.adapters)
+            self.assertNotIn('http://a:80/', session.adapters)
+            self.assertIn('http://b:80/', session.adapters)
+
+    def test_endpoint_pools_concurrent(self):
+        """
+        mounting and pruning pools should not disturb threads looking up
+        adapters on the session
+        """
+        session = requests.Session()
+        pools = EndpointPools(session)
+        kept = [endpoint('http://kept-{}:80'.format(i)) for i in range(50)]
+        for e in kept:
+            pools.use(e.url)
+        stop = threading.Event()
+        errors = []
+
+        def lookup():
+            while not stop.is_set():
+                try:
+                    # matches last, after iterating every mounted prefix
+                    session.get_adapter('https://a/x')
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        threads = [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            for i in range(500):
+                url = 'http://{}:80'.format(i)
+                pools.use(url)
+                pools.prune(kept + [endpoint(url)])
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(pools.adapters), 51)
+        self.assertEqual(list(session.adapters)[-2:], ['https://', 'http://'])
+        self.assertIn('http://499:80/', session.adapters)
+        self.assertNotIn('http://498:80/', session.adapters)
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    def test_pools_pruned_on_resolve(self, mocked):
+        """
+        re-resolving should prune the pools of endpoints that are gone
+        """
+        mocked.return_value = ([endpoint('http://a:80/')], 0)
+        cs = ConsulService('consul://', min_ttl=0)
+        cs.pools.use(cs.base_url)
+        self.assertIn('http://a:80/', cs.session.adapters)
+        mocked.return_value = ([endpoint('http://b:80/')], 0)
+        cs.base_url
+        self.assertNotIn('http://a:80/', cs.session.adapters)
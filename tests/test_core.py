@@ -7,7 +7,7 @@ import mock
 from flask import Flask
 
 from flask_consulate import Consul
-from flask_consulate.exceptions import ConsulConnectionError
+from flask_consulate.exceptions import ConsulConnectionError, CircuitOpenError
 
 
 class TestFlaskConsulate(unittest.TestCase):
@@ -95,3 +95,28 @@ class TestFlaskConsulate(unittest.TestCase):
 
         httpretty.disable()
         httpretty.reset()
+
+    def test_agent_circuit_breaker(self):
+        """
+        Calls to an agent whose circuit breaker opened should fail without
+        contacting the agent
+        """
+        app = self.create_app()
+        with mock.patch('consulate.Session') as mocked:
+            mocked.return_value.agent.service.register.side_effect = \
+                ConsulConnectionError
+            consul = Consul(
+                app,
+                circuit_breaker={'min_calls': 2, 'reset_timeout': 60},
+                retry_policy={'sleep': None},
+            )
+            with self.assertRaises(ConsulConnectionError):
+                consul.register_service()
+            register = mocked.return_value.agent.service.register
+            self.assertEqual(register.call_count, 2)
+            self.assertEqual(
+                consul.breakers.snapshot()[consul.agent]['state'], 'open'
+            )
+            with self.assertRaises(CircuitOpenError):
+                consul.register_service()
+            self.assertEqual(register.call_count, 2)
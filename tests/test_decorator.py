@@ -3,11 +3,12 @@
 import unittest
 import httpretty
 import requests
+import mock
 
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, ReadTimeout
 from six import next
 
-from flask_consulate.decorators import with_retry_connections
+from flask_consulate.decorators import with_retry_connections, RetryPolicy
 from flask_consulate.exceptions import ConsulConnectionError
 
 
@@ -75,3 +76,77 @@ class TestDecorator(unittest.TestCase):
 
         with self.assertRaises(ConsulConnectionError):
             GET_request()
+
+    def test_backoff(self):
+        """
+        the sleep between tries should grow exponentially up to max_sleep,
+        and be a random fraction of that with jitter
+        """
+        policy = RetryPolicy(sleep=0.1, max_sleep=0.3, jitter=False)
+        self.assertEqual(
+            [policy.backoff(i) for i in range(1, 5)],
+            [0.1, 0.2, 0.3, 0.3],
+        )
+        with mock.patch('flask_consulate.decorators.random.uniform') as uniform:
+            uniform.return_value = 0.05
+            self.assertEqual(policy.replace(jitter=True).backoff(2), 0.05)
+            uniform.assert_called_with(0, 0.2)
+        self.assertEqual(RetryPolicy(sleep=None).backoff(1), 0)
+
+    @mock.patch('flask_consulate.decorators.time.sleep')
+    def test_retry_policy(self, sleep):
+        """
+        the decorator should retry on the configured exceptions and status
+        codes, and give up once the deadline would be exceeded
+        """
+        response = mock.Mock(status_code=503)
+        f = mock.Mock(side_effect=[ReadTimeout, response, 'OK'])
+        decorated = with_retry_connections(
+            max_tries=5, exceptions=(ReadTimeout,), status_codes=(503,),
+        )(f)
+        self.assertEqual(decorated(), 'OK')
+        self.assertEqual(sleep.call_count, 2)
+
+        f = mock.Mock(return_value=response)
+        decorated = with_retry_connections(status_codes=(503,))(f)
+        self.assertIs(decorated(), response)
+        self.assertEqual(f.call_count, 3)
+
+        clock = [0]
+        sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        f = mock.Mock(side_effect=ConnectionError)
+        decorated = with_retry_connections(
+            max_tries=100, sleep=1, jitter=False, deadline=3.5,
+        )(f)
+        with mock.patch('flask_consulate.decorators.monotonic',
+                        side_effect=lambda: clock[0]):
+            with self.assertRaises(ConsulConnectionError):
+                decorated()
+        # tries at 0s, 1s and 3s; the next one after sleeping another 4s
+        # would be past the deadline
+        self.assertEqual(f.call_count, 3)
+
+    def test_retry_policy_override(self):
+        """
+        a retry_policy attribute of the instance and a retry_policy keyword
+        argument should override the decorator's policy
+        """
+
+        class Client(object):
+            retry_policy = RetryPolicy(max_tries=2, sleep=None)
+            calls = 0
+
+            @with_retry_connections(max_tries=10)
+            def call(self, **kwargs):
+                self.calls += 1
+                raise ConnectionError
+
+        client = Client()
+        with self.assertRaises(ConsulConnectionError):
+            client.call()
+        self.assertEqual(client.calls, 2)
+
+        client = Client()
+        with self.assertRaises(ConsulConnectionError):
+            client.call(retry_policy={'max_tries': 4})
+        self.assertEqual(client.calls, 4)
@@ -0,0 +1,102 @@
+# coding: utf-8
+
+import mock
+
+from unittest import TestCase
+
+from flask_consulate import ConsulService
+from flask_consulate.balancers import WeightedRandom
+from flask_consulate.endpoints import Endpoint, carry_over
+
+
+class TestEndpoint(TestCase):
+    """
+    Test the records of resolved endpoints
+    """
+
+    def test_fields(self):
+        """
+        the URL should be formatted once, and fields readable like dict keys
+        """
+        endpoint = Endpoint('10.0.0.1', 80, weight=5, node='node1')
+        self.assertEqual(endpoint.url, 'http://10.0.0.1:80')
+        self.assertEqual(endpoint['url'], 'http://10.0.0.1:80')
+        self.assertEqual(endpoint.get('node'), 'node1')
+        self.assertIsNone(endpoint.get('datacenter'))
+        self.assertIsNone(endpoint.get('outstanding'))
+        with self.assertRaises(KeyError):
+            endpoint['datacenter']
+        with self.assertRaises(AttributeError):
+            endpoint.extra = 1
+        self.assertEqual(Endpoint.from_dict(endpoint.as_dict()), endpoint)
+
+    def test_carry_over(self):
+        """
+        unchanged endpoints should be kept with their statistics, and changed
+        ones keep their latency
+        """
+        a, b = Endpoint('a', 80), Endpoint('b', 80)
+        a.outstanding, a.latency, b.latency = 2, 0.1, 0.2
+        current = carry_over(
+            [Endpoint('a', 80), {'addr': 'b', 'port': 80, 'weight': 3},
+             Endpoint('c', 80)],
+            (a, b),
+        )
+        self.assertIs(current[0], a)
+        self.assertIsNot(current[1], b)
+        self.assertEqual((current[1].weight, current[1].latency), (3, 0.2))
+        self.assertEqual(current[1].outstanding, 0)
+        self.assertIsNone(current[2].latency)
+
+
+class TestSelection(TestCase):
+    """
+    Test choosing endpoints from the cached tuple
+    """
+
+    def setUp(self):
+        self.cs = ConsulService('consul://foo', balancer='weighted_random')
+        self.endpoints = self.cs.cache.set(
+            [Endpoint('a', 80, weight=1), Endpoint('b', 80, weight=3)], 30,
+        )
+
+    def test_all_closed(self):
+        """
+        while every breaker is closed, selection should not check them, and
+        the balancer should reuse what it computed for the cached tuple
+        """
+        with mock.patch.object(self.cs.breakers, 'get') as get:
+            for _ in range(10):
+                self.assertIn(self.cs._select(self.cs.endpoints), self.endpoints)
+        get.assert_not_called()
+        table = self.cs.balancer._table
+        self.assertIs(table[0], self.endpoints)
+        self.cs._select(self.cs.endpoints)
+        self.assertIs(self.cs.balancer._table, table)
+
+        # a new answer replaces the tuple, but keeps unchanged records
+        endpoints = self.cs.cache.set(
+            [Endpoint('a', 80, weight=1), Endpoint('b', 80, weight=3)], 30,
+        )
+        self.assertIsNot(endpoints, self.endpoints)
+        self.assertIs(endpoints[0], self.endpoints[0])
+
+    def test_open_breaker(self):
+        """
+        endpoints whose breaker is open should be skipped
+        """
+        self.cs.breakers.get('http://b:80')._trip()
+        self.assertEqual(self.cs.breakers.unclosed, 1)
+        for _ in range(10):
+            self.assertEqual(self.cs.base_url, 'http://a:80')
+
+    def test_weighted_random(self):
+        """
+        WeightedRandom should choose by cumulative weight
+        """
+        balancer = WeightedRandom()
+        with mock.patch('flask_consulate.balancers.random.uniform') as uniform:
+            uniform.return_value = 1
+            self.assertEqual(balancer.select(self.endpoints).url, 'http://a:80')
+            uniform.return_value = 1.01
+            self.assertEqual(balancer.select(self.endpoints).url, 'http://b:80')
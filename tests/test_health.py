@@ -0,0 +1,96 @@
+# coding: utf-8
+
+import unittest
+
+from flask_consulate import ConsulService
+from flask_consulate.health import parse_service, HealthQuery
+from flask_consulate.testing import FakeConsul, CRITICAL
+
+from helpers import wait_for
+
+
+class TestHealthResolver(unittest.TestCase):
+    """
+    Test resolving endpoints through consul's health API
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul().start()
+        self.agent = '{}:{}'.format(self.fake.host, self.fake.http_port)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_parse_service(self):
+        """
+        name, tag and datacenter should be taken from consul DNS names
+        """
+        self.assertEqual(parse_service('api.service.consul'),
+                         ('api', None, None))
+        self.assertEqual(parse_service('v1.api.service.dc2.consul'),
+                         ('api', 'v1', 'dc2'))
+        self.assertEqual(parse_service('api'), ('api', None, None))
+
+    def test_query(self):
+        """
+        only passing instances with the tag and node metadata should be
+        returned, with their metadata
+        """
+        self.fake.register('api', 1, service_id='a', tags=['v1'],
+                           meta={'version': '1'}, node='n1',
+                           node_meta={'zone': 'a'})
+        self.fake.register('api', 2, service_id='b', tags=['v1'], node='n2',
+                           node_meta={'zone': 'b'})
+        self.fake.register('api', 3, service_id='c', tags=['v2'], node='n1')
+        self.fake.register('api', 4, service_id='d', tags=['v1'], node='n1',
+                           status=CRITICAL)
+
+        query = HealthQuery('v1.api.service.consul', agent=self.agent)
+        endpoints, index = query.fetch()
+        self.assertEqual(sorted(e['id'] for e in endpoints), ['a', 'b'])
+        self.assertEqual(index, self.fake.health_index)
+        a = [e for e in endpoints if e['id'] == 'a'][0]
+        self.assertEqual(a['url'], 'http://127.0.0.1:1')
+        self.assertEqual(a['meta'], {'version': '1'})
+        self.assertEqual(a['node_meta'], {'zone': 'a'})
+        self.assertEqual(a['datacenter'], 'dc1')
+
+        query.node_meta = {'zone': 'b'}
+        self.assertEqual([e['id'] for e in query.fetch()[0]], ['b'])
+
+    def test_large_service(self):
+        """
+        all instances of a large service should be resolved
+        """
+        for port in range(1, 201):
+            self.fake.register('big', port, service_id='big-{}'.format(port))
+        cs = ConsulService('consul://big.service.consul',
+                           health={'agent': self.agent})
+        try:
+            self.assertEqual(len(cs.endpoints), 200)
+        finally:
+            cs.stop_refresh()
+
+    def test_pushed_updates(self):
+        """
+        changes should be pushed into the service by the watcher, without
+        requests resolving endpoints themselves
+        """
+        first, = self.fake.serve('api')
+        cs = ConsulService('consul://api.service.consul',
+                           health={'agent': self.agent, 'wait': 5})
+        try:
+            self.assertEqual([e['url'] for e in cs.endpoints], [first.url])
+            wait_for(lambda: cs._refresher.index > 0)
+
+            second, = self.fake.serve('api')
+            wait_for(lambda: len(cs.endpoints) == 2)
+            self.fake.set_check('service:api-{}'.format(first.port), CRITICAL)
+            wait_for(lambda: [e['url'] for e in cs.endpoints] == [second.url])
+
+            resolves = len(self.fake.requests)
+            for _ in range(5):
+                self.assertEqual(cs.get('/').json()['endpoint'], second.url)
+            self.assertEqual(len(self.fake.requests), resolves)
+        finally:
+            cs.stop_refresh()
@@ -0,0 +1,108 @@
+# coding: utf-8
+
+import time
+import threading
+import mock
+
+from unittest import TestCase
+
+from flask_consulate import ConsulService
+from flask_consulate.hedging import HedgePolicy
+
+from helpers import endpoint
+
+
+class TestHedgePolicy(TestCase):
+    """
+    Test the policy deciding when requests are hedged
+    """
+
+    def test_budget(self):
+        """
+        hedges should be limited to the budgeted share of requests
+        """
+        policy = HedgePolicy(delay=0.1, budget=0.5)
+        policy.earn()
+        self.assertFalse(policy.spend())
+        policy.earn()
+        self.assertTrue(policy.spend())
+        self.assertFalse(policy.spend())
+        self.assertEqual(policy.hedged, 1)
+
+    def test_percentile(self):
+        """
+        the hedge delay should follow the observed latency percentile once
+        enough latencies were observed
+        """
+        policy = HedgePolicy(delay=1, percentile=90, min_samples=10,
+                             samples=100)
+        for i in range(9):
+            policy.observe(i / 100.0)
+        self.assertEqual(policy.hedge_delay(), 1)
+        policy.observe(0.09)
+        self.assertEqual(policy.hedge_delay(), 0.09)
+        self.assertIsNone(HedgePolicy(percentile=50).hedge_delay())
+
+
+class TestHedgedRequests(TestCase):
+    """
+    Test hedged requests in ConsulService
+    """
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    @mock.patch('flask_consulate.service.requests.Session')
+    def test_hedge(self, mocked, mocked_resolve):
+        """
+        a slow GET should be hedged to another endpoint; the first response
+        wins and the slow one is closed once it arrives
+        """
+        mocked_resolve.return_value = (
+            [endpoint('http://slow:80/'), endpoint('http://fast:80/')], 30
+        )
+        slow = mock.Mock(status_code=200)
+        fast = mock.Mock(status_code=200)
+        release = threading.Event()
+
+        def request(method, url, **kwargs):
+            if url.startswith('http://slow'):
+                release.wait(1)
+                return slow
+            return fast
+
+        mocked.return_value.request.side_effect = request
+        cs = ConsulService('consul://', hedge={'delay': 0.01, 'budget': 1})
+        self.assertIs(cs.get('/'), fast)
+        release.set()
+        for _ in range(100):
+            if slow.close.called:
+                break
+            time.sleep(0.01)
+        self.assertTrue(slow.close.called)
+        self.assertFalse(fast.close.called)
+        self.assertEqual(cs.hedge.hedged, 1)
+
+        # only idempotent methods are hedged
+        release.clear()
+        threading.Timer(0.05, release.set).start()
+        self.assertIs(cs.post('/'), slow)
+        self.assertEqual(cs.hedge.hedged, 1)
+
+    @mock.patch('flask_consulate.ConsulService._resolve')
+    @mock.patch('flask_consulate.service.requests.Session')
+    def test_no_budget(self, mocked, mocked_resolve):
+        """
+        without budget, the first request should be waited for
+        """
+        mocked_resolve.return_value = (
+            [endpoint('http://a:80/'), endpoint('http://b:80/')], 30
+        )
+        response = mock.Mock(status_code=200)
+
+        def request(method, url, **kwargs):
+            time.sleep(0.05)
+            return response
+
+        mocked.return_value.request.side_effect = request
+        cs = ConsulService('consul://', hedge={'delay': 0.01, 'budget': 0})
+        self.assertIs(cs.get('/'), response)
+        self.assertEqual(mocked.return_value.request.call_count, 1)
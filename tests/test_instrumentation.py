@@ -0,0 +1,154 @@
+# coding: utf-8
+
+import json
+import unittest
+
+import httpretty
+import mock
+
+from flask import Flask
+from requests.exceptions import ConnectionError
+
+from flask_consulate import Consul, ConsulService
+from flask_consulate.instrumentation import Instrumentation, NOOP, \
+    StatsdInstrumentation, OpenTelemetryInstrumentation, \
+    PrometheusInstrumentation
+
+from helpers import endpoint, records
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+class Recorder(Instrumentation):
+    """
+    Instrumentation that keeps everything it receives
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.observed = []
+        self.incremented = []
+
+    def observe(self, name, value, labels):
+        self.observed.append((name, value, labels))
+
+    def increment(self, name, value, labels):
+        self.incremented.append((name, value, labels))
+
+    def names(self):
+        return [o[0] for o in self.observed]
+
+
+class TestInstrumentation(unittest.TestCase):
+    """
+    Test the metrics reported by ConsulService and Consul
+    """
+
+    def test_disabled(self):
+        """
+        the default instrumentation should be the disabled no-op
+        """
+        cs = ConsulService('consul://tag.FOO.service')
+        self.assertIs(cs.instrumentation, NOOP)
+        self.assertFalse(cs.instrumentation.enabled)
+
+    @mock.patch('flask_consulate.service.Resolver.query')
+    @mock.patch('flask_consulate.ConsulService._parse_srv')
+    @mock.patch('requests.Session.request')
+    def test_service(self, mocked, mocked_parse, mocked_query):
+        """
+        resolve and request latencies, retries and endpoint churn should be
+        reported
+        """
+        recorder = Recorder()
+        mocked_parse.side_effect = [
+            ([endpoint('http://a:80/'), endpoint('http://b:80/')], 0),
+            ([endpoint('http://b:80/'), endpoint('http://c:80/')], 0),
+        ]
+        mocked.side_effect = [ConnectionError, mock.Mock(status_code=200)]
+        cs = ConsulService('consul://tag.FOO.service', min_ttl=0,
+                           retry_policy={'sleep': 0},
+                           instrumentation=recorder)
+        cs.get('/status')
+
+        self.assertEqual(recorder.names().count('resolve_seconds'), 2)
+        requests = [o for o in recorder.observed if o[0] == 'request_seconds']
+        self.assertEqual(
+            [o[2]['status'] for o in requests], ['error', 200],
+        )
+        self.assertEqual(requests[0][2]['service'], 'tag.FOO.service')
+        self.assertIn(
+            ('retries', 1, {'call': 'request'}), recorder.incremented,
+        )
+        self.assertIn(('retry_sleep_seconds', 0, {'call': 'request'}),
+                      recorder.observed)
+        # a was dropped from the cache by the connection error already
+        churn = [i for i in recorder.incremented if i[0] == 'endpoint_churn']
+        self.assertEqual([(i[1], i[2]['change']) for i in churn], [
+            (2, 'added'), (1, 'added'),
+        ])
+
+    @httpretty.activate
+    def test_config_fetch(self):
+        """
+        config fetch duration and size should be reported per namespace
+        """
+        body = json.dumps(records(cfg=(1, 1)))
+        httpretty.register_uri(
+            httpretty.GET, 'http://localhost:8500/v1/kv/ns/', body=body,
+        )
+        recorder = Recorder()
+        consul = Consul(Flask('tests'), consul_host='localhost',
+                        instrumentation=recorder)
+        consul.apply_remote_config('ns/')
+        self.assertEqual(
+            recorder.names(), ['config_fetch_seconds', 'config_fetch_bytes'],
+        )
+        self.assertEqual(recorder.observed[1][1:],
+                         (len(body), {'namespace': 'ns/'}))
+
+    def test_statsd(self):
+        """
+        labels should be folded into statsd metric names
+        """
+        client = mock.Mock(spec=['timing', 'incr'])
+        hooks = StatsdInstrumentation(client)
+        hooks.observe('request_seconds', 0.5, {
+            'service': 'api', 'endpoint': 'http://a:80/', 'status': 200,
+        })
+        client.timing.assert_called_with(
+            'consul.request_seconds.http___a_80_.api.200', 500,
+        )
+        hooks.increment('retries', 1, {'call': 'request'})
+        client.incr.assert_called_with('consul.retries.request', 1)
+
+    def test_opentelemetry(self):
+        """
+        instruments should be created once per metric
+        """
+        meter = mock.Mock()
+        hooks = OpenTelemetryInstrumentation(meter)
+        hooks.observe('config_fetch_bytes', 10, {'namespace': 'ns/'})
+        hooks.observe('config_fetch_bytes', 20, {'namespace': 'ns/'})
+        meter.create_histogram.assert_called_once_with(
+            'consul.config_fetch_bytes', unit='By',
+        )
+        meter.create_histogram.return_value.record.assert_called_with(
+            20, attributes={'namespace': 'ns/'},
+        )
+
+    @unittest.skipIf(prometheus_client is None, 'requires prometheus_client')
+    def test_prometheus(self):
+        """
+        metrics should be exported to the given registry
+        """
+        registry = prometheus_client.CollectorRegistry()
+        hooks = PrometheusInstrumentation(registry=registry)
+        hooks.increment('retries', 2, {'call': 'request'})
+        self.assertEqual(registry.get_sample_value(
+            'consul_retries_total', {'call': 'request'},
+        ), 2)
@@ -0,0 +1,225 @@
+# coding: utf-8
+
+import time
+import unittest
+
+from flask_consulate import ConsulService
+from flask_consulate.endpoints import Endpoint
+from flask_consulate.exceptions import CircuitOpenError
+from flask_consulate.instrumentation import Instrumentation
+from flask_consulate.locality import (
+    Locality, estimate_rtt, NODE, ZONE, NEAR, REMOTE,
+)
+from flask_consulate.testing import FakeConsul
+
+
+def coord(*vec, **kwargs):
+    c = {'Vec': list(vec), 'Error': 0.2, 'Adjustment': 0, 'Height': 0}
+    c.update(kwargs)
+    return c
+
+
+def endpoint(url, node=None, zone=None):
+    return Endpoint(url=url, node=node,
+                    node_meta={'zone': zone} if zone else None)
+
+
+class Recorder(Instrumentation):
+    enabled = True
+
+    def __init__(self):
+        self.counts = []
+
+    def increment(self, name, value, labels):
+        self.counts.append((name, value, labels))
+
+
+class TestLocality(unittest.TestCase):
+    """
+    Test ranking endpoints by locality and choosing among them
+    """
+
+    def test_estimate_rtt(self):
+        """
+        the rtt should be the euclidean distance plus heights and
+        adjustments, ignoring adjustments that would make it negative
+        """
+        a, b = coord(0.001, 0), coord(0, 0.001, Height=0.0005)
+        self.assertAlmostEqual(estimate_rtt(a, b), 2 ** 0.5 / 1000 + 0.0005)
+        a['Adjustment'] = -1
+        self.assertAlmostEqual(estimate_rtt(a, b), 2 ** 0.5 / 1000 + 0.0005)
+        a['Adjustment'] = 0.001
+        self.assertAlmostEqual(estimate_rtt(a, b), 2 ** 0.5 / 1000 + 0.0015)
+
+    def test_rank(self):
+        """
+        endpoints should be grouped by node, zone, coordinates and the rest
+        """
+        locality = Locality(node='n1', zone='a')
+        locality.coords = {'n1': coord(0, 0), 'n3': coord(0.001, 0),
+                           'n4': coord(0.1, 0)}
+        endpoints = [
+            endpoint('e4', 'n4'), endpoint('e3', 'n3'),
+            endpoint('e2', 'n2', zone='a'), endpoint('e1', 'n1'),
+            endpoint('e5'),
+        ]
+        ranked = locality.rank(endpoints)
+        self.assertEqual(
+            [(tier, [e['url'] for e in members]) for tier, members in ranked],
+            [(NODE, ['e1']), (ZONE, ['e2']), (NEAR, ['e3']),
+             (REMOTE, ['e4', 'e5'])],
+        )
+
+    def test_choose(self):
+        """
+        the closest tier with enough available endpoints should be chosen,
+        spilling into farther tiers up to max_tier
+        """
+        endpoints = [endpoint('e1', 'n1'), endpoint('e2', 'n2', zone='a'),
+                     endpoint('e3', 'n3', zone='a'), endpoint('e4', 'n4')]
+        locality = Locality(node='n1', zone='a')
+        ranked = locality.rank(endpoints)
+
+        tier, chosen = locality.choose(ranked, endpoints)
+        self.assertEqual((tier, chosen), (NODE, endpoints[:1]))
+        tier, chosen = locality.choose(ranked, endpoints[1:])
+        self.assertEqual((tier, chosen), (ZONE, endpoints[1:3]))
+
+        locality.min_endpoints = 4
+        tier, chosen = locality.choose(ranked, endpoints)
+        self.assertEqual((tier, chosen), (REMOTE, endpoints))
+
+        locality = Locality(node='n1', zone='a', min_endpoints=4,
+                            max_tier=ZONE)
+        tier, chosen = locality.choose(ranked, endpoints)
+        self.assertEqual((tier, chosen), (ZONE, endpoints[:3]))
+        self.assertEqual(locality.choose(ranked, endpoints[3:]), (None, []))
+
+
+class TestLocalityUpdate(unittest.TestCase):
+    """
+    Test learning the locality from the consul agent
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul(node_meta={'zone': 'a'}).start()
+        self.addCleanup(self.fake.stop)
+        self.agent = '{}:{}'.format(self.fake.host, self.fake.http_port)
+
+    def test_discovery_retried(self):
+        """
+        a failed agent/self lookup should be retried, once coordinate_ttl
+        passed
+        """
+        locality = Locality(agent=self.agent, coordinate_ttl=0.1)
+        self.fake.fail(500)
+        locality.update()
+        self.assertIsNone(locality.node)
+        locality.update()
+        self.assertEqual(len(self.fake.requests), 1)
+        time.sleep(0.2)
+        locality.update()
+        self.assertEqual(locality.node, self.fake.node)
+        self.assertEqual(locality.zone, 'a')
+
+    def test_coordinates_refreshed_in_background(self):
+        """
+        the first coordinates should be fetched right away, and later ones
+        in a background thread
+        """
+        self.fake.coordinates = {self.fake.node: coord(0, 0)}
+        locality = Locality(agent=self.agent, coordinates=True,
+                            coordinate_ttl=0)
+        locality.update()
+        self.assertEqual(list(locality.coords), [self.fake.node])
+
+        self.fake.coordinates = {'n2': coord(0, 0)}
+        self.fake.latency = 0.2
+        start = time.time()
+        locality.update()
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(list(locality.coords), [self.fake.node])
+        deadline = time.time() + 2
+        while 'n2' not in locality.coords and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(list(locality.coords), ['n2'])
+
+
+class TestLocalService(unittest.TestCase):
+    """
+    Test ConsulService preferring close endpoints
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul(node_meta={'zone': 'a'}).start()
+        self.agent = '{}:{}'.format(self.fake.host, self.fake.http_port)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def serve(self, node, zone):
+        endpoint, = self.fake.serve('api', node=node, node_meta={'zone': zone})
+        return endpoint
+
+    def service(self, **kwargs):
+        kwargs.setdefault('agent', self.agent)
+        recorder = Recorder()
+        cs = ConsulService('consul://api.service.consul',
+                           health={'agent': self.agent},
+                           locality=kwargs, instrumentation=recorder)
+        self.addCleanup(cs.stop_refresh)
+        return cs, recorder
+
+    def urls(self, cs, n=6):
+        return set(cs.get('/').json()['endpoint'] for _ in range(n))
+
+    def test_zone(self):
+        """
+        requests should stay in the local node's zone while it has
+        available endpoints, and the tier used should be counted
+        """
+        local = self.serve('n2', 'a')
+        remote = self.serve('n3', 'b')
+        cs, recorder = self.service()
+        self.assertEqual(self.urls(cs), set([local.url]))
+        self.assertEqual(cs.locality.node, self.fake.node)
+        self.assertEqual(cs.locality.zone, 'a')
+        self.assertEqual(
+            [c[2] for c in recorder.counts if c[0] == 'locality_requests'][0],
+            {'service': 'api.service.consul', 'tier': ZONE},
+        )
+
+        cs, _ = self.service(min_endpoints=2)
+        self.assertEqual(self.urls(cs), set([local.url, remote.url]))
+
+    def test_node(self):
+        """
+        endpoints on the local node should be preferred to the zone
+        """
+        self.serve('n2', 'a')
+        local = self.serve(self.fake.node, 'a')
+        cs, _ = self.service()
+        self.assertEqual(self.urls(cs), set([local.url]))
+
+    def test_coordinates(self):
+        """
+        without zones, endpoints near by network coordinates should be
+        preferred
+        """
+        self.fake.coordinates = {
+            self.fake.node: coord(0, 0), 'n2': coord(0.01, 0),
+            'n3': coord(0.0005, 0),
+        }
+        self.serve('n2', 'b')
+        near = self.serve('n3', 'b')
+        cs, _ = self.service(coordinates=True)
+        self.assertEqual(self.urls(cs), set([near.url]))
+
+    def test_max_tier(self):
+        """
+        with only remote endpoints, requests should fail beyond max_tier
+        """
+        self.serve('n3', 'b')
+        cs, _ = self.service(max_tier=ZONE)
+        with self.assertRaises(CircuitOpenError):
+            cs.get('/')
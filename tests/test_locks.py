@@ -0,0 +1,250 @@
+# coding: utf-8
+
+import time
+import threading
+import unittest
+
+import mock
+import requests
+from flask import Flask
+
+from flask_consulate import Consul
+from flask_consulate.exceptions import LockNotAcquired
+from flask_consulate.testing import FakeConsul
+
+
+class TestLock(unittest.TestCase):
+    """
+    Test locks on kv keys held by consul sessions
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul().start()
+        self.addCleanup(self.fake.stop)
+        self.consul = Consul(Flask(__name__), **self.fake.consul_kwargs)
+
+    def test_mutual_exclusion(self):
+        """
+        a held lock should not be acquired by anyone else, and its fencing
+        token should grow with every acquisition
+        """
+        first = self.consul.lock('locks/job', value='first', ttl=10)
+        with first:
+            self.assertTrue(first.held)
+            self.assertEqual(self.fake.kv['locks/job']['Session'], first.session.id)
+            self.assertEqual(self.fake.kv['locks/job']['Value'], b'first')
+            other = self.consul.lock('locks/job', timeout=0)
+            self.assertFalse(other.acquire())
+            with self.assertRaises(LockNotAcquired):
+                with other:
+                    pass
+            token = first.token
+        self.assertFalse(first.held)
+        self.assertNotIn('Session', self.fake.kv['locks/job'])
+        self.assertEqual(self.fake.sessions, {})
+
+        with self.consul.lock('locks/job', timeout=0) as second:
+            self.assertGreater(second.token, token)
+
+    def test_wait(self):
+        """
+        a waiter should be woken up by the release, through a blocking query
+        """
+        first = self.consul.lock('locks/job', ttl=10)
+        self.assertTrue(first.acquire())
+        acquired = []
+
+        def wait():
+            with self.consul.lock('locks/job', timeout=5) as lock:
+                acquired.append(lock.token)
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(acquired, [])
+        start = time.time()
+        first.release()
+        thread.join(5)
+        self.assertEqual(len(acquired), 1)
+        self.assertLess(time.time() - start, 1)
+        self.assertGreater(acquired[0], first.token)
+
+    def test_contention(self):
+        """
+        waiters that lost the race for a released lock should go back to
+        waiting on the key, not sleep for retry_interval
+        """
+        tokens = []
+
+        def work():
+            for _ in range(3):
+                with self.consul.lock('locks/job', ttl=10, timeout=5) as lock:
+                    tokens.append(lock.token)
+                    time.sleep(0.01)
+
+        threads = [threading.Thread(target=work) for _ in range(5)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(len(tokens), 15)
+        self.assertEqual(tokens, sorted(tokens))
+        self.assertLess(time.time() - start, 3)
+
+    def test_lock_delay(self):
+        """
+        a key that stays unlocked while the lock fails is held back by the
+        lock delay, and should be retried after retry_interval
+        """
+        lock = self.consul.lock('locks/job', ttl=10, retry_interval=2)
+        free = ({'locks/job': {'Key': 'locks/job', 'ModifyIndex': 7}}, 7)
+        with mock.patch.object(lock, '_try_lock', side_effect=[None, None, 9]), \
+                mock.patch.object(lock, '_read', return_value=free), \
+                mock.patch('flask_consulate.locks.time.sleep') as sleep:
+            self.assertTrue(lock.acquire())
+        self.addCleanup(lock.release)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(sleep.call_args[0][0], 2)
+        self.assertEqual(lock.token, 9)
+
+    def test_wait_on_key_only(self):
+        """
+        waiters should only be woken up by changes to the key itself, not
+        to keys under it
+        """
+        holder = self.consul.lock('locks/job', ttl=10)
+        self.assertTrue(holder.acquire())
+        self.addCleanup(holder.release)
+        thread = threading.Thread(
+            target=self.consul.lock('locks/job', ttl=10, timeout=1).acquire,
+        )
+        thread.start()
+        time.sleep(0.2)
+        reads = len(self.fake.requests)
+        for i in range(5):
+            self.fake.set_kv('locks/job2/{}'.format(i), i)
+        time.sleep(0.2)
+        self.assertEqual(len(self.fake.requests), reads)
+        thread.join(5)
+
+    def test_timeout(self):
+        """
+        acquire should give up after its timeout and destroy its session
+        """
+        with self.consul.lock('locks/job', ttl=10):
+            start = time.time()
+            self.assertFalse(self.consul.lock('locks/job', wait=1).acquire(0.3))
+            self.assertGreaterEqual(time.time() - start, 0.3)
+            self.assertEqual(len(self.fake.sessions), 1)
+
+    def test_renewal(self):
+        """
+        the session should be renewed while the lock is held, and a lost
+        session detected
+        """
+        lock = self.consul.lock('locks/job', ttl=0.3)
+        self.assertTrue(lock.acquire(0))
+        self.addCleanup(lock.release)
+        time.sleep(0.8)
+        self.assertTrue(lock.held)
+        self.assertEqual(self.fake.kv['locks/job']['Session'], lock.session.id)
+
+        self.fake.destroy_session(lock.session.id)
+        deadline = time.time() + 2
+        while lock.held and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(lock.held)
+
+
+class TestSemaphore(unittest.TestCase):
+    """
+    Test semaphores under kv prefixes
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul().start()
+        self.addCleanup(self.fake.stop)
+        self.consul = Consul(Flask(__name__), **self.fake.consul_kwargs)
+
+    def test_limit(self):
+        """
+        no more than limit holders should hold the semaphore at once, and
+        released or lost slots should be taken over
+        """
+        first = self.consul.semaphore('locks/reports', 2, ttl=10)
+        second = self.consul.semaphore('locks/reports', 2, ttl=10)
+        third = self.consul.semaphore('locks/reports', 2, ttl=10, timeout=0)
+        self.assertTrue(first.acquire())
+        self.assertTrue(second.acquire())
+        self.assertGreater(second.token, first.token)
+        self.assertFalse(third.acquire())
+        self.assertEqual(len(self.fake.sessions), 2)
+
+        session_id = first.session.id
+        first.release()
+        self.assertNotIn('locks/reports/' + session_id, self.fake.kv)
+        self.assertTrue(third.acquire())
+        self.assertFalse(first.acquire(0))
+
+        # the contender key of a lost session is deleted with it
+        self.fake.destroy_session(second.session.id)
+        self.assertTrue(first.acquire(0))
+        first.release()
+        third.release()
+        second.release()
+        self.assertEqual(self.fake.sessions, {})
+        self.assertEqual(sorted(self.fake.kv), ['locks/reports/.lock'])
+
+    def test_wait(self):
+        """
+        a waiter should get the slot once it is released
+        """
+        holder = self.consul.semaphore('locks/reports', 1, ttl=10)
+        self.assertTrue(holder.acquire())
+        waiter = self.consul.semaphore('locks/reports', 1, ttl=10)
+        thread = threading.Thread(target=waiter.acquire, args=(5,))
+        thread.start()
+        time.sleep(0.2)
+        self.assertFalse(waiter.held)
+        holder.release()
+        thread.join(5)
+        self.assertTrue(waiter.held)
+        waiter.release()
+
+    def test_conflicting_limit(self):
+        """
+        contenders should agree on the limit
+        """
+        with self.consul.semaphore('locks/reports', 2, ttl=10):
+            with self.assertRaises(ValueError):
+                self.consul.semaphore('locks/reports', 3, ttl=10).acquire()
+        self.assertEqual(self.fake.sessions, {})
+
+
+class TestFakeSessions(unittest.TestCase):
+    """
+    Test the session API of FakeConsul
+    """
+
+    def test_sessions(self):
+        """
+        sessions should be created, renewed, listed and destroyed, and
+        acquire their keys
+        """
+        fake = FakeConsul().start()
+        self.addCleanup(fake.stop)
+        base = 'http://{}:{}/v1/'.format(fake.host, fake.http_port)
+        session_id = requests.put(base + 'session/create',
+                                  json={'TTL': '10s'}).json()['ID']
+        self.assertTrue(requests.put(base + 'kv/a?acquire=' + session_id,
+                                     data=b'1').json())
+        self.assertFalse(requests.put(base + 'kv/a?acquire=other').ok)
+        self.assertEqual(requests.get(base + 'session/list').json()[0]['ID'],
+                         session_id)
+        self.assertEqual(requests.put(base + 'session/renew/' + session_id)
+                         .status_code, 200)
+        requests.put(base + 'session/destroy/' + session_id)
+        self.assertEqual(requests.put(base + 'session/renew/' + session_id)
+                         .status_code, 404)
+        self.assertNotIn('Session', fake.kv['a'])
@@ -0,0 +1,178 @@
+# coding: utf-8
+
+import mock
+import time
+import threading
+
+from unittest import TestCase
+
+from flask_consulate import ConsulService
+from flask_consulate.exceptions import RateLimitExceeded
+from flask_consulate.ratelimit import TokenBucket, ConcurrencyLimit, \
+    AdaptiveLimit, RateLimiter
+from flask_consulate.testing import FakeConsul
+
+
+class TestLimits(TestCase):
+    """
+    Test the token bucket and the fixed and adaptive concurrency limits
+    """
+
+    def setUp(self):
+        patcher = mock.patch('flask_consulate.ratelimit.monotonic')
+        self.clock = patcher.start()
+        self.clock.return_value = 0
+        self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+        """
+        a burst should be let through at once, then tokens should be added
+        at the rate
+        """
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertIsNone(bucket.take())
+        self.assertIsNone(bucket.take())
+        self.assertAlmostEqual(bucket.take(), 0.1)
+        self.clock.return_value = 0.05
+        self.assertAlmostEqual(bucket.take(), 0.05)
+        self.clock.return_value = 0.1
+        self.assertIsNone(bucket.take())
+        self.clock.return_value = 10
+        bucket.take()
+        self.assertEqual(bucket.tokens, 1)
+
+    def test_concurrency_limit(self):
+        """
+        no more than limit calls should be in flight
+        """
+        limit = ConcurrencyLimit(2)
+        self.assertTrue(limit.take())
+        self.assertTrue(limit.take())
+        self.assertFalse(limit.take())
+        limit.give()
+        self.assertTrue(limit.take())
+
+    def test_adaptive_limit(self):
+        """
+        the limit should grow while in use and successful, and back off
+        once per burst of overloaded calls
+        """
+        limit = AdaptiveLimit(initial=4, latency=1)
+        for _ in range(4):
+            limit.take()
+        for _ in range(4):
+            limit.give(0.1, 200)
+        self.assertGreater(limit.limit, 4.4)
+        # not grown while mostly unused
+        limit.take()
+        limit.give(0.1, 200)
+        self.assertLess(limit.limit, 4.5)
+
+        limit.limit = 8
+        self.clock.return_value = 10
+        limit.take()
+        limit.take()
+        limit.give(0.5, 503)
+        self.assertEqual(limit.limit, 4)
+        # started before the decrease
+        limit.give(2, 200)
+        self.assertEqual(limit.limit, 4)
+
+        self.clock.return_value = 20
+        limit.take()
+        limit.give(2, 200)
+        self.assertEqual(limit.limit, 2)
+
+        limit.take()
+        limit.give(None, None)
+        self.assertEqual(limit.limit, 2)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_rate_limiter(self):
+        """
+        both the service and the endpoint limits should be claimed, or
+        neither
+        """
+        limiter = RateLimiter(concurrency=2, per_endpoint={'concurrency': 1})
+        limiter.acquire('a')
+        with self.assertRaises(RateLimitExceeded) as cm:
+            limiter.acquire('a')
+        self.assertGreater(cm.exception.retry_after, 0)
+        limiter.acquire('b')
+        self.assertIsNotNone(limiter.try_acquire('c'))
+
+        limiter.release('a', 0.1, 200)
+        snapshot = limiter.snapshot()
+        self.assertEqual(snapshot['service']['in_flight'], 1)
+        self.assertEqual(snapshot['service']['rejected'], 1)
+        self.assertEqual(snapshot['endpoints']['a'],
+                         {'rejected': 1, 'limit': 1, 'in_flight': 0})
+        self.assertIsNone(limiter.try_acquire('a'))
+
+
+class TestRateLimitedService(TestCase):
+    """
+    Test ConsulService limiting the requests to its endpoints
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul().start()
+        self.backend, = self.fake.serve('api')
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def service(self, **rate_limit):
+        return self.fake.service('consul://api.service.consul',
+                                 cls=ConsulService, rate_limit=rate_limit)
+
+    def test_fail_fast(self):
+        """
+        requests beyond the rate should fail without being sent or retried
+        """
+        cs = self.service(rate=0.001, burst=2)
+        cs.get('/')
+        cs.get('/')
+        with self.assertRaises(RateLimitExceeded):
+            cs.get('/')
+        self.assertEqual(self.backend.hits, 2)
+
+    def test_queue(self):
+        """
+        requests beyond the concurrency limit should wait for a slot
+        """
+        self.backend.latency = 0.1
+        cs = self.service(concurrency=1, timeout=5)
+        cs.get('/')
+        threads = [
+            threading.Thread(target=cs.get, args=('/',)) for _ in range(3)
+        ]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # one after the other
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(self.backend.hits, 4)
+        self.assertEqual(cs.rate_limit.service.concurrency.in_flight, 0)
+
+        cs = self.service(concurrency=1, timeout=0.01)
+        cs.rate_limit.acquire(self.backend.url)
+        with self.assertRaises(RateLimitExceeded):
+            cs.get('/')
+        cs.rate_limit.release(self.backend.url)
+        cs.get('/')
+
+    def test_adaptive(self):
+        """
+        503 responses should lower the concurrency limit of the endpoint
+        """
+        cs = self.service(per_endpoint={'adaptive': {'initial': 8}})
+        cs.get('/')
+        self.backend.failure_mode = 'unavailable'
+        self.backend.failure_rate = 1
+        cs.get('/', retry_policy={'max_tries': 1})
+        limits = cs.rate_limit.endpoints[self.backend.url]
+        self.assertEqual(limits.concurrency.limit, 4)
+        self.assertEqual(limits.concurrency.in_flight, 0)
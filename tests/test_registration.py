@@ -0,0 +1,102 @@
+# coding: utf-8
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+
+from flask_consulate import Consul
+from flask_consulate.registration import RegistrationManager, CRITICAL
+from flask_consulate.testing import FakeConsul, PASSING
+
+from helpers import wait_for
+
+
+class TestRegistrationManager(unittest.TestCase):
+    """
+    Test registering services from a background thread
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul().start()
+        self.addCleanup(self.fake.stop)
+        self.consul = Consul(Flask(__name__), **self.fake.consul_kwargs)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.lock_path = os.path.join(directory, 'registration.lock')
+
+    def manager(self, **kwargs):
+        kwargs.setdefault('lock_path', self.lock_path)
+        kwargs.setdefault('standby_interval', 0.05)
+        manager = RegistrationManager(self.consul, **kwargs)
+        manager.add('web', port=80, ttl=1)
+        manager.add('admin', port=81, tags=['internal'],
+                    http='http://localhost:81/health')
+        self.addCleanup(manager.stop)
+        return manager
+
+    def registrations(self):
+        return len([r for r in self.fake.requests
+                    if r == ('PUT', '/v1/agent/service/register')])
+
+    def test_register(self):
+        """
+        the services should be registered in the background, their TTL
+        checks kept passing, and deregistered on stop
+        """
+        manager = self.consul.register_services(
+            {'name': 'web', 'port': 80, 'ttl': 1, 'deregister_after': '1m'},
+            lock_path=self.lock_path,
+        )
+        self.addCleanup(manager.stop)
+        wait_for(lambda: self.fake.checks.get('service:web', {})
+                 .get('Status') == PASSING)
+        self.assertEqual(self.fake.services['web']['Port'], 80)
+
+        manager.set_status('web', CRITICAL, 'database down')
+        wait_for(lambda: self.fake.checks['service:web']['Status'] == CRITICAL)
+        self.assertEqual(self.fake.checks['service:web']['Output'],
+                         'database down')
+
+        manager.stop()
+        self.assertEqual(self.fake.services, {})
+
+    def test_once_per_host(self):
+        """
+        only the process holding the lock should register, and another one
+        should take over when it exits
+        """
+        first = self.manager().start()
+        wait_for(lambda: first.registered)
+        second = self.manager().start()
+        time.sleep(0.2)
+        self.assertFalse(second.registered)
+        self.assertEqual(self.registrations(), 2)
+
+        first.stop()
+        wait_for(lambda: second.registered)
+        self.assertEqual(sorted(self.fake.services), ['admin', 'web'])
+        self.assertEqual(self.fake.services['admin']['Tags'], ['internal'])
+
+    def test_coalesced_heartbeats(self):
+        """
+        repeated statuses should be sent once per heartbeat, and a lost
+        registration should be restored
+        """
+        manager = self.manager(heartbeat_interval=60).start()
+        wait_for(lambda: manager.registered)
+        for _ in range(100):
+            manager.set_status('web', PASSING, 'ok')
+        time.sleep(0.1)
+        updates = [r for r in self.fake.requests
+                   if r[1] == '/v1/agent/check/update/service:web']
+        self.assertEqual(len(updates), 1)
+
+        self.fake.deregister('web')
+        manager.set_status('web', CRITICAL)
+        wait_for(lambda: self.registrations() == 4)
+        wait_for(lambda: self.fake.checks.get('service:web', {})
+                 .get('Status') == CRITICAL)
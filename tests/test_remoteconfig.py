@@ -1,13 +1,18 @@
 # coding: utf-8
 
 import os
+import json
 import unittest
 
+import mock
+
 from httpretty import HTTPretty
 from flask import Flask
 
 from flask_consulate import Consul
 
+from helpers import record, records
+
 
 class MockConsulKV:
     """
@@ -117,3 +122,107 @@ class TestApplyRemoteConfig(unittest.TestCase):
 
         self.assertEqual(app.config['cfg_1'], 'consul_1')
         self.assertEqual(app.config['cfg_3'], 'consul_3')
+
+    def test_config_incremental(self):
+        """
+        Ensures that repeated passes only de-serialize and apply keys whose
+        ModifyIndex changed, report the changes, and prune removed keys on
+        request
+        """
+        HTTPretty.enable()
+        HTTPretty.register_uri(
+            HTTPretty.GET,
+            'http://localhost:8500/v1/kv/ns/',
+            responses=[
+                HTTPretty.Response(body=json.dumps(
+                    records(cfg_1=(1, 'a'), cfg_3=(2, [1])),
+                )),
+                HTTPretty.Response(body=json.dumps(
+                    records(cfg_1=(1, 'a'), cfg_3=(3, [2])),
+                )),
+                HTTPretty.Response(body=json.dumps(records(cfg_3=(3, [2])))),
+                HTTPretty.Response(body=json.dumps(records())),
+            ],
+        )
+        try:
+            app = self.create_app()
+            consul = Consul(app, consul_host='localhost')
+            diff = consul.apply_remote_config('ns/')
+            self.assertEqual(diff.added, {'cfg_1': 'a', 'cfg_3': [1]})
+
+            app.config['cfg_1'] = 'local'
+            with mock.patch.object(consul, '_decode',
+                                   wraps=consul._decode) as decode:
+                diff = consul.apply_remote_config('ns/')
+            self.assertEqual(decode.call_count, 1)
+            self.assertEqual(diff.changed, {'cfg_3': [2]})
+            self.assertEqual(diff.added, {})
+            self.assertEqual(app.config['cfg_1'], 'local')
+
+            diff = consul.apply_remote_config('ns/')
+            self.assertEqual(diff.removed, {'cfg_1'})
+            self.assertEqual(app.config['cfg_1'], 'local')
+
+            diff = consul.apply_remote_config('ns/', prune=True)
+            self.assertEqual(diff.removed, {'cfg_3'})
+            self.assertNotIn('cfg_3', app.config)
+            self.assertEqual(app.config['cfg_2'], 'local_2')
+        finally:
+            HTTPretty.reset()
+            HTTPretty.disable()
+
+    def test_config_layers(self):
+        """
+        Ensures that several namespaces are fetched in a single transaction,
+        with keys of later namespaces taking precedence, and that agents
+        without transaction support are queried per namespace instead
+        """
+        HTTPretty.enable()
+        HTTPretty.register_uri(
+            HTTPretty.PUT,
+            'http://localhost:8500/v1/txn',
+            body=json.dumps({'Results': [
+                {'KV': record('shared/cfg_1', 1, 'shared_1')},
+                {'KV': record('shared/cfg_3', 2, 'shared_3')},
+                {'KV': record('svc/cfg_3', 3, 'svc_3')},
+            ], 'Errors': None}),
+        )
+        try:
+            app = self.create_app()
+            consul = Consul(app, consul_host='localhost')
+            diff = consul.apply_remote_config(['shared/', 'svc/'])
+            self.assertEqual(
+                json.loads(HTTPretty.last_request.body.decode('utf-8')),
+                [
+                    {'KV': {'Verb': 'get-tree', 'Key': 'shared/'}},
+                    {'KV': {'Verb': 'get-tree', 'Key': 'svc/'}},
+                ],
+            )
+            self.assertEqual(diff.added, {'cfg_1': 'shared_1', 'cfg_3': 'svc_3'})
+            self.assertEqual(app.config['cfg_3'], 'svc_3')
+            self.assertEqual(
+                consul.kv_indexes[('shared/', 'svc/')],
+                {'cfg_1': (0, 1), 'cfg_3': (1, 3)},
+            )
+
+            HTTPretty.reset()
+            HTTPretty.register_uri(
+                HTTPretty.PUT, 'http://localhost:8500/v1/txn', status=404,
+            )
+            HTTPretty.register_uri(
+                HTTPretty.GET, 'http://localhost:8500/v1/kv/shared/',
+                body=json.dumps([
+                    record('shared/cfg_1', 1, 'shared_1'),
+                    record('shared/cfg_3', 2, 'shared_3'),
+                ]),
+            )
+            HTTPretty.register_uri(
+                HTTPretty.GET, 'http://localhost:8500/v1/kv/svc/', status=404,
+            )
+            diff = consul.apply_remote_config(['shared/', 'svc/'])
+            self.assertEqual(diff.changed, {'cfg_3': 'shared_3'})
+            self.assertEqual(diff.added, {})
+            self.assertEqual(app.config['cfg_3'], 'shared_3')
+        finally:
+            HTTPretty.reset()
+            HTTPretty.disable()
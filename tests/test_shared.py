@@ -0,0 +1,85 @@
+# coding: utf-8
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from flask import Flask
+
+from flask_consulate import Consul
+from flask_consulate.shared import SharedConfig
+
+from helpers import records
+
+
+class TestSharedConfig(unittest.TestCase):
+    """
+    Test sharing the remote config between pre-forked workers
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'shared')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_consul(self):
+        app = Flask('tests')
+        with mock.patch('consulate.Session'):
+            consul = Consul(app, consul_host='localhost')
+        return app, consul
+
+    def test_fetch(self):
+        """
+        only the first caller should fetch; later callers should read the
+        shared payload until it is too old
+        """
+        shared = SharedConfig(self.path, max_age=60)
+        fetch = mock.Mock(return_value={'namespace': 'ns/', 'config': {}})
+        self.assertEqual(shared.fetch('ns/', fetch)[1], True)
+        payload, fetched = shared.fetch('ns/', fetch)
+        self.assertFalse(fetched)
+        self.assertEqual(payload, fetch.return_value)
+        self.assertEqual(fetch.call_count, 1)
+
+        self.assertIsNone(shared.read('other/'))
+        self.assertIsNone(SharedConfig(self.path, max_age=-1).read('ns/'))
+
+    def test_share_remote_config(self):
+        """
+        a worker attaching to the shared config should get the parsed values
+        and kv indexes without querying consul
+        """
+        app, consul = self.create_consul()
+        with mock.patch.object(consul, '_fetch_kv') as fetch:
+            fetch.return_value = (records(a=(1, {'x': 1}), b=(2, 'y')), 2)
+            diff = consul.share_remote_config(self.path, 'ns/')
+        self.assertEqual(diff.added, {'a': {'x': 1}, 'b': 'y'})
+
+        worker_app, worker = self.create_consul()
+        with mock.patch.object(worker, '_fetch_kv') as fetch:
+            diff = worker.share_remote_config(self.path, 'ns/')
+            self.assertFalse(fetch.called)
+        self.assertEqual(diff.added, {'a': {'x': 1}, 'b': 'y'})
+        self.assertEqual(worker_app.config['a'], {'x': 1})
+        self.assertEqual(worker.kv_indexes, consul.kv_indexes)
+
+    def test_session_after_fork(self):
+        """
+        the consulate session and http session should be re-created in a
+        forked process
+        """
+        app, consul = self.create_consul()
+        session, http = consul.session, consul.http
+        self.assertIs(consul.session, session)
+        self.assertIs(consul.http, http)
+
+        with mock.patch('consulate.Session') as mocked, \
+                mock.patch('flask_consulate.consul.os.getpid') as getpid:
+            getpid.return_value = -1
+            self.assertIs(consul.session, mocked.return_value)
+            self.assertIsNot(consul.http, http)
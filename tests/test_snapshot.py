@@ -0,0 +1,127 @@
+# coding: utf-8
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import httpretty
+import mock
+
+from flask import Flask
+
+from flask_consulate import Consul
+from flask_consulate.exceptions import ConsulConnectionError
+from flask_consulate.snapshot import ConfigSnapshot
+
+from helpers import records
+
+URL = 'http://localhost:8500/v1/kv/ns/'
+
+
+class TestConfigSnapshot(unittest.TestCase):
+    """
+    Test the on-disk snapshot of the remote config
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'config.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_consul(self, **kwargs):
+        app = Flask('tests')
+        with mock.patch('consulate.Session'):
+            consul = Consul(
+                app, consul_host='localhost', snapshot_path=self.path, **kwargs
+            )
+        return app, consul
+
+    def test_read_write(self):
+        """
+        a snapshot should be read back, and rejected if it is of another
+        namespace or format version, or too old
+        """
+        snapshot = ConfigSnapshot(self.path, max_age=60)
+        self.assertIsNone(snapshot.read('ns/'))
+        snapshot.write('ns/', 42, records(a=(1, 'x')))
+        self.assertEqual(snapshot.read('ns/'), (records(a=(1, 'x')), 42))
+        self.assertIsNone(snapshot.read('other/'))
+        self.assertEqual(os.listdir(self.tmpdir), ['config.json'])
+
+        later = time.time() + 61
+        with mock.patch('flask_consulate.snapshot.time.time') as now:
+            now.return_value = later
+            self.assertIsNone(snapshot.read('ns/'))
+
+        with open(self.path) as f:
+            content = json.load(f)
+        content['version'] = 0
+        with open(self.path, 'w') as f:
+            json.dump(content, f)
+        self.assertIsNone(snapshot.read('ns/'))
+
+    @httpretty.activate
+    def test_bootstrap(self):
+        """
+        bootstrap_remote_config should apply the snapshot written by an
+        earlier apply_remote_config, and then only the keys that changed
+        """
+        httpretty.register_uri(httpretty.GET, URL, responses=[
+            httpretty.Response(
+                body=json.dumps(records(a=(1, 'x'), b=(2, 'y'))),
+                adding_headers={'X-Consul-Index': '2'},
+            ),
+            httpretty.Response(
+                body=json.dumps(records(a=(1, 'x'), b=(3, 'z'))),
+                adding_headers={'X-Consul-Index': '3'},
+            ),
+        ])
+        app, consul = self.create_consul()
+        consul.apply_remote_config('ns/')
+
+        app, consul = self.create_consul()
+        with mock.patch.object(consul, '_decode',
+                               wraps=consul._decode) as decode:
+            diff = consul.bootstrap_remote_config('ns/')
+        self.assertEqual(diff.added, {'a': 'x', 'b': 'y'})
+        self.assertEqual(decode.call_count, 3)
+        self.assertEqual(app.config['b'], 'z')
+        self.assertEqual(consul.snapshot_indexes['ns/'], 3)
+        self.assertEqual(ConfigSnapshot(self.path).read('ns/')[1], 3)
+
+    def test_bootstrap_background(self):
+        """
+        with background=True, the snapshot should be applied without waiting
+        for consul, and failing to reach consul should keep the snapshot
+        """
+        ConfigSnapshot(self.path).write('ns/', 7, records(a=(1, 'x')))
+        app, consul = self.create_consul()
+        with mock.patch.object(consul, '_fetch_kv') as fetch:
+            fetch.side_effect = ConsulConnectionError
+            with mock.patch('flask_consulate.consul.threading.Thread') as thread:
+                diff = consul.bootstrap_remote_config('ns/', background=True)
+                reconcile = thread.call_args[1]['target']
+            self.assertEqual(diff.added, {'a': 'x'})
+            self.assertEqual(fetch.call_count, 0)
+            reconcile()
+        self.assertEqual(app.config['a'], 'x')
+
+    @httpretty.activate
+    def test_bootstrap_without_snapshot(self):
+        """
+        without a snapshot, bootstrap_remote_config should fetch from consul
+        and write the snapshot
+        """
+        httpretty.register_uri(
+            httpretty.GET, URL, body=json.dumps(records(a=(1, 'x'))),
+            adding_headers={'X-Consul-Index': '1'},
+        )
+        app, consul = self.create_consul(snapshot_max_age=60)
+        diff = consul.bootstrap_remote_config('ns/', background=True)
+        self.assertEqual(diff.added, {'a': 'x'})
+        self.assertEqual(ConfigSnapshot(self.path).read('ns/')[1], 1)
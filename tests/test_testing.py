@@ -0,0 +1,147 @@
+# coding: utf-8
+
+import json
+import threading
+import unittest
+
+import requests
+
+from flask import Flask
+
+from flask_consulate import Consul
+from flask_consulate.testing import FakeConsul, CRITICAL, parse_duration
+
+
+class TestFakeConsul(unittest.TestCase):
+    """
+    Test the fake consul agent over real sockets
+    """
+
+    def setUp(self):
+        self.fake = FakeConsul().start()
+        self.base = 'http://{}:{}/v1/'.format(self.fake.host, self.fake.http_port)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def test_parse_duration(self):
+        """
+        consul durations should be converted to seconds
+        """
+        self.assertEqual(parse_duration('10s'), 10)
+        self.assertEqual(parse_duration('5m'), 300)
+        self.assertEqual(parse_duration('100ms'), 0.1)
+        self.assertEqual(parse_duration(None, default=3), 3)
+
+    def test_kv(self):
+        """
+        the kv store should track modify indexes, and be read by
+        apply_remote_config
+        """
+        self.fake.set_kv('ns/cfg_1', {'a': 1})
+        self.fake.set_kv('ns/cfg_2', 'two')
+        app = Flask('tests')
+        consul = Consul(app, **self.fake.consul_kwargs)
+        diff = consul.apply_remote_config('ns/')
+        self.assertEqual(diff.added, {'cfg_1': {'a': 1}, 'cfg_2': 'two'})
+
+        requests.put(self.base + 'kv/ns/cfg_2', data=b'"three"')
+        self.assertEqual(self.fake.kv['ns/cfg_2']['CreateIndex'], 2)
+        self.assertEqual(self.fake.kv['ns/cfg_2']['ModifyIndex'], 3)
+        diff = consul.apply_remote_config('ns/')
+        self.assertEqual(diff.changed, {'cfg_2': 'three'})
+
+        r = requests.get(self.base + 'kv/ns/', params={'keys': ''})
+        self.assertEqual(r.json(), ['ns/cfg_1', 'ns/cfg_2'])
+        r = requests.put(self.base + 'kv/ns/cfg_1', params={'cas': 1},
+                         data=b'2')
+        self.assertEqual(r.json(), True)
+        r = requests.put(self.base + 'kv/ns/cfg_1', params={'cas': 1},
+                         data=b'3')
+        self.assertEqual(r.json(), False)
+
+    def test_blocking_query(self):
+        """
+        blocking queries should return once the namespace changes
+        """
+        self.fake.set_kv('ns/cfg', 1)
+        r = requests.get(self.base + 'kv/ns/', params={'recurse': ''})
+        index = int(r.headers['X-Consul-Index'])
+
+        timer = threading.Timer(0.1, self.fake.set_kv, ('ns/cfg', 2))
+        timer.start()
+        r = requests.get(self.base + 'kv/ns/', params={
+            'recurse': '', 'index': index, 'wait': '5s',
+        })
+        self.assertGreater(int(r.headers['X-Consul-Index']), index)
+        self.assertEqual(r.json()[0]['Value'], 'Mg==')
+
+        r = requests.get(self.base + 'kv/other/', params={
+            'recurse': '', 'index': 1, 'wait': '50ms',
+        })
+        self.assertEqual(r.status_code, 404)
+
+    def test_agent(self):
+        """
+        services registered through the agent API should show up in the
+        health API with the status of their checks
+        """
+        app = Flask('tests')
+        consul = Consul(app, **self.fake.consul_kwargs)
+        consul.register_service(name='web', port=80, ttl='10s')
+        self.assertIn('web', self.fake.services)
+
+        r = requests.get(self.base + 'health/service/web',
+                         params={'passing': ''})
+        self.assertEqual(r.json(), [])
+        requests.put(self.base + 'agent/check/pass/service:web')
+        r = requests.get(self.base + 'health/service/web',
+                         params={'passing': ''})
+        self.assertEqual(r.json()[0]['Service']['Port'], 80)
+
+        requests.put(self.base + 'agent/service/deregister/web')
+        self.assertEqual(self.fake.services, {})
+        self.assertEqual(self.fake.checks, {})
+
+    def test_dns_failover(self):
+        """
+        ConsulService should resolve the passing instances through DNS and
+        fail over when one of them goes away
+        """
+        first, second = self.fake.serve('api', instances=2, tags=['v1'])
+        self.fake.register('api', 1, service_id='api-down', tags=['v1'],
+                           status=CRITICAL)
+        cs = self.fake.service('consul://v1.api.service.consul')
+        self.assertEqual(
+            sorted(e['url'] for e in cs.endpoints),
+            sorted([first.url, second.url]),
+        )
+
+        first.stop()
+        for _ in range(4):
+            r = cs.get('/status')
+            self.assertEqual(r.json()['endpoint'], second.url)
+
+        second.latency = 0.01
+        second.failure_rate = 1
+        self.assertEqual(cs.get('/status', retry_policy={
+            'max_tries': 1,
+        }).status_code, 503)
+
+    def test_txn_and_errors(self):
+        """
+        transactions should be applied atomically, and injected errors
+        returned before anything else
+        """
+        r = requests.put(self.base + 'txn', data=json.dumps([
+            {'KV': {'Verb': 'set', 'Key': 'a/1', 'Value': 'MQ=='}},
+            {'KV': {'Verb': 'set', 'Key': 'a/2', 'Value': 'Mg=='}},
+            {'KV': {'Verb': 'get-tree', 'Key': 'a/'}},
+        ]))
+        self.assertEqual(len(r.json()['Results']), 4)
+
+        self.fake.fail(503)
+        r = requests.get(self.base + 'kv/a/1')
+        self.assertEqual(r.status_code, 503)
+        r = requests.get(self.base + 'kv/a/1', params={'raw': ''})
+        self.assertEqual(r.content, b'1')
@@ -0,0 +1,172 @@
+# coding: utf-8
+
+import unittest
+import httpretty
+import mock
+
+from flask import Flask
+from requests.exceptions import ConnectionError
+
+from flask_consulate import Consul
+from flask_consulate.codecs import get_codec
+from flask_consulate.testing import FakeConsul
+from flask_consulate.watch import KVWatcher
+
+from helpers import kv_response, record, wait_for
+
+NAMESPACE = 'config/watched/'
+URL = 'http://localhost:8500/v1/kv/config/watched/'
+
+
+class TestKVWatcher(unittest.TestCase):
+    """
+    Test the blocking query watcher that keeps app.config in sync with
+    consul's kv store
+    """
+
+    def setUp(self):
+        self.app = Flask('tests')
+        self.app.config['local'] = 'value'
+        with mock.patch('consulate.Session'):
+            self.consul = Consul(self.app, consul_host='localhost')
+
+    @httpretty.activate
+    def test_poll(self):
+        """
+        every poll should block on the last X-Consul-Index and only apply
+        keys whose ModifyIndex changed
+        """
+        httpretty.register_uri(httpretty.GET, URL, responses=[
+            kv_response(10, NAMESPACE, a=(5, 1), b=(10, {'x': 1})),
+            kv_response(12, NAMESPACE, a=(5, 1), b=(12, {'x': 2}),
+                        c=(11, 'new')),
+            kv_response(13, NAMESPACE, b=(12, {'x': 2})),
+        ])
+        callback = mock.Mock()
+        watcher = KVWatcher(self.consul, NAMESPACE, callback=callback, wait=5)
+
+        diff = watcher.poll()
+        self.assertEqual(diff.added, {'a': 1, 'b': {'x': 1}})
+        self.assertNotIn('index', httpretty.last_request().querystring)
+        self.assertEqual(self.app.config['b'], {'x': 1})
+
+        with mock.patch.object(self.consul, '_decode',
+                               wraps=self.consul._decode) as decode:
+            diff = watcher.poll()
+        self.assertEqual(decode.call_count, 2)
+        self.assertEqual(diff.added, {'c': 'new'})
+        self.assertEqual(diff.changed, {'b': {'x': 2}})
+        self.assertIn('recurse', httpretty.last_request().path)
+        self.assertEqual(httpretty.last_request().querystring['index'], ['10'])
+        self.assertEqual(httpretty.last_request().querystring['wait'], ['5s'])
+
+        diff = watcher.poll()
+        self.assertEqual(diff.removed, {'a', 'c'})
+        self.assertEqual(watcher.index, 13)
+        self.assertEqual(callback.call_count, 3)
+        self.assertEqual(self.app.config['local'], 'value')
+
+    @httpretty.activate
+    def test_poll_index_reset(self):
+        """
+        a lower X-Consul-Index than the last one should restart from 0, and
+        an unchanged namespace should not fire the callback
+        """
+        httpretty.register_uri(httpretty.GET, URL, responses=[
+            kv_response(10, NAMESPACE, a=(5, 1)),
+            kv_response(3, NAMESPACE, a=(5, 1)),
+        ])
+        callback = mock.Mock()
+        watcher = KVWatcher(self.consul, NAMESPACE, callback=callback)
+        watcher.poll()
+        diff = watcher.poll()
+        self.assertFalse(diff)
+        self.assertEqual(watcher.index, 0)
+        self.assertEqual(callback.call_count, 1)
+
+    @httpretty.activate
+    def test_poll_undecodable(self):
+        """
+        a value its codec can't decode should be skipped, without recording
+        its ModifyIndex, instead of failing the whole poll
+        """
+        self.consul.codecs['a'] = self.consul.codecs['b'] = get_codec('int')
+        httpretty.register_uri(httpretty.GET, URL, responses=[
+            kv_response(10, NAMESPACE, a=(5, 'not-an-int'), b=(10, 1)),
+            kv_response(11, NAMESPACE, a=(11, 2), b=(10, 1)),
+        ])
+        watcher = KVWatcher(self.consul, NAMESPACE, prune=True)
+        diff = watcher.poll()
+        self.assertEqual(diff.added, {'b': 1})
+        self.assertNotIn('a', self.app.config)
+        self.assertNotIn('a', watcher.indexes)
+
+        diff = watcher.poll()
+        self.assertEqual(diff.added, {'a': 2})
+        self.assertEqual(watcher.indexes['a'], 11)
+
+        with self.assertRaises(ValueError):
+            self.consul._apply_records(NAMESPACE, [
+                record(NAMESPACE + 'b', 12, b'x', raw=True),
+            ], {})
+
+    def test_callback_error(self):
+        """
+        a callback that raises should be logged, and the watcher keep
+        applying changes
+        """
+        fake = FakeConsul().start()
+        self.addCleanup(fake.stop)
+        app = Flask('tests')
+        consul = Consul(app, **fake.consul_kwargs)
+        fake.set_kv(NAMESPACE + 'a', 1)
+        diffs = []
+
+        def callback(diff):
+            diffs.append(diff)
+            raise ZeroDivisionError
+
+        with mock.patch.object(app.logger, 'error') as error:
+            watcher = consul.watch_remote_config(NAMESPACE, callback=callback,
+                                                 wait=1)
+            self.addCleanup(watcher.stop)
+            wait_for(lambda: len(diffs) == 1)
+            fake.set_kv(NAMESPACE + 'a', 2)
+            wait_for(lambda: len(diffs) == 2)
+        self.assertTrue(watcher.is_alive())
+        self.assertEqual(app.config['a'], 2)
+        self.assertEqual(error.call_count, 2)
+
+    def test_backoff(self):
+        """
+        failed queries should be retried with jittered exponential backoff
+        """
+        watcher = KVWatcher(self.consul, NAMESPACE, retry_interval=1,
+                            max_retry_interval=4)
+        delays = []
+
+        def wait(delay):
+            delays.append(delay)
+            if len(delays) == 4:
+                watcher.stop()
+
+        with mock.patch.object(watcher, 'poll', side_effect=ConnectionError), \
+                mock.patch.object(watcher._stopped, 'wait', side_effect=wait), \
+                mock.patch('flask_consulate.decorators.random.uniform',
+                           side_effect=lambda low, high: high) as uniform:
+            watcher.run()
+        self.assertEqual(delays, [1, 2, 4, 4])
+        self.assertEqual(uniform.call_count, 4)
+
+    def test_watch_remote_config(self):
+        """
+        watch_remote_config should start a daemon thread that can be stopped
+        """
+        with mock.patch.object(KVWatcher, 'poll') as poll:
+            watcher = self.consul.watch_remote_config(NAMESPACE, wait=1)
+            self.assertTrue(watcher.daemon)
+            watcher.stop()
+            watcher.join(1)
+        self.assertFalse(watcher.is_alive())
+        self.assertEqual(watcher.namespace, NAMESPACE)
+        self.assertTrue(poll.called)